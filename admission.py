@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import deque
+
+import sandbox
+import timing
+
+# Renders running at once in this server process, over all apps and sessions
+MAX_RENDERS = int(os.environ.get("CONLINE_MAX_RENDERS", max(2, os.cpu_count() or 1)))
+# Longest wait in the queue before giving up on a render
+QUEUE_TIMEOUT = 30
+POLL_INTERVAL = 0.05
+# Under load the grid side shrinks with the square root of the demand per slot
+# (so the points, and the work, with the demand itself), down to this fraction
+MIN_SCALE = 0.4
+
+
+class Ticket:
+    """A render admitted, or waiting to be, for one session."""
+
+    def __init__(self, app, session, load):
+        self.app = app
+        self.session = session
+        # Renders running or waiting per slot when it arrived, itself included
+        self.load = load
+        self.scale = 1.0 if load <= 1 else max(MIN_SCALE, load ** -0.5)
+        self.superseded = False
+        self.waited = 0.0
+
+
+_cond = threading.Condition()
+_queue = deque()
+_running = set()
+_sessions = {}
+_local = threading.local()
+
+
+def current():
+    """Return the Ticket held by this thread, if any."""
+    return getattr(_local, "ticket", None)
+
+
+def scale():
+    """Fraction of its usual grid side the current render should use (1.0 when not loaded)."""
+    ticket = current()
+    return ticket.scale if ticket is not None else 1.0
+
+
+def scaled(n, n_min=20):
+    """Grid side ``n`` lowered by the current load, but not below ``n_min``."""
+    return max(min(n, n_min), int(n * scale()))
+
+
+def status():
+    """Renders running and waiting now, and the number of slots."""
+    with _cond:
+        return {"running": len(_running), "waiting": len(_queue), "slots": MAX_RENDERS}
+
+
+def _drop(ticket):
+    # Called with _cond held
+    if ticket in _queue:
+        _queue.remove(ticket)
+    _running.discard(ticket)
+    if _sessions.get(ticket.session) is ticket:
+        del _sessions[ticket.session]
+    _cond.notify_all()
+
+
+def admit(app):
+    """Wait for a render slot for ``app`` and hold it in this thread until release.
+
+    A session has one render at a time: a newer one supersedes it, cancelling
+    it in the queue or, if it already runs, its sandboxed computation. The
+    wait is timed as the "queue" stage of the current render.
+    """
+    release()  # left over by a run of this thread that never got to release
+    session = sandbox.session_key()
+    with _cond:
+        ticket = Ticket(app, session, (len(_running) + len(_queue) + 1) / MAX_RENDERS)
+        previous = _sessions.get(session) if session is not None else None
+        if previous is not None:
+            previous.superseded = True
+            if previous in _queue:
+                _queue.remove(previous)
+        if session is not None:
+            _sessions[session] = ticket
+        _queue.append(ticket)
+        _cond.notify_all()
+        cancel_previous = previous in _running
+    if cancel_previous:
+        sandbox.cancel(session)
+
+    start = time.perf_counter()
+    deadline = time.monotonic() + QUEUE_TIMEOUT
+    with timing.stage("queue"):
+        with _cond:
+            while _queue[0] is not ticket or len(_running) >= MAX_RENDERS:
+                if ticket.superseded or sandbox.rerun_requested():
+                    _drop(ticket)
+                    raise sandbox.SandboxCancelled("Generazione annullata: sostituita da una richiesta più recente")
+                if time.monotonic() > deadline:
+                    _drop(ticket)
+                    raise sandbox.SandboxError(f"Server occupato: nessuna generazione libera da {QUEUE_TIMEOUT} s, "
+                                               "riprova tra poco")
+                _cond.wait(POLL_INTERVAL)
+            _queue.popleft()
+            _running.add(ticket)
+            _cond.notify_all()
+    ticket.waited = time.perf_counter() - start
+    _local.ticket = ticket
+    return ticket
+
+
+def release():
+    """Give back the slot held by this thread, if any."""
+    ticket = current()
+    if ticket is None:
+        return
+    _local.ticket = None
+    with _cond:
+        _drop(ticket)
+
+
+def caption(ticket=None):
+    """Short Italian description of the wait and of any lowered resolution of ``ticket``
+    (by default the current one), or "" when there is nothing to say."""
+    ticket = ticket if ticket is not None else current()
+    if ticket is None:
+        return ""
+    parts = []
+    if ticket.waited >= 0.001:
+        parts.append(f"attesa in coda {ticket.waited * 1000:.0f} ms")
+    if ticket.scale < 1:
+        parts.append(f"risoluzione ridotta al {ticket.scale:.0%} del lato per il carico del server")
+    return ", ".join(parts)
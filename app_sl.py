@@ -2,32 +2,29 @@ import streamlit as st
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib.colors as colors
-import sympy as sp
-import io
+import admission
+import timing
+import tiles
+from shared import symbolic_to_callable
 
-def symbolic_to_callable(symbolic_str):
-    """Convert a symbolic function (string) into a Python callable function."""
-    x, y = sp.symbols('x y')  # Define the symbols
-    symbolic_expr = sp.sympify(symbolic_str)  # Convert the input string to a sympy expression
-    func = sp.lambdify((x, y), symbolic_expr, modules='numpy')  # Convert sympy expression to callable
-    return func
-
-def alg(f, x0=0, y0=0, d=1, e=0.01, cl=True, center=True, col='Greys'):
-    x = np.arange(x0 - d, x0 + d, 2 * d / 500)
-    y = np.arange(y0 - d, y0 + d, 2 * d / 500)
-    X, Y = np.meshgrid(x, y)
-    Z = f(X, Y)
+def alg(f, x0=0, y0=0, d=1, e=0.01, cl=True, center=True, col='Greys', n=500):
+    # Samples from the tile cache shared with the other pages
+    window = tiles.evaluate_window(f, x0, y0, d, n)
+    X, Y = np.meshgrid(window.x, window.y)
+    Z = window.Z
 
     fig, (ax1, ax2) = plt.subplots(nrows=2, figsize=(7, 7))
-    im2 = ax1.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=col)
-    im = ax1.pcolormesh(X, Y, Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base=10), cmap=col)
+    with timing.stage("pcolormesh"):
+        im2 = ax1.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=col)
+        im = ax1.pcolormesh(X, Y, Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base=10), cmap=col)
     fig.colorbar(im2, extend='both', ax=ax1, orientation='horizontal', shrink=0.8)
     ax1.tick_params(axis='x', labelbottom=False)
 
     levels = [f(x0, y0) + e * k for k in np.arange(-15, 15)]
-    CS1 = ax2.contour(X, Y, Z, [f(x0, y0) + 2 * e * k for k in np.arange(-1, 15)], linewidths=1.5, cmap='Reds')
-    ax2.contour(X,Y,Z, [0], lw=1.5, colors='black')
-    CS2 = ax2.contour(X, Y, Z, [f(x0, y0) + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
+    with timing.stage("contour"):
+        CS1 = ax2.contour(X, Y, Z, [f(x0, y0) + 2 * e * k for k in np.arange(-1, 15)], linewidths=1.5, cmap='Reds')
+        ax2.contour(X,Y,Z, [0], lw=1.5, colors='black')
+        CS2 = ax2.contour(X, Y, Z, [f(x0, y0) + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
 
     ax2.clabel(CS1)
     ax2.clabel(CS2)
@@ -57,12 +54,19 @@ colormap = st.selectbox("Choose a colormap:", ['Greys', 'autumn', 'coolwarm', 'v
 
 # When the user clicks the button, generate the plot
 if st.button("Generate Plot"):
+    timer = timing.start_render("app_sl")
     try:
+        admission.admit(timer.app)
         # Convert the input function to a callable function
         f = symbolic_to_callable(func_str)
 
         # Generate and display the contour plot
-        fig = alg(f, x0, y0, d, e, center=center, col=colormap)
-        st.pyplot(fig)
+        fig = alg(f, x0, y0, d, e, center=center, col=colormap, n=admission.scaled(500))
+        with timing.stage("st.pyplot"):
+            st.pyplot(fig)
     except Exception as ex:
         st.error(f"Error in function input: {ex.__class__.__name__} - {ex}")
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+        timing.debug_panel(timer)
@@ -0,0 +1,114 @@
+import gc
+import re
+import tempfile
+import zipfile
+from typing import NamedTuple
+
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import QuadMesh
+
+import grammar
+import timing
+
+FORMATS = {"pdf": "application/pdf", "zip": "application/zip"}
+PNG_DPI = 200
+# Atlases larger than this are refused before rendering starts
+MAX_PLATES = 200
+
+
+class Plate(NamedTuple):
+    func_str: str
+    x0: float
+    y0: float
+    d: float
+    kind: str
+
+    @property
+    def name(self):
+        """File-name friendly description of the plate."""
+        slug = re.sub(r"[^0-9A-Za-z.+-]+", "_", self.func_str).strip("_")[:40]
+        return f"{self.kind}_{slug}_{self.x0:g}_{self.y0:g}_{self.d:g}"
+
+
+def parse_windows(text):
+    """Parse one window per line as "x0, y0, ℓ"."""
+    windows = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            x0, y0, d = (grammar.number(v) for v in line.split(","))
+        except ValueError:
+            raise ValueError(f"Riga {number}: scrivi la finestra come x0, y0, ℓ")
+        if d <= 0:
+            raise ValueError(f"Riga {number}: il lato deve essere positivo")
+        windows.append((x0, y0, d))
+    return windows
+
+
+def plates(func_strs, windows, kinds):
+    """All the plates of an atlas: every function on every window, in every kind."""
+    result = [Plate(s, x0, y0, d, kind) for s in func_strs for x0, y0, d in windows for kind in kinds]
+    if len(result) > MAX_PLATES:
+        raise ValueError(f"L'atlante avrebbe {len(result)} tavole (al massimo {MAX_PLATES})")
+    return result
+
+
+def _close(fig):
+    plt.close(fig)
+    # Figures are full of reference cycles: free their arrays now, not at the next full collection
+    gc.collect()
+
+
+def write_pdf(pages, fh):
+    """Write the (name, figure) pairs from ``pages`` as vector pages of one PDF.
+
+    Each page is written to ``fh`` and its figure closed as soon as it is
+    drawn, so only one plate is in memory at a time however long the
+    generator is.
+    """
+    count = 0
+    with PdfPages(fh) as pdf:
+        for name, fig in pages:
+            count += 1
+            try:
+                fig.suptitle(name, fontsize=8)
+                # Curves, axes and text stay vector; a color mesh has one path
+                # per cell, so it is embedded as an image at PNG_DPI instead
+                for ax in fig.axes:
+                    for artist in ax.collections:
+                        if isinstance(artist, QuadMesh):
+                            artist.set_rasterized(True)
+                with timing.stage("savefig"):
+                    pdf.savefig(fig, dpi=PNG_DPI)
+            finally:
+                _close(fig)
+    return count
+
+
+def write_zip(pages, fh):
+    """Write the (name, figure) pairs from ``pages`` as PNG entries of one ZIP."""
+    count = 0
+    # PNGs are already deflated: store them as they are
+    with zipfile.ZipFile(fh, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, fig in pages:
+            count += 1
+            try:
+                with zf.open(f"{count:03d}_{name}.png", "w") as entry, timing.stage("savefig"):
+                    fig.savefig(entry, format="png", dpi=PNG_DPI, bbox_inches="tight")
+            finally:
+                _close(fig)
+    return count
+
+
+def export(pages, fmt="pdf"):
+    """Build the file of ``pages`` in format ``fmt`` and return its bytes.
+
+    The plates are drawn one at a time into a temporary file; the finished
+    file is returned whole, as Streamlit keeps downloads in memory anyway.
+    """
+    with tempfile.TemporaryFile() as fh:
+        (write_pdf if fmt == "pdf" else write_zip)(pages, fh)
+        fh.seek(0)
+        return fh.read()
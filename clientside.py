@@ -0,0 +1,147 @@
+import base64
+import os
+import zlib
+
+import matplotlib
+import numpy as np
+
+NAN_CODE = 65535
+# Largest uint16 step, as a fraction of the spacing of the levels drawn on
+# the grid; a grid whose range needs a coarser step is sent as float32
+LEVEL_RESOLUTION = 0.02
+
+# The page drawing the specs, served as a Streamlit component (see show)
+FRONTEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frontend")
+
+# Same scaling as create_base_plot
+SYMLOG = {"linthresh": 0.5, "linscale": 1.0, "base": 10.0}
+
+
+def symlog(Z):
+    """matplotlib's SymLogNorm transform with the SYMLOG parameters (symlog in the page)."""
+    linthresh, linscale, base = SYMLOG["linthresh"], SYMLOG["linscale"], SYMLOG["base"]
+    c = linscale / (1 - 1 / base)
+    a = np.abs(Z)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log = np.sign(Z) * linthresh * (c + np.log(a / linthresh) / np.log(base))
+    return np.where(a <= linthresh, Z * c, log)
+
+
+def encode_grid(Z, resolution=None, transform=None):
+    """Quantize Z to uint16 with scale and offset, deflate it and base64 it.
+
+    Non-finite values are mapped to NAN_CODE and come back as gaps. With
+    ``transform="symlog"`` the quantized values are symlog(Z): the colors
+    and the levels of a heatmap keep their precision near 0 whatever the
+    range. When the step would be larger than ``resolution`` the grid is
+    sent as float32 instead.
+    """
+    Z = np.asarray(Z, dtype=float)
+    if transform == "symlog":
+        Z = symlog(Z)
+    finite = np.isfinite(Z)
+    if finite.any():
+        offset = float(Z[finite].min())
+        span = float(Z[finite].max()) - offset
+    else:
+        offset, span = 0.0, 0.0
+    scale = span / (NAN_CODE - 1) if span > 0 else 1.0
+    if resolution is not None and scale > resolution:
+        q = np.where(finite, Z, np.nan).astype('<f4')
+        dtype = "float32"
+    else:
+        q = np.full(Z.shape, NAN_CODE, dtype='<u2')
+        q[finite] = np.rint((Z[finite] - offset) / scale).astype('<u2')
+        dtype = "uint16"
+    return {
+        "data": base64.b64encode(zlib.compress(q.tobytes(), 6)).decode("ascii"),
+        "dtype": dtype,
+        "shape": list(Z.shape),
+        "scale": scale,
+        "offset": offset,
+        "nan": NAN_CODE,
+        "transform": transform,
+    }
+
+
+def plotly_colorscale(name, n=11):
+    """Sample a matplotlib colormap into a plotly colorscale."""
+    cmap = matplotlib.colormaps[name]
+    return [[float(t), "rgb({:.0f},{:.0f},{:.0f})".format(*(255 * np.array(cmap(t)[:3])))]
+            for t in np.linspace(0, 1, n)]
+
+
+def _axes(x, y):
+    return {"x0": float(x[0]), "dx": float(x[1] - x[0]), "y0": float(y[0]), "dy": float(y[1] - y[0])}
+
+
+def heatmap_spec(x, y, Z, colormap, Z2=None, level=None, center=None, points=()):
+    """Spec of the browser-rendered equivalent of generate_heatmap (symlog colors, g = 0, level).
+
+    ``points`` are constrained critical points (lagrange.Extremum) to mark.
+    """
+    spec = {
+        "kind": "heatmap",
+        "axes": _axes(x, y),
+        # Colors, g = 0 and the level are all drawn on symlog(f) and symlog(g)
+        "grid": encode_grid(Z, transform="symlog"),
+        "constraint": encode_grid(Z2, transform="symlog") if Z2 is not None else None,
+        "colorscale": plotly_colorscale(colormap),
+        "symlog": SYMLOG,
+        "level": level,
+        "levelColor": "cyan",
+        "center": center,
+        "points": [{"x": p.x, "y": p.y, "value": p.value, "kind": p.kind} for p in points],
+    }
+    return spec
+
+
+def contour_spec(x, y, Z, f0, passo, level=None, center=None):
+    """Spec of the browser-rendered equivalent of generate_contour (levels f0 ± 2·passo·k)."""
+    spec = {
+        "kind": "contour",
+        "axes": _axes(x, y),
+        "grid": encode_grid(Z, resolution=LEVEL_RESOLUTION * 2 * float(passo)),
+        "f0": float(f0),
+        "step": 2 * float(passo),
+        "reds": plotly_colorscale("Reds"),
+        "blues": plotly_colorscale("Blues_r"),
+        "level": level,
+        "levelColor": "lime",
+        "center": center,
+    }
+    return spec
+
+
+def sweep_spec(x, y, frames, parameter, center=None):
+    """Spec of the level curves of a parameter sweep, one frame per value, with a slider and play button.
+
+    ``frames`` come from sweep.payload: the browser only switches between them.
+    """
+    spec = {
+        "kind": "sweep",
+        "bounds": [float(x[0]), float(x[-1]), float(y[0]), float(y[-1])],
+        "frames": frames,
+        "parameter": parameter,
+        "center": center,
+    }
+    return spec
+
+
+def _components():
+    import plotly
+    import streamlit.components.v1 as components
+
+    # plotly.js is served as a file of its own, so the browser loads it once
+    # and keeps it across renders and pages
+    components.declare_component("plotly_js", path=os.path.join(os.path.dirname(plotly.__file__), "package_data"))
+    return components.declare_component("clientside", path=FRONTEND)
+
+
+def show(spec, height=700, key=None):
+    """Draw a spec built by heatmap_spec, contour_spec or sweep_spec in the Streamlit app.
+
+    Only the spec (the compressed grid and the style) goes to the browser
+    with each render; the page and plotly.js are static files.
+    """
+    return _components()(spec=spec, height=height, key=key, default=None)
@@ -0,0 +1,174 @@
+import csv
+import io
+import json
+import math
+from typing import NamedTuple
+
+import contourpy
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_hex
+from matplotlib.contour import ContourSet
+
+import timing
+
+FORMATS = {
+    "geojson": ("application/geo+json", "geojson"),
+    "csv": ("text/csv", "csv"),
+    "svg": ("image/svg+xml", "svg"),
+}
+
+
+class Level(NamedTuple):
+    curve: str  # "f" for level sets of f, "g" for the constraint g = 0
+    value: float
+    color: str
+    lines: list  # polylines as (n, 2) arrays of world coordinates
+
+
+def extract(x, y, Z, levels, curve="f", color="#000000"):
+    """Contour ``Z`` with contourpy, for grids that were not drawn with matplotlib."""
+    generator = contourpy.contour_generator(x, y, Z)
+    with timing.stage("contour"):
+        return [Level(curve, float(v), color, generator.lines(v)) for v in levels]
+
+
+def from_contour_set(cs, curve="f"):
+    """Levels already computed by a matplotlib contour call (no re-contouring)."""
+    colors = cs.get_edgecolor()
+    levels = []
+    for i, (value, segments) in enumerate(zip(cs.levels, cs.allsegs)):
+        color = to_hex(colors[i % len(colors)]) if len(colors) else "#000000"
+        levels.append(Level(curve, float(value), color, [s for s in segments if len(s) > 1]))
+    return levels
+
+
+def from_figure(fig):
+    """All the contour lines drawn on ``fig``; constraint curves carry the gid "g".
+
+    The constraint may also be a LineCollection drawn by implicit.draw.
+    """
+    levels = []
+    for ax in fig.axes:
+        for artist in ax.collections:
+            if isinstance(artist, ContourSet) and not artist.filled:
+                levels += from_contour_set(artist, artist.get_gid() or "f")
+            elif isinstance(artist, LineCollection) and artist.get_gid() == "g":
+                colors = artist.get_edgecolor()
+                levels.append(Level("g", 0.0, to_hex(colors[0]) if len(colors) else "#000000",
+                                    [s for s in artist.get_segments() if len(s) > 1]))
+    return levels
+
+
+def simplify(points, tolerance):
+    """Douglas–Peucker simplification of a polyline, ``tolerance`` in world units."""
+    points = np.asarray(points, dtype=float)
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        a, b = points[i], points[j]
+        inner = points[i + 1:j] - a
+        ab = b - a
+        length = math.hypot(*ab)
+        if length == 0:  # closed loop: distance from the end point
+            dist = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            dist = np.abs(ab[0] * inner[:, 1] - ab[1] * inner[:, 0]) / length
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            m = i + 1 + k
+            keep[m] = True
+            stack += [(i, m), (m, j)]
+    return points[keep]
+
+
+def simplified(levels, tolerance):
+    """Simplify every polyline of ``levels``, dropping those that collapse to a point."""
+    with timing.stage("simplify"):
+        result = []
+        for level in levels:
+            lines = [simplify(line, tolerance) for line in level.lines]
+            result.append(level._replace(lines=[line for line in lines if len(line) > 1]))
+        return result
+
+
+def _decimals(tolerance):
+    # Digits beyond a tenth of the tolerance carry no information
+    return max(0, math.ceil(-math.log10(tolerance)) + 1) if tolerance > 0 else 12
+
+
+def to_geojson(levels, tolerance):
+    """FeatureCollection with one MultiLineString per level."""
+    digits = _decimals(tolerance)
+    features = [{
+        "type": "Feature",
+        "properties": {"curve": level.curve, "level": level.value, "stroke": level.color},
+        "geometry": {"type": "MultiLineString",
+                     "coordinates": [np.round(line, digits).tolist() for line in level.lines]},
+    } for level in simplified(levels, tolerance) if level.lines]
+    return json.dumps({"type": "FeatureCollection", "features": features}, separators=(",", ":"))
+
+
+def to_csv(levels, tolerance):
+    """One row per vertex: curve, level, polyline index, x, y."""
+    digits = _decimals(tolerance)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(["curva", "livello", "linea", "x", "y"])
+    line_id = 0
+    for level in simplified(levels, tolerance):
+        for line in level.lines:
+            for px, py in np.round(line, digits):
+                writer.writerow([level.curve, f"{level.value:.10g}", line_id, px, py])
+            line_id += 1
+    return buf.getvalue()
+
+
+def to_svg(levels, tolerance, bounds, size=600):
+    """SVG paths in world coordinates; ``bounds`` is (xmin, xmax, ymin, ymax)."""
+    digits = _decimals(tolerance)
+    xmin, xmax, ymin, ymax = bounds
+    width, height = xmax - xmin, ymax - ymin
+    paths = []
+    for level in simplified(levels, tolerance):
+        d = " ".join("M" + " L".join(f"{px:.{digits}f} {py:.{digits}f}" for px, py in line)
+                     for line in level.lines)
+        if d:
+            paths.append(f'<path d="{d}" stroke="{level.color}" vector-effect="non-scaling-stroke" '
+                         f'data-curve="{level.curve}" data-level="{level.value:.10g}"/>')
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size * height / width:.0f}" '
+            f'viewBox="{xmin} {-ymax} {width} {height}">\n'
+            f'<g transform="scale(1,-1)" fill="none" stroke-width="1.5">\n'
+            + "\n".join(paths) + "\n</g>\n</svg>\n")
+
+
+def to_traces(levels, tolerance):
+    """One dict per level with flat x and y lists, polylines separated by None as plotly takes them.
+
+    The levels are expected to be simplified already (see simplified).
+    """
+    digits = _decimals(tolerance)
+    traces = []
+    for level in levels:
+        xs, ys = [], []
+        for line in level.lines:
+            line = np.round(line, digits)
+            xs += line[:, 0].tolist() + [None]
+            ys += line[:, 1].tolist() + [None]
+        traces.append({"curve": level.curve, "value": level.value, "color": level.color, "x": xs, "y": ys})
+    return traces
+
+
+def export(levels, fmt, tolerance, bounds, size=600):
+    """Serialize ``levels`` in format ``fmt`` ("geojson", "csv" or "svg")."""
+    if fmt == "geojson":
+        return to_geojson(levels, tolerance)
+    if fmt == "csv":
+        return to_csv(levels, tolerance)
+    return to_svg(levels, tolerance, bounds, size)
@@ -0,0 +1,243 @@
+"""Whitelisted parser for the expressions typed by the users.
+
+Only the syntax described in the apps' help is accepted:
+
+    expr   := term (("+" | "-") term)*
+    term   := factor (("*" | "/") factor)*
+    factor := ("+" | "-") factor | power
+    power  := atom (("**" | "^") factor)?
+    atom   := number | variable | constant | function "(" expr ")" | "(" expr ")"
+
+with the functions exp, sin, cos, tan, log, log10, sqrt, abs and the
+constants pi and E. Nothing is ever passed to eval, so parsing can run in
+the server process; the tree is turned either into a SymPy expression or
+directly into a NumPy callable, without going through lambdify. SymPy
+evaluates numbers and powers while building its expression, which for some
+inputs takes very long: to_sympy is meant to run in the sandbox.
+"""
+import math
+import operator
+import re
+from functools import lru_cache
+
+import numpy as np
+import sympy as sp
+
+MAX_LENGTH = 1000
+MAX_DEPTH = 50
+# Exact powers of numbers larger than this (in decimal digits) are refused
+MAX_DIGITS = 10000
+
+FUNCTIONS = {
+    "exp": (sp.exp, np.exp),
+    "sin": (sp.sin, np.sin),
+    "cos": (sp.cos, np.cos),
+    "tan": (sp.tan, np.tan),
+    "log": (sp.log, np.log),
+    "log10": (lambda a: sp.log(a, 10), np.log10),
+    "sqrt": (sp.sqrt, np.sqrt),
+    "abs": (sp.Abs, np.abs),
+}
+CONSTANTS = {"pi": (sp.pi, np.pi), "E": (sp.E, np.e)}
+OPERATORS = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv}
+
+_TOKEN = re.compile(r"\s*(?:(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)"
+                    r"|(?P<name>[A-Za-z_][A-Za-z_0-9]*)|(?P<op>\*\*|[-+*/^(),]))")
+_LITERAL = re.compile(r"\s*[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?\s*\Z")
+
+
+def _tokenize(text):
+    tokens, pos, end = [], 0, len(text.rstrip())
+    while pos < end:
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise ValueError(f"Carattere non ammesso: {text[pos:].lstrip()[0]!r}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    # Trees are tuples: ("num", text), ("var", index), ("const", name),
+    # ("call", name, arg), ("neg", arg), ("pow", base, exponent) and the n-ary
+    # ("sum", ((op, term), ...)) and ("product", ((op, factor), ...)), so long
+    # sums and products do not make the tree deep
+    def __init__(self, text, names):
+        self.tokens = _tokenize(text)
+        self.names = names
+        self.pos = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        if self.pos == len(self.tokens):
+            raise ValueError("Espressione incompleta")
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def expect(self, value):
+        if self.peek() != value:
+            raise ValueError(f"Atteso {value!r}" + (f" invece di {self.peek()!r}" if self.peek() else ""))
+        self.pos += 1
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Espressione vuota")
+        tree = self.expr()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"Simbolo inatteso: {self.peek()!r}")
+        return tree
+
+    def expr(self):
+        terms = [("+", self.term())]
+        while self.peek() in ("+", "-"):
+            terms.append((self.take()[1], self.term()))
+        return terms[0][1] if len(terms) == 1 else ("sum", tuple(terms))
+
+    def term(self):
+        factors = [("*", self.factor())]
+        while self.peek() in ("*", "/"):
+            factors.append((self.take()[1], self.factor()))
+        return factors[0][1] if len(factors) == 1 else ("product", tuple(factors))
+
+    def factor(self):
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise ValueError("Espressione troppo annidata")
+        if self.peek() in ("+", "-"):
+            sign = self.take()[1]
+            tree = self.factor()
+            tree = ("neg", tree) if sign == "-" else tree
+        else:
+            tree = self.atom()
+            if self.peek() in ("**", "^"):
+                self.pos += 1
+                tree = ("pow", tree, self.factor())
+        self.depth -= 1
+        return tree
+
+    def atom(self):
+        kind, value = self.take()
+        if kind == "num":
+            if not math.isfinite(float(value)):
+                raise ValueError(f"Valore non finito: {value}")
+            return ("num", value)
+        if kind == "name":
+            if self.peek() == "(":
+                if value not in FUNCTIONS:
+                    raise ValueError(f"Funzione non ammessa: {value}")
+                self.pos += 1
+                arg = self.expr()
+                self.expect(")")
+                return ("call", value, arg)
+            if value in FUNCTIONS:
+                raise ValueError(f"Manca l'argomento di {value}")
+            if value in CONSTANTS:
+                return ("const", value)
+            if value in self.names:
+                return ("var", self.names.index(value))
+            if self.names:
+                raise ValueError(f"La funzione deve contenere solo le variabili {', '.join(self.names)}")
+            raise ValueError(f"Valore non numerico: {value}")
+        if value == "(":
+            tree = self.expr()
+            self.expect(")")
+            return tree
+        raise ValueError(f"Simbolo inatteso: {value!r}")
+
+
+@lru_cache(maxsize=1024)
+def parse(text, names=('x', 'y')):
+    """Syntax tree of ``text``; raises ValueError outside the grammar."""
+    if len(text) > MAX_LENGTH:
+        raise ValueError(f"Espressione troppo lunga (massimo {MAX_LENGTH} caratteri)")
+    return _Parser(text, tuple(names)).parse()
+
+
+def _power(base, exponent):
+    if base.is_Rational and exponent.is_Rational:
+        bits = max(base.p.bit_length(), base.q.bit_length())
+        if abs(float(exponent)) * bits * math.log10(2) > MAX_DIGITS:
+            raise ValueError("Potenza troppo grande")
+    return base ** exponent
+
+
+def to_sympy(tree, names=('x', 'y')):
+    """SymPy expression of a tree from ``parse``.
+
+    SymPy evaluates the tree as it builds it (e.g. exact roots of large
+    integers), so call this in the sandbox, as sandbox.compile_expression does.
+    """
+    kind = tree[0]
+    if kind == "num":
+        text = tree[1]
+        return sp.Integer(text) if text.isdigit() else sp.Float(text)
+    if kind == "var":
+        return sp.Symbol(names[tree[1]])
+    if kind == "const":
+        return CONSTANTS[tree[1]][0]
+    if kind == "call":
+        return FUNCTIONS[tree[1]][0](to_sympy(tree[2], names))
+    if kind == "neg":
+        return -to_sympy(tree[1], names)
+    if kind == "pow":
+        return _power(to_sympy(tree[1], names), to_sympy(tree[2], names))
+    ops = iter(tree[1])
+    _, first = next(ops)
+    value = to_sympy(first, names)
+    for op, operand in ops:
+        value = OPERATORS[op](value, to_sympy(operand, names))
+    return value
+
+
+def _numpy(tree):
+    # Every node becomes a function of the tuple of arguments
+    kind = tree[0]
+    if kind in ("num", "const"):
+        value = np.float64(tree[1]) if kind == "num" else np.float64(CONSTANTS[tree[1]][1])
+        return lambda args: value
+    if kind == "var":
+        index = tree[1]
+        return lambda args: args[index]
+    if kind == "call":
+        func, arg = FUNCTIONS[tree[1]][1], _numpy(tree[2])
+        return lambda args: func(arg(args))
+    if kind == "neg":
+        arg = _numpy(tree[1])
+        return lambda args: -arg(args)
+    if kind == "pow":
+        base, exponent = _numpy(tree[1]), _numpy(tree[2])
+        return lambda args: base(args) ** exponent(args)
+    (_, first), *rest = tree[1]
+    first = _numpy(first)
+    rest = [(OPERATORS[op], _numpy(operand)) for op, operand in rest]
+
+    def combine(args):
+        value = first(args)
+        for op, operand in rest:
+            value = op(value, operand(args))
+        return value
+    return combine
+
+
+def to_numpy(tree):
+    """NumPy function of a tree from ``parse``, taking the variables positionally."""
+    node = _numpy(tree)
+
+    def func(*args):
+        return node(args)
+    return func
+
+
+def number(text):
+    """Value of a numeric input such as "0.5", "-1e-3", "pi/4" or "sqrt(2)/2"."""
+    if _LITERAL.match(text):
+        value = float(text)
+    else:
+        with np.errstate(all='ignore'):
+            value = float(to_numpy(parse(text.strip(), ()))())
+    if not math.isfinite(value):
+        raise ValueError(f"Valore non finito: {text.strip()}")
+    return value
@@ -0,0 +1,115 @@
+from functools import lru_cache
+
+import contourpy
+import numpy as np
+import sympy as sp
+from matplotlib.collections import LineCollection
+
+import sandbox
+import shared
+import timing
+
+# Coarse cells per side, fine subdivisions per coarse cell and Newton steps
+COARSE = 64
+REFINE = 4
+NEWTON_STEPS = 3
+# Rings of coarse cells refined around each sign change, for the branches
+# that enter and leave a cell through the same side
+DILATE = 1
+
+
+def _gradient(g_expr):
+    x, y = sp.symbols('x y')
+    return [g_expr, sp.diff(g_expr, x), sp.diff(g_expr, y)]
+
+
+@lru_cache(maxsize=shared.EXPRESSION_CACHE_SIZE)
+def _compile_gradient(g_expr):
+    with timing.stage("diff"):
+        exprs = sandbox.run(_gradient, g_expr)
+    with timing.stage("lambdify"):
+        return sandbox.CompiledBatch(exprs)
+
+
+def compile_gradient(g):
+    """Differentiate g in the sandbox and compile g, gx, gy into one batched evaluator,
+    cached per expression."""
+    return _compile_gradient(g.expr)
+
+
+def _narrow_band(G, dilate):
+    # Coarse cells whose corners do not all have the same strict sign
+    corners = np.stack([G[:-1, :-1], G[:-1, 1:], G[1:, :-1], G[1:, 1:]])
+    with np.errstate(invalid='ignore'):
+        cells = (np.fmin.reduce(corners) <= 0) & (np.fmax.reduce(corners) >= 0)
+    for _ in range(dilate):
+        grown = np.pad(cells, 1)
+        cells = cells | grown[:-2, 1:-1] | grown[2:, 1:-1] | grown[1:-1, :-2] | grown[1:-1, 2:]
+    return cells
+
+
+def _project(system, points, steps, max_step):
+    """Newton steps p ← p − g(p)·∇g/|∇g|² towards g = 0.
+
+    A point whose step is not finite or longer than ``max_step`` stays where
+    it is, so that no vertex jumps to another branch of the curve.
+    """
+    px, py = points[:, 0].copy(), points[:, 1].copy()
+    with np.errstate(all='ignore'):
+        for _ in range(steps):
+            G, Gx, Gy = system(px, py)
+            t = G / (Gx * Gx + Gy * Gy)
+            dx, dy = t * Gx, t * Gy
+            ok = np.isfinite(dx) & np.isfinite(dy) & (np.hypot(dx, dy) <= max_step)
+            px[ok] -= dx[ok]
+            py[ok] -= dy[ok]
+    return np.column_stack([px, py])
+
+
+def _trace(g, system, x0, y0, d, coarse, refine, steps, dilate):
+    n = coarse * refine + 1
+    x = np.linspace(x0 - d, x0 + d, n)
+    y = np.linspace(y0 - d, y0 + d, n)
+
+    # Coarse sampling, then the nodes of the cells where g changes sign
+    G = np.broadcast_to(np.asarray(g(x[::refine][None, :], y[::refine][:, None]), dtype=float),
+                        (coarse + 1, coarse + 1))
+    quads = np.kron(_narrow_band(G, dilate), np.ones((refine, refine), dtype=bool))
+    needed = np.zeros((n, n), dtype=bool)
+    for di in (0, 1):
+        for dj in (0, 1):
+            needed[di:di + n - 1, dj:dj + n - 1] |= quads
+    rows, cols = np.nonzero(needed)
+    Z = np.full((n, n), np.nan)
+    Z[rows, cols] = np.broadcast_to(np.asarray(g(x[cols], y[rows]), dtype=float), rows.shape)
+
+    # Quads with a masked corner are skipped: contourpy follows the curve
+    # through the narrow band only, already joined across cells
+    lines = contourpy.contour_generator(x, y, np.ma.masked_invalid(Z)).lines(0.0)
+    lines = [line for line in lines if len(line) > 1]
+    if not lines:
+        return [], G.size + len(rows)
+    points = _project(system, np.concatenate(lines), steps, max_step=x[1] - x[0])
+    evaluations = G.size + len(rows) + steps * len(points)
+    return np.split(points, np.cumsum([len(line) for line in lines])[:-1]), evaluations
+
+
+def trace(g, system, x0, y0, d, coarse=COARSE, refine=REFINE, steps=NEWTON_STEPS, dilate=DILATE):
+    """Polylines of g = 0 in the square of center (x0, y0) and side 2d.
+
+    g is sampled on a coarse grid and evaluated at full resolution only in
+    the cells around its sign changes; the vertices found there are then
+    projected onto the curve with Newton steps using ``system`` (see
+    compile_gradient). Returns the polylines, as contourpy's lines, and the
+    number of evaluations of g used.
+    """
+    with timing.stage("g = 0"):
+        return sandbox.run(_trace, g, system, x0, y0, d, coarse, refine, steps, dilate)
+
+
+def draw(ax, lines, **style):
+    """Draw the traced curve; like the constraint contours, it carries the gid "g"."""
+    collection = LineCollection(lines, **style)
+    collection.set_gid("g")
+    ax.add_collection(collection)
+    return collection
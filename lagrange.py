@@ -0,0 +1,167 @@
+import time
+from functools import lru_cache
+from typing import NamedTuple
+
+import contourpy
+import numpy as np
+import sympy as sp
+
+import planner
+import sandbox
+import shared
+import timing
+
+# Seeds spread along g = 0, Newton iterations and tolerances
+SEEDS = 64
+MAX_ITER = 30
+TOLERANCE = 1e-10
+# Share of the latency target granted to the solver
+BUDGET_SHARE = 0.25
+
+KINDS = {1: "massimo locale", -1: "minimo locale", 0: "indeterminato"}
+
+
+class Extremum(NamedTuple):
+    x: float
+    y: float
+    lam: float
+    value: float
+    kind: str
+
+
+def _derivatives(f_expr, g_expr):
+    x, y = sp.symbols('x y')
+    fx, fy = sp.diff(f_expr, x), sp.diff(f_expr, y)
+    gx, gy = sp.diff(g_expr, x), sp.diff(g_expr, y)
+    return [f_expr, fx, fy, g_expr, gx, gy,
+            sp.diff(fx, x), sp.diff(fx, y), sp.diff(fy, y),
+            sp.diff(gx, x), sp.diff(gx, y), sp.diff(gy, y)]
+
+
+@lru_cache(maxsize=shared.EXPRESSION_CACHE_SIZE)
+def _compile_system(f_expr, g_expr):
+    with timing.stage("diff"):
+        exprs = sandbox.run(_derivatives, f_expr, g_expr)
+    with timing.stage("lambdify"):
+        return sandbox.CompiledBatch(exprs)
+
+
+def compile_system(f, g):
+    """Differentiate f and g in the sandbox and compile f, ∇f, g, ∇g and both
+    Hessians into a single batched evaluator, cached per pair of expressions."""
+    return _compile_system(f.expr, g.expr)
+
+
+def constraint_segments(x, y, Z2):
+    """Polylines of g = 0 from a grid, for when no matplotlib contour was drawn."""
+    with timing.stage("contour"):
+        return contourpy.contour_generator(x, y, Z2).lines(0)
+
+
+def seeds(segments, n=SEEDS):
+    """About ``n`` points evenly spaced by arc length along the polylines of g = 0."""
+    segments = [np.asarray(s, dtype=float) for s in segments if len(s) > 1]
+    if not segments:
+        return np.empty((0, 2))
+    lengths = [np.hypot(*np.diff(s, axis=0).T) for s in segments]
+    total = sum(l.sum() for l in lengths)
+    points = []
+    for s, l in zip(segments, lengths):
+        arc = np.concatenate(([0.0], np.cumsum(l)))
+        k = max(1, round(n * arc[-1] / total)) if total > 0 else 1
+        t = (np.arange(k) + 0.5) * arc[-1] / k
+        points.append(np.column_stack([np.interp(t, arc, s[:, 0]), np.interp(t, arc, s[:, 1])]))
+    return np.concatenate(points)
+
+
+def _newton(system, points, max_seconds):
+    """Batched Newton iteration on ∇f = λ∇g, g = 0 from all the seeds at once."""
+    deadline = time.perf_counter() + max_seconds
+    x, y = points[:, 0].copy(), points[:, 1].copy()
+    with np.errstate(all='ignore'):
+        _, fx, fy, _, gx, gy, *_ = system(x, y)
+        lam = (fx * gx + fy * gy) / (gx**2 + gy**2)
+        for _ in range(MAX_ITER):
+            _, fx, fy, g, gx, gy, fxx, fxy, fyy, gxx, gxy, gyy = system(x, y)
+            F = np.stack([fx - lam * gx, fy - lam * gy, g], axis=-1)
+            J = np.empty((len(x), 3, 3))
+            J[:, 0] = np.stack([fxx - lam * gxx, fxy - lam * gxy, -gx], axis=-1)
+            J[:, 1] = np.stack([fxy - lam * gxy, fyy - lam * gyy, -gy], axis=-1)
+            J[:, 2] = np.stack([gx, gy, np.zeros_like(gx)], axis=-1)
+            ok = np.isfinite(J).all(axis=(1, 2)) & np.isfinite(F).all(axis=1) & (np.abs(np.linalg.det(J)) > 1e-14)
+            step = np.zeros_like(F)
+            if ok.any():
+                step[ok] = np.linalg.solve(J[ok], -F[ok][..., None])[..., 0]
+            step[~ok] = np.nan
+            x, y, lam = x + step[:, 0], y + step[:, 1], lam + step[:, 2]
+            if np.nanmax(np.abs(step), initial=0.0) < TOLERANCE or time.perf_counter() > deadline:
+                break
+
+        f, fx, fy, g, gx, gy, fxx, fxy, fyy, gxx, gxy, gyy = system(x, y)
+        residual = np.abs(np.stack([fx - lam * gx, fy - lam * gy, g])).max(axis=0)
+        # Bordered Hessian: positive determinant for a maximum, negative for a minimum
+        det = (-gx * (gx * (fyy - lam * gyy) - gy * (fxy - lam * gxy))
+               + gy * (gx * (fxy - lam * gxy) - gy * (fxx - lam * gxx)))
+    return np.column_stack([x, y, lam, f, residual, det])
+
+
+def _deduplicate(rows, scale):
+    found = []
+    for row in rows[np.argsort(rows[:, 4])]:
+        if all(np.hypot(row[0] - other[0], row[1] - other[1]) > 1e-6 * scale for other in found):
+            found.append(row)
+    return found
+
+
+def constrained_extrema(system, segments, x0, y0, d, target_ms=None):
+    """Critical points of f on g = 0 inside Q, found from seeds along ``segments``.
+
+    The solver runs in the sandbox with a share of the latency target; if it
+    does not finish in time no points are returned.
+    """
+    if target_ms is None:
+        target_ms = planner.LATENCY_TARGET_MS
+    points = seeds(segments)
+    if not len(points):
+        return []
+    budget = BUDGET_SHARE * target_ms / 1000
+    with timing.stage("lagrange"):
+        try:
+            rows = sandbox.run(_newton, system, points, budget, timeout=budget + 1)
+        except sandbox.SandboxCancelled:
+            raise
+        except sandbox.SandboxError:
+            return []
+
+    scale = max(d, 1.0)
+    inside = (np.all(np.isfinite(rows[:, :4]), axis=1) & (rows[:, 4] < 1e-8 * scale)
+              & (np.abs(rows[:, 0] - x0) <= d) & (np.abs(rows[:, 1] - y0) <= d))
+    extrema = []
+    for x, y, lam, value, _, det in _deduplicate(rows[inside], scale):
+        sign = 0 if abs(det) < 1e-12 else int(np.sign(det))
+        extrema.append(Extremum(float(x), float(y), float(lam), float(value), KINDS[sign]))
+    return extrema
+
+
+MARKERS = {
+    "massimo locale": dict(marker='^', color='red'),
+    "minimo locale": dict(marker='v', color='blue'),
+    "indeterminato": dict(marker='o', color='gray'),
+}
+
+
+def mark_extrema(ax, extrema):
+    """Mark the constrained critical points on a matplotlib axis."""
+    for kind, style in MARKERS.items():
+        points = [p for p in extrema if p.kind == kind]
+        if points:
+            ax.scatter([p.x for p in points], [p.y for p in points], s=70, edgecolors='white',
+                       zorder=5, label=kind, **style)
+    if extrema:
+        ax.legend(loc='upper right', fontsize=8)
+
+
+def table(extrema):
+    """Rows for st.table describing the constrained critical points."""
+    return [{"x": f"{p.x:.6g}", "y": f"{p.y:.6g}", "f(x, y)": f"{p.value:.6g}", "λ": f"{p.lam:.6g}",
+             "tipo": p.kind} for p in extrema]
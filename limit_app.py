@@ -3,167 +3,170 @@ import numpy as np
 import matplotlib.pyplot as plt
 import random
 import sympy as sp
+import timing
+import shared
+
+# Built-in functions to choose from, as expressions so they can be evaluated together
+x_sym = sp.Symbol('x')
+builtin_exprs = {
+    "Polinomio: x^2 - 3x + 2": x_sym**2 - 3*x_sym + 2,
+    "Seno: sin(x)": sp.sin(x_sym),
+    "Coseno: cos(x)": sp.cos(x_sym),
+    "Esponenziale: exp(x)": sp.exp(x_sym),
+    # Undefined (nan) for x <= 0
+    "Logaritmo: log(x+1)": sp.Piecewise((sp.log(x_sym + 1), x_sym > 0), (sp.nan, True)),
+    "Tangente: tan(x)": sp.tan(x_sym),
+    "Salto": sp.Heaviside(x_sym, 0),
+}
 
+# Dictionary mapping function names to their implementations
+functions = {name: shared.compiled_expression(expr, names=('x',)) for name, expr in builtin_exprs.items()}
 
-def symbolic_to_callable(symbolic_str):
-    """Convert a symbolic function (string) into a Python callable function."""
-    x = sp.symbols('x')  # Define the symbols
-    symbolic_expr = sp.sympify(symbolic_str)  # Convert the input string to a sympy expression
-    func = sp.lambdify((x), symbolic_expr, modules='numpy')  # Convert sympy expression to callable
-    return func
-
-# Define a set of possible functions to choose from
-def f_poly(x):
-    return x**2 - 3*x + 2
-
-def f_sin(x):
-    return np.sin(x)
-
-def f_cos(x):
-    return np.cos(x)
-
-def f_exp(x):
-    return np.exp(x)
-
-def f_log(x):
-    # Use np.where to avoid log of negative numbers
-    return np.where(x > 0, np.log(x+1), np.nan)
-
-def f_tan(x):
-    return np.tan(x)
-
-def f_H(x):
-    return np.heaviside(x, 0)
+# All the built-ins in a single evaluator returning a (7, n) stack
+builtins = shared.compiled_batch(tuple(builtin_exprs.values()), names=('x',))
 
+st.title("Visualizzazione grafica limiti e continuità")
+timer = timing.start_render("limit_app")
+try:
+    insert_f = st.selectbox("Scegli la funzione", ['casualmente', 'inserendola'])
 
-# Dictionary mapping function names to their implementations
-functions = {
-    "Polinomio: x^2 - 3x + 2": f_poly,
-    "Seno: sin(x)": f_sin,
-    "Coseno: cos(x)": f_cos,
-    "Esponenziale: exp(x)": f_exp,
-    "Logaritmo: log(x+1)": f_log,
-    "Tangente: tan(x)": f_tan,
-    "Salto": f_H
-}
 
-st.title("Visualizzazione grafica limiti e continuità")
+    if insert_f == "casualmente":
+        # Add a button for restarting the function
+        if 'selected_function_name' not in st.session_state:
+            st.session_state.selected_function_name, st.session_state.selected_function = random.choice(list(functions.items()))
 
-insert_f = st.selectbox("Scegli la funzione", ['casualmente', 'inserendola'])
+        # When the "Restart Function" button is clicked, a new random function is selected
+        if st.button("Restart"):
+            st.session_state.selected_function_name, st.session_state.selected_function = random.choice(list(functions.items()))
 
+        # Get the currently selected function and its name
+        selected_function_name = st.session_state.selected_function_name
+        selected_function = st.session_state.selected_function
 
-if insert_f == "casualmente":
-    # Add a button for restarting the function
-    if 'selected_function_name' not in st.session_state:
-        st.session_state.selected_function_name, st.session_state.selected_function = random.choice(list(functions.items()))
+        # Randomly select a function
+        #selected_function_name, selected_function = random.choice(list(functions.items()))
 
-    # When the "Restart Function" button is clicked, a new random function is selected
-    if st.button("Restart"):
-        st.session_state.selected_function_name, st.session_state.selected_function = random.choice(list(functions.items()))
+        # Create the Streamlit app
+        # Display the randomly selected function name
+        st.write(f"Funzione selezionata: {selected_function_name}")
 
-    # Get the currently selected function and its name
-    selected_function_name = st.session_state.selected_function_name
-    selected_function = st.session_state.selected_function
+        compare_builtins = st.checkbox("Confronta tutte le funzioni predefinite", value=False)
 
-    # Randomly select a function
-    #selected_function_name, selected_function = random.choice(list(functions.items()))
+    else:
+        string_f = st.text_input(
+            r"Inserisci $f(x)$ (e.g., scrivi x**2 -1 per la curva $f(x)=x^2-1$", 
+            #r"Inserisci una funzione $g$ tale che è visualizzato il vincolo $g(x,y)^{-1}(\{0\})$  (e.g., scrivi x**2 + y ** 2-1 per la curva $x^2+y^2=1$)", 
+            value="x**2-1"
+        )
+        selected_function = shared.symbolic_to_callable(string_f, names=('x',))
+        selected_function_name = string_f
+        # Define the function for plotting and computation
+        #def f(x):
+        #   return np.sin(x)  # Example function, you can replace it with any function.
 
-    # Create the Streamlit app
-    # Display the randomly selected function name
-    st.write(f"Funzione selezionata: {selected_function_name}")
+        # Create the Streamlit app
+        #st.title("Understanding Limit and Continuity Graphically")
 
-else:
-    string_f = st.text_input(
-        r"Inserisci $f(x)$ (e.g., scrivi x**2 -1 per la curva $f(x)=x^2-1$", 
-        #r"Inserisci una funzione $g$ tale che è visualizzato il vincolo $g(x,y)^{-1}(\{0\})$  (e.g., scrivi x**2 + y ** 2-1 per la curva $x^2+y^2=1$)", 
-        value="x**2-1"
-    )
-    selected_function = symbolic_to_callable(string_f)
-    selected_function_name = string_f
-    # Define the function for plotting and computation
-    #def f(x):
-    #   return np.sin(x)  # Example function, you can replace it with any function.
+    # Input section: user selects x0, epsilon, r
+    x0 = st.number_input(r"Inserisci $x_0$:", value=0.0)
+    epsilon = st.number_input(r"Scegli epsilon $(\varepsilon > 0)$:", min_value=0.01, value=0.5, step=0.01)
+    r = st.number_input(r"Segli $r$ $(r > 0)$:", min_value=0.01, value=1.0, step=0.01)
 
-    # Create the Streamlit app
-    #st.title("Understanding Limit and Continuity Graphically")
+    f0=selected_function(x0)
 
-# Input section: user selects x0, epsilon, r
-x0 = st.number_input(r"Inserisci $x_0$:", value=0.0)
-epsilon = st.number_input(r"Scegli epsilon $(\varepsilon > 0)$:", min_value=0.01, value=0.5, step=0.01)
-r = st.number_input(r"Segli $r$ $(r > 0)$:", min_value=0.01, value=1.0, step=0.01)
+    # Plot function over a wide range
+    with timing.stage("f(x)"):
+        if selected_function_name == "Logaritmo: log(x+1)":
 
-f0=selected_function(x0)
+            x1 = np.linspace(x0 - 0.8, x0 + 3.2, 500)  # Wide range for plotting
+            y1 = selected_function(x1)
 
-# Plot function over a wide range
-if selected_function_name == f_log:
+            x2 = np.linspace(x0 - 0.8*r, x0 + 3.2*r, 500)  # Wide range for plotting
+            y2 = selected_function(x2)
 
-    x1 = np.linspace(x0 - 0.8, x0 + 3.2, 500)  # Wide range for plotting
-    y1 = selected_function(x1)
+        elif selected_function_name == "Tangente: tan(x)":
+            x1 = np.linspace(x0 - np.pi/2, x0 + np.pi/2, 500)  # Wide range for plotting
+            y1 = selected_function(x1)
 
-    x2 = np.linspace(x0 - 0.8*r, x0 + 3.2*r, 500)  # Wide range for plotting
-    y2 = selected_function(x2)
-    
-elif selected_function_name == f_tan:
-    x1 = np.linspace(x0 - np.pi/2, x0 + np.pi/2, 500)  # Wide range for plotting
-    y1 = selected_function(x1)
+            x2 = np.linspace(x0 - r*np.pi/2, x0 + r*np.pi/2, 500)  # Wide range for plotting
+            y2 = selected_function(x2)
 
-    x2 = np.linspace(x0 - r*np.pi/2, x0 + r*np.pi/2, 500)  # Wide range for plotting
-    y2 = selected_function(x2)
+        else:
+            x1 = np.linspace(x0 - 2, x0 + 2, 500)  # Wide range for plotting
+            y1 = selected_function(x1)
 
-else:
-    x1 = np.linspace(x0 - 2, x0 + 2, 500)  # Wide range for plotting
-    y1 = selected_function(x1)
+            x2 = np.linspace(x0 - 2 * r, x0 + 2 * r, 500)  # Wide range for plotting
+            y2 = selected_function(x2)
 
-    x2 = np.linspace(x0 - 2 * r, x0 + 2 * r, 500)  # Wide range for plotting
-    y2 = selected_function(x2)
 
 
+    # Plot the interval (x0 - r, x0 + r)
+    x_zoom = np.linspace(x0 - r, x0 + r, 100)
+    y_zoom = selected_function(x_zoom)
 
-# Plot the interval (x0 - r, x0 + r)
-x_zoom = np.linspace(x0 - r, x0 + r, 100)
-y_zoom = selected_function(x_zoom)
+    # Calculate f(x0) and define the epsilon neighborhood
+    f0 = selected_function(x0)
+    f_low, f_high = f0 - epsilon, f0 + epsilon
 
-# Calculate f(x0) and define the epsilon neighborhood
-f0 = selected_function(x0)
-f_low, f_high = f0 - epsilon, f0 + epsilon
+    # Plotting with Matplotlib
+    fig, (ax1, ax2) = plt.subplots(2,1, figsize=(10,10))
 
-# Plotting with Matplotlib
-fig, (ax1, ax2) = plt.subplots(2,1, figsize=(10,10))
+    ax1.plot(x1, y1, label=f'Grafico di f(x)', color='blue')
+    ax1.scatter(x0,f0, marker='x')
 
-ax1.plot(x1, y1, label=f'Grafico di f(x)', color='blue')
-ax1.scatter(x0,f0, marker='x')
+    if selected_function_name == "Tangente: tan(x)":
+        ax1.set_ylim(-100,100)
+        ax1.set_xlim(x0-np.pi/2,x0+np.pi/2)
 
-if selected_function_name == "Tangente: tan(x)":
-    ax1.set_ylim(-100,100)
-    ax1.set_xlim(x0-np.pi/2,x0+np.pi/2)
+        ax2.set_ylim(-100,100)
+        ax2.set_ylim(x0-r*np.pi/2,x0+r*np.pi/2)
 
-    ax2.set_ylim(-100,100)
-    ax2.set_ylim(x0-r*np.pi/2,x0+r*np.pi/2)
 
+    # Plot the main graph of the function
+    ax2.plot(x2, y2, label=f'Grafico di f(x)', color='blue')
 
-# Plot the main graph of the function
-ax2.plot(x2, y2, label=f'Grafico di f(x)', color='blue')
+    # Highlight the segment (x0-r, x0+r)
+    ax2.plot(x_zoom, y_zoom, color='orange', label=f'Segmento attorno x0')
 
-# Highlight the segment (x0-r, x0+r)
-ax2.plot(x_zoom, y_zoom, color='orange', label=f'Segmento attorno x0')
+    # Highlight the neighborhood (f(x0)-epsilon, f(x0)+epsilon) on y-axis
+    ax2.hlines([f_low, f_high], x0 - 2 * r, x0 + 2 * r, colors='green', linestyles='dashed', label='ε-intorno')
 
-# Highlight the neighborhood (f(x0)-epsilon, f(x0)+epsilon) on y-axis
-ax2.hlines([f_low, f_high], x0 - 2 * r, x0 + 2 * r, colors='green', linestyles='dashed', label='ε-intorno')
+    # Mark the point x0 and its corresponding f(x0)
+    ax2.scatter([x0], [f0], color='red', zorder=5, label=f'f(x0) = {f0}')
 
-# Mark the point x0 and its corresponding f(x0)
-ax2.scatter([x0], [f0], color='red', zorder=5, label=f'f(x0) = {f0}')
 
+    # Add labels and legends
+    ax2.set_xlabel('x')
+    ax2.set_ylabel('f(x)', rotation = 'horizontal')
+    ax2.axvline(x0, color='red', linestyle='--', label='x = x0')
+    ax2.legend(bbox_to_anchor=(1.1, 1.05))
 
-# Add labels and legends
-ax2.set_xlabel('x')
-ax2.set_ylabel('f(x)', rotation = 'horizontal')
-ax2.axvline(x0, color='red', linestyle='--', label='x = x0')
-ax2.legend(bbox_to_anchor=(1.1, 1.05))
 
 
+    # Show the graph
+    with timing.stage("st.pyplot"):
+        st.pyplot(fig)
 
-# Show the graph
-st.pyplot(fig)
+    if insert_f == "casualmente" and compare_builtins:
+        # One evaluation of all the built-ins on the shared grid
+        with timing.stage("f(x)"):
+            with np.errstate(all='ignore'):
+                ys = builtins(x1)
+        fig_all, axes = plt.subplots(2, 4, figsize=(12, 5), sharex=True)
+        for ax, name, y in zip(axes.flat, builtin_exprs, ys):
+            ax.plot(x1, y, color='orange' if name == selected_function_name else 'blue')
+            ax.axvline(x0, color='red', linestyle='--', linewidth=0.8)
+            ax.set_title(name, fontsize=9)
+            if name == "Tangente: tan(x)":
+                ax.set_ylim(-100, 100)
+        axes.flat[-1].set_visible(False)
+        fig_all.tight_layout()
+        with timing.stage("st.pyplot"):
+            st.pyplot(fig_all)
+finally:
+    timing.finish_render(timer)
+    timing.debug_panel(timer)
 
 # Add explanation about the limit and continuity
 st.markdown(f"""
@@ -0,0 +1,260 @@
+"""Offline load test of the Streamlit apps with concurrent AppTest sessions.
+
+Every session replays a sequence of steps (typing an expression, moving a
+slider, pressing a "Genera" button...) against its own AppTest instance; all
+the sessions of an app run in the same process, as they would on the server.
+Each app is measured in a fresh subprocess so that peak RSS is its own.
+
+    python loadtest.py --sessions 8 --iterations 3
+    python loadtest.py webapp2.py --scenario recorded.json --json report.json
+
+A scenario file is a JSON list of steps such as
+{"widget": "text_input", "label": "Inserisci $f(x,y)$", "value": "sin(x*y)"};
+"label" matches a substring of the widget label, or use "key" instead.
+Buttons take no value.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+import sandbox
+
+ROOT = Path(__file__).resolve().parent
+APPS = ["webapp2.py", "webapp.py", "webapp3D.py", "app_sl.py", "limit_app.py", "tangent.py"]
+TIMEOUT = 120
+QUANTILES = (0.5, 0.95, 0.99)
+
+EXPRESSIONS_2D = ["exp(x*y+x**2)", "sin(x + y)", "log(x**2 + y**2 + 1)", "x**2 - y**2",
+                  "cos(3*x)*sin(2*y)", "sqrt(x**2 + y**2)", "x*y*exp(-x**2-y**2)"]
+EXPRESSIONS_1D = ["x**2", "sin(x)", "exp(-x**2)", "sqrt(x**2 + 1)", "x**3 - x", "cos(2*x) + x"]
+
+_local = threading.local()
+
+
+def step(widget, label=None, value=None, key=None):
+    return {"widget": widget, "label": label, "value": value, "key": key}
+
+
+def synthetic(app, rng):
+    """A random input sequence for ``app``, ending with its render buttons."""
+    f2 = rng.choice(EXPRESSIONS_2D)
+    f1 = rng.choice(EXPRESSIONS_1D)
+    side = str(rng.choice([0.5, 1, 2]))
+    if app == "webapp2.py":
+        return [step("text_input", "Inserisci $f(x,y)$", f2),
+                step("text_input", r"Scegli $\ell$", side),
+                step("button", "Genera curve di livello"),
+                step("button", "Genera mappa di calore")]
+    if app == "webapp.py":
+        return [step("text_input", "Inserisci una funzione $f(x,y)$", f2),
+                step("button", "Genera i grafici")]
+    if app == "webapp3D.py":
+        # At least one of the two figures, or the render draws nothing
+        dplot, cplot = rng.choice([(True, False), (False, True), (True, True)])
+        return [step("text_input", "Inserisci una funzione $f(x,y)$", f2),
+                step("checkbox", "grafico interattivo in 3D", dplot),
+                step("checkbox", "grafico statico in 3D", cplot),
+                step("button", "Genera i grafici")]
+    if app == "app_sl.py":
+        return [step("text_input", "Enter a function", f2),
+                step("button", "Generate Plot")]
+    if app == "limit_app.py":
+        return [step("button", "Restart"),
+                step("number_input", "Inserisci $x_0$", round(rng.uniform(-1, 1), 2))]
+    if app == "tangent.py":
+        return [step("text_input", "Inserisci una funzione di x", f1),
+                step("slider", "Scegli la distanza h", round(rng.uniform(0.05, 0.5), 2))]
+    raise ValueError(f"Nessuno scenario sintetico per {app}")
+
+
+def _widget(at, spec):
+    if spec.get("key"):
+        return getattr(at, spec["widget"])(key=spec["key"])
+    for widget in getattr(at, spec["widget"]):
+        if spec["label"] in widget.label:
+            return widget
+    raise LookupError(f"{spec['widget']} con etichetta {spec['label']!r} non trovato")
+
+
+def _apply(at, spec):
+    widget = _widget(at, spec)
+    if spec["widget"] in ("button", "form_submit_button"):
+        widget.click()
+    elif spec["widget"] in ("checkbox", "toggle"):
+        widget.set_value(bool(spec["value"]))
+    else:
+        widget.set_value(spec["value"])
+
+
+def _distinct_session_ids():
+    # AppTest gives every instance the same session id, while the sandbox cancels
+    # the running job of a session when a new one starts: give each simulated
+    # session its own id, as a real server does
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    init = LocalScriptRunner.__init__
+
+    def __init__(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        self._session_id = getattr(_local, "session_id", self._session_id)
+
+    LocalScriptRunner.__init__ = __init__
+
+
+def _session(app, steps_for, iterations, seed, samples, lock):
+    from streamlit.testing.v1 import AppTest
+
+    _local.session_id = f"loadtest-{seed}"
+    rng = random.Random(seed)
+    at = AppTest.from_file(str(ROOT / app), default_timeout=TIMEOUT)
+
+    def run(kind):
+        start = time.perf_counter()
+        error = None
+        try:
+            at.run()
+            if len(at.exception):
+                error = at.exception[0].value
+            elif len(at.error):
+                error = at.error[0].value
+        except Exception as e:  # script timeout, widget not found...
+            error = f"{e.__class__.__name__}: {e}"
+        with lock:
+            samples.append((kind, time.perf_counter() - start, error))
+
+    run("load")
+    for _ in range(iterations):
+        for spec in steps_for(rng):
+            try:
+                _apply(at, spec)
+            except Exception as e:
+                with lock:
+                    samples.append((spec["widget"], 0.0, f"{e.__class__.__name__}: {e}"))
+                continue
+            run("render" if spec["widget"] == "button" else "input")
+
+
+def _rss_mb():
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _stats(latencies):
+    if not latencies:
+        return None
+    values = np.quantile(np.array(latencies) * 1000, QUANTILES)
+    return dict(zip(("p50_ms", "p95_ms", "p99_ms"), (round(float(v), 1) for v in values)))
+
+
+def run_app(app, sessions, iterations, seed, scenario=None):
+    """Run ``sessions`` concurrent sessions of ``app`` and return its report."""
+    _distinct_session_ids()
+    samples, lock = [], threading.Lock()
+    steps_for = (lambda rng: scenario) if scenario is not None else (lambda rng: synthetic(app, rng))
+
+    peak = [_rss_mb()]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], _rss_mb())
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=_session, args=(app, steps_for, iterations, seed + i, samples, lock))
+               for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    done.set()
+    sampler.join()
+
+    runs = [s for s in samples if s[0] in ("load", "input", "render")]
+    errors = [s[2] for s in samples if s[2] is not None]
+    return {
+        "app": app,
+        "sessions": sessions,
+        "runs": len(runs),
+        "wall_s": round(wall, 2),
+        "throughput_runs_s": round(len(runs) / wall, 2) if wall else 0.0,
+        "latency": _stats([s[1] for s in runs]),
+        "render_latency": _stats([s[1] for s in runs if s[0] == "render"]),
+        "error_rate": round(len(errors) / max(len(samples), 1), 4),
+        "errors": sorted(set(errors))[:5],
+        "peak_rss_mb": round(max(peak[0], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024), 1),
+        "peak_child_rss_mb": round(sandbox.peak_rss_mb(), 1),
+    }
+
+
+def _worker(queue, *args):
+    # Keep the report clean of the AppTest "missing ScriptRunContext" chatter
+    import logging
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    try:
+        queue.put(run_app(*args))
+    except Exception as e:
+        queue.put({"app": args[0], "failed": f"{e.__class__.__name__}: {e}"})
+
+
+def _print(report):
+    if "failed" in report:
+        print(f"{report['app']:<14} FALLITO: {report['failed']}")
+        return
+    lat = report["latency"] or {}
+    ren = report["render_latency"] or {}
+    print(f"{report['app']:<14} {report['sessions']:>4} {report['runs']:>5} "
+          f"{lat.get('p50_ms', 0):>8.0f} {lat.get('p95_ms', 0):>8.0f} {lat.get('p99_ms', 0):>8.0f} "
+          f"{ren.get('p50_ms', 0):>9.0f} {ren.get('p95_ms', 0):>9.0f} "
+          f"{report['throughput_runs_s']:>8.2f} {100 * report['error_rate']:>6.1f}% "
+          f"{report['peak_rss_mb']:>8.0f} {report['peak_child_rss_mb']:>8.0f}")
+    for error in report["errors"]:
+        print(f"{'':<14} errore: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("apps", nargs="*", default=APPS, help="pagine da provare (default: tutte)")
+    parser.add_argument("--sessions", type=int, default=4, help="sessioni concorrenti per app")
+    parser.add_argument("--iterations", type=int, default=2, help="ripetizioni dello scenario per sessione")
+    parser.add_argument("--scenario", type=Path, help="file JSON con i passi registrati (una sola app)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, help="scrive il report anche in JSON")
+    args = parser.parse_args(argv)
+
+    scenario = json.loads(args.scenario.read_text()) if args.scenario else None
+    if scenario is not None and len(args.apps) != 1:
+        parser.error("--scenario richiede una sola app")
+
+    os.chdir(ROOT)
+    print(f"{'app':<14} {'sess':>4} {'runs':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'gen p50':>9} {'gen p95':>9} {'runs/s':>8} {'errori':>7} {'RSS MB':>8} {'figli MB':>8}")
+    reports = []
+    ctx = mp.get_context("spawn")
+    for app in args.apps:
+        queue = ctx.Queue()
+        process = ctx.Process(target=_worker, args=(queue, app, args.sessions, args.iterations, args.seed, scenario))
+        process.start()
+        report = queue.get()
+        process.join()
+        _print(report)
+        reports.append(report)
+    if args.json:
+        args.json.write_text(json.dumps(reports, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+import sympy as sp
+
+import admission
+import sandbox
+import timing
+
+# Target wall time for a whole render (evaluation + figures), in milliseconds
+LATENCY_TARGET_MS = float(os.environ.get("CONLINE_LATENCY_TARGET_MS", 300))
+
+# Rough matplotlib cost of each figure: fixed ms and ns per grid point
+RENDER_COST = {
+    "heatmap": (150.0, 1500.0),
+    "contour": (150.0, 500.0),
+    "surface": (50.0, 300.0),
+    # mplot3d contours over plot_surface with one facet per grid cell
+    "mplot3d": (280.0, 8600.0),
+    # Grid quantized and compressed for the browser, which does the drawing
+    "client": (20.0, 30.0),
+    # Direct NumPy raster (raster.heatmap_png), no matplotlib figure
+    "thumbnail": (2.0, 25.0),
+}
+
+# Per-element cost of the operation tree nodes, in units of one numpy addition
+FUNCTION_COST = {
+    "exp": 8, "log": 10, "sin": 10, "cos": 10, "tan": 14,
+    "Abs": 1, "sqrt": 4, "Heaviside": 2, "Piecewise": 6,
+}
+NS_PER_OP = 1.5
+PROBE_POINTS = 64
+PARALLEL_MIN_MS = 20.0
+TILE_MIN_BYTES = 32 * 2**20
+# Probed costs kept per server process, one per expression
+MAX_PROBES = 256
+
+
+class Plan(NamedTuple):
+    n_points: int
+    path: str
+    estimated_ms: float
+    ns_per_point: float
+    target_ms: float
+
+
+def expression_cost(expr):
+    """Estimate the cost of one evaluation of ``expr`` by weighting its operation tree."""
+    cost = 0
+    for node in sp.preorder_traversal(expr):
+        if node.is_Atom:
+            continue
+        if isinstance(node, (sp.Add, sp.Mul)):
+            cost += len(node.args) - 1
+        elif isinstance(node, sp.Pow):
+            cost += 1 if node.exp.is_Integer and abs(node.exp) <= 4 else FUNCTION_COST["exp"] + FUNCTION_COST["log"]
+        else:
+            cost += FUNCTION_COST.get(type(node).__name__, 10)
+    return max(cost, 1)
+
+
+def _temporaries(expr):
+    return sum(1 for node in sp.preorder_traversal(expr) if not node.is_Atom)
+
+
+def _probe(func, x0, y0, d, n):
+    x = np.linspace(x0 - d, x0 + d, n)
+    y = np.linspace(y0 - d, y0 + d, n)
+    X, Y = np.meshgrid(x, y)
+    with np.errstate(all='ignore'):
+        func(X, Y)  # warm-up
+        start = time.perf_counter()
+        func(X, Y)
+    return (time.perf_counter() - start) * 1e9 / X.size
+
+
+_probes = OrderedDict()
+_lock = threading.Lock()
+
+
+def probe_cost(func, x0=0.0, y0=0.0, d=1.0):
+    """Time ``func`` on a small grid in the sandbox, in nanoseconds per point.
+
+    The cost per point hardly depends on the window, so it is measured once
+    per expression: later renders, panning or zooming included, reuse it.
+    """
+    key = (sp.srepr(func.expr), func.names)
+    with _lock:
+        if key in _probes:
+            _probes.move_to_end(key)
+            return _probes[key]
+    estimate = expression_cost(func.expr) * NS_PER_OP
+    try:
+        measured = sandbox.run(_probe, func, x0, y0, d, PROBE_POINTS)
+    except sandbox.SandboxCancelled:
+        raise
+    except sandbox.SandboxError:
+        return estimate
+    # Tiny grids are dominated by call overhead: never trust less than the tree estimate
+    cost = max(measured, estimate)
+    with _lock:
+        _probes[key] = cost
+        while len(_probes) > MAX_PROBES:
+            _probes.popitem(last=False)
+    return cost
+
+
+def plan_resolution(func, x0=0.0, y0=0.0, d=1.0, kinds=("heatmap",), target_ms=None,
+                    n_min=100, n_max=500, extra=()):
+    """Choose grid resolution and evaluation path so the render meets ``target_ms``.
+
+    ``extra`` lists further callables (e.g. the constraint g) evaluated on the same grid.
+    """
+    if target_ms is None:
+        target_ms = LATENCY_TARGET_MS
+    with timing.stage("planner"):
+        ns_eval = sum(probe_cost(fn, x0, y0, d) for fn in (func, *extra))
+    workers = os.cpu_count() or 1
+
+    fixed_ms = sum(RENDER_COST[k][0] for k in kinds)
+    ns_render = sum(RENDER_COST[k][1] for k in kinds)
+
+    def choose_path(n):
+        if workers > 1 and n * n * ns_eval / 1e6 > PARALLEL_MIN_MS:
+            return "parallel"
+        temporaries = max(_temporaries(fn.expr) for fn in (func, *extra))
+        if n * n * 8 * temporaries > TILE_MIN_BYTES:
+            return "tiled"
+        return "direct"
+
+    def cost_ms(n, path):
+        speedup = 0.8 * workers if path == "parallel" else 1.0
+        return fixed_ms + n * n * (ns_eval / speedup + ns_render) / 1e6
+
+    budget_ns = max(target_ms - fixed_ms, 0.0) * 1e6
+    n = int(math.sqrt(budget_ns / (ns_eval + ns_render))) if budget_ns else n_min
+    n = min(n_max, max(n_min, n))
+    path = choose_path(n)
+    if path == "parallel":
+        # Parallel evaluation frees part of the budget for more points
+        speedup = 0.8 * workers
+        n = min(n_max, max(n, int(math.sqrt(budget_ns / (ns_eval / speedup + ns_render))) if budget_ns else n))
+    if admission.scale() < 1:
+        # The server is loaded: a coarser grid, admitted with the render (see admission.admit)
+        n = admission.scaled(n)
+        path = choose_path(n)
+    return Plan(n, path, cost_ms(n, path), ns_eval, target_ms)
+
+
+def resolution_caption(plan, shape=None):
+    """Short Italian description of a plan, for display under the figures.
+
+    ``shape`` gives the columns and rows of the grid actually evaluated, when
+    they differ from the plan's (e.g. snapped to the tile lattice, see tiles.window_shape).
+    """
+    columns, rows = shape if shape is not None else (plan.n_points, plan.n_points)
+    text = (f"Risoluzione {columns}×{rows}, valutazione {plan.path} "
+            f"(stima {plan.estimated_ms:.0f} ms, obiettivo {plan.target_ms:.0f} ms)")
+    if admission.caption():
+        text += f"; {admission.caption()}"
+    return text
@@ -0,0 +1,227 @@
+import os
+import tempfile
+import zipfile
+
+import contourpy
+import matplotlib
+import numpy as np
+from matplotlib.colors import to_hex
+
+import contours
+import raster
+import sandbox
+import timing
+
+# Grid points per band, whatever the width: peak memory is a few bands.
+# Evaluation bands are larger, as they live in the sandbox child.
+BAND_POINTS = 2**20
+EVALUATION_POINTS = 2**22
+MAX_SIDE = 20000
+# Streamlit keeps a download whole in memory: larger posters go through write
+DOWNLOAD_SIDE = 8000
+# Colors and level curves of a poster do not need double precision: half the disk
+DTYPE = np.float32
+
+
+def _band(path, shape, rows, mode="r"):
+    # Map only the rows of one band: the address space and the resident pages
+    # stay those of a band, even for grids larger than the memory limits
+    width = shape[1]
+    return np.memmap(path, dtype=DTYPE, mode=mode, shape=(rows.stop - rows.start, width),
+                     offset=rows.start * width * np.dtype(DTYPE).itemsize)
+
+
+class Grid:
+    """f sampled on an n x n grid kept on disk, filled and read band by band with np.memmap."""
+
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+        self.shape = (len(y), len(x))
+        fd, self.path = tempfile.mkstemp(suffix=".grid")
+        with os.fdopen(fd, "wb") as fh:
+            fh.truncate(self.shape[0] * self.shape[1] * np.dtype(DTYPE).itemsize)
+        self.vmin, self.vmax = np.inf, -np.inf
+
+    @property
+    def bounds(self):
+        return self.x[0], self.x[-1], self.y[0], self.y[-1]
+
+    def bands(self, points=BAND_POINTS):
+        """Row slices of about ``points`` grid points each, from the bottom (y min) up."""
+        n, width = self.shape
+        step = max(1, points // width)
+        return [slice(i, min(i + step, n)) for i in range(0, n, step)]
+
+    def read(self, rows):
+        """Rows of the grid as a float array in memory."""
+        # The copy outlives the map, which is released right away
+        return np.array(_band(self.path, self.shape, rows), dtype=float)
+
+    def close(self):
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _fill(func, path, shape, rows, x, y):
+    # Runs in the sandbox child: writes its band straight into the file, so
+    # only the band's finite range goes back through the pipe
+    values = np.asarray(func(x[None, :], y[rows, None]), dtype=float)
+    band = _band(path, shape, rows, mode="r+")
+    band[...] = np.broadcast_to(values, band.shape)
+    band.flush()
+    finite = values[np.isfinite(values)]
+    return (float(finite.min()), float(finite.max())) if finite.size else (np.inf, -np.inf)
+
+
+def sample(func, x0, y0, d, n):
+    """Evaluate ``func`` on an n x n grid over the square of center (x0, y0) and side 2d."""
+    if not 2 <= n <= MAX_SIDE:
+        raise ValueError(f"Il lato del poster deve essere tra 2 e {MAX_SIDE} pixel")
+    grid = Grid(np.linspace(x0 - d, x0 + d, n), np.linspace(y0 - d, y0 + d, n))
+    try:
+        for rows in grid.bands(EVALUATION_POINTS):
+            # One sandboxed call per band: the CPU limit and cancellation apply per band
+            with timing.stage("f(X, Y)"):
+                lo, hi = sandbox.run(_fill, func, grid.path, grid.shape, rows, grid.x, grid.y)
+            grid.vmin, grid.vmax = min(grid.vmin, lo), max(grid.vmax, hi)
+    except BaseException:
+        grid.close()
+        raise
+    if grid.vmin > grid.vmax:
+        grid.vmin, grid.vmax = 0.0, 1.0
+    return grid
+
+
+def write_png(grid, colormap, fh):
+    """Heatmap of the grid (same colors as raster.heatmap_png), streamed band by band."""
+    def bands():
+        # PNG rows go from the top (y max) down
+        for rows in reversed(grid.bands()):
+            with timing.stage("raster"):
+                yield raster.colorize(grid.read(rows)[::-1], colormap, grid.vmin, grid.vmax)
+
+    n_rows, n_cols = grid.shape
+    raster.write_png(fh, n_cols, n_rows, bands())
+
+
+def levels_around(f0, passo):
+    """(value, color) of the levels of the contour plot: f0 in black, Reds above, Blues below."""
+    reds, blues = matplotlib.colormaps["Reds"], matplotlib.colormaps["Blues_r"]
+    return ([(f0 + 2 * passo * k, to_hex(blues((k + 15) / 14))) for k in range(-15, 0)]
+            + [(f0, "#000000")]
+            + [(f0 + 2 * passo * k, to_hex(reds((k - 1) / 14))) for k in range(1, 16)])
+
+
+def _stitch(pieces, boundaries, y, dx):
+    """Join the pieces whose ends meet on one of the ``boundaries`` rows.
+
+    Both bands interpolate the same crossing points there, up to rounding:
+    the ends on a row are sorted by x and paired when closer than a
+    millionth of a cell. Three ends at one point (a saddle exactly on the
+    boundary) are left open.
+    """
+    dy = y[1] - y[0]
+    on_row = {}
+    for i, piece in enumerate(pieces):
+        for at_start, (px, py) in ((True, piece[0]), (False, piece[-1])):
+            row = int(round((py - y[0]) / dy))
+            if row in boundaries and abs(py - y[row]) < 1e-6 * dy:
+                on_row.setdefault(row, []).append((px, i, at_start))
+    neighbour = {}
+    for ends in on_row.values():
+        ends.sort()
+        k = 0
+        while k + 1 < len(ends):
+            (xa, i, a), (xb, j, b) = ends[k], ends[k + 1]
+            apart = k + 2 < len(ends) and ends[k + 2][0] - xb < 1e-6 * dx
+            if xb - xa < 1e-6 * dx and i != j and not apart:
+                neighbour[i, a], neighbour[j, b] = (j, b), (i, a)
+                k += 2
+            else:
+                k += 1
+
+    lines, seen = [], set()
+
+    def walk(i, at_start):
+        parts = []
+        while i not in seen:
+            seen.add(i)
+            piece = pieces[i] if at_start else pieces[i][::-1]
+            parts.append(piece if not parts else piece[1:])
+            nxt = neighbour.get((i, not at_start))
+            if nxt is None:
+                break
+            i, at_start = nxt
+        return np.concatenate(parts)
+
+    # Open chains start from a free end; what is left are closed loops
+    for i in range(len(pieces)):
+        for at_start in (True, False):
+            if i not in seen and (i, at_start) not in neighbour:
+                lines.append(walk(i, at_start))
+    # (the walk ends back on the first point, so they come out closed)
+    for i in range(len(pieces)):
+        if i not in seen:
+            lines.append(walk(i, True))
+    return lines
+
+
+def extract_levels(grid, levels, tolerance):
+    """Level curves of the grid, contoured per band and stitched at the band boundaries.
+
+    Consecutive bands share their boundary row, where both find the same
+    crossing points; every piece is simplified (endpoints kept) before
+    stitching, so the vertices kept grow with the side, not with its square.
+    """
+    bands = grid.bands()
+    boundaries = {band.start for band in bands[1:]}
+    pieces = [[] for _ in levels]
+    for band in bands:
+        rows = slice(band.start, min(band.stop + 1, len(grid.y)))
+        generator = contourpy.contour_generator(grid.x, grid.y[rows], grid.read(rows))
+        with timing.stage("contour"):
+            for found, (value, _) in zip(pieces, levels):
+                found += [contours.simplify(line, tolerance) for line in generator.lines(value) if len(line) > 1]
+    with timing.stage("stitch"):
+        dx = grid.x[1] - grid.x[0]
+        return [contours.Level("f", float(value), color, _stitch(found, boundaries, grid.y, dx))
+                for found, (value, color) in zip(pieces, levels)]
+
+
+def write(func, x0, y0, d, n, colormap, levels, fmt, fh):
+    """Write the poster of ``func`` to the binary file ``fh``.
+
+    Without levels the file is the PNG itself; otherwise a ZIP with the PNG
+    and the stitched level curves in format ``fmt``, one pixel on the side.
+    Memory stays that of a few bands whatever ``n``, up to MAX_SIDE.
+    """
+    with sample(func, x0, y0, d, n) as grid:
+        if not levels:
+            write_png(grid, colormap, fh)
+        else:
+            tolerance = 0.5 * (grid.x[1] - grid.x[0])
+            with zipfile.ZipFile(fh, "w", zipfile.ZIP_STORED) as zf:
+                with zf.open("poster.png", "w", force_zip64=True) as entry:
+                    write_png(grid, colormap, entry)
+                found = extract_levels(grid, levels, tolerance)
+                zf.writestr(f"curve.{contours.FORMATS[fmt][1]}",
+                            contours.export(found, fmt, tolerance, grid.bounds, size=n))
+
+
+def export(func, x0, y0, d, n, colormap, levels=(), fmt="svg"):
+    """Poster of ``func`` as bytes, for a download (see write).
+
+    The poster is built in a temporary file, but the bytes returned are the
+    whole file: the side is limited to DOWNLOAD_SIDE.
+    """
+    if n > DOWNLOAD_SIDE:
+        raise ValueError(f"Il lato di un poster da scaricare è al massimo {DOWNLOAD_SIDE} pixel")
+    with tempfile.TemporaryFile() as fh:
+        write(func, x0, y0, d, n, colormap, levels, fmt, fh)
+        fh.seek(0)
+        return fh.read()
@@ -0,0 +1,141 @@
+import math
+from typing import NamedTuple
+
+import numpy as np
+
+import planner
+import sandbox
+import timing
+
+# Relative accuracy asked of the integral over Q before refining the grid
+TOLERANCE = 1e-6
+# Times the grid side may be doubled (each time about 4x the points of the
+# render grid), and the share of the latency target the finer grid may take
+REFINEMENTS = 1
+BUDGET_SHARE = 0.25
+
+
+class Integral(NamedTuple):
+    value: float
+    error: float  # estimated absolute error
+    evaluations: int  # evaluations of f besides the grid ones
+
+
+def _gap(nodes, lo, hi):
+    # Weights of the quadratic through the three nodes, integrated over [lo, hi]
+    h = nodes[2] - nodes[0]
+    t = (np.asarray(nodes) - nodes[1]) / h
+    V = np.vander(t, 3, increasing=True).T
+    a, b = (lo - nodes[1]) / h, (hi - nodes[1]) / h
+    moments = [(b ** (k + 1) - a ** (k + 1)) / (k + 1) for k in range(3)]
+    return np.linalg.solve(V, moments) * h
+
+
+def weights(a, x, b):
+    """Quadrature weights over [a, b] for the nodes a, x[0], ..., x[-1], b.
+
+    ``x`` is uniform and lies inside [a, b]: composite Simpson on x (with the
+    3/8 rule on the last three intervals when their number is odd), and
+    quadratic interpolation on the two end gaps, shorter than a few steps.
+    """
+    h = x[1] - x[0]
+    m = len(x) - 1
+    w = np.zeros(m + 3)
+    inner = w[1:-1]
+    if m < 3:
+        inner[:-1] += h / 2
+        inner[1:] += h / 2
+    else:
+        k = m if m % 2 == 0 else m - 3
+        s = np.ones(k + 1)
+        s[1:-1:2], s[2:-1:2] = 4, 2
+        inner[:k + 1] += s * h / 3
+        if k < m:
+            inner[k:] += np.array([1, 3, 3, 1]) * 3 * h / 8
+    if x[0] - a > 1e-9 * h:
+        w[:3] += _gap([a, x[0], x[1]], a, x[0])
+    if b - x[-1] > 1e-9 * h:
+        w[-3:] += _gap([x[-2], x[-1], b], x[-1], b)
+    return w
+
+
+def _border(func, x0, y0, d, x, y):
+    # f on the sides of Q, where the lattice of the grid stops short of them
+    bx = np.concatenate([np.full(len(y), x0 - d), np.full(len(y), x0 + d), x, x, [x0 - d, x0 + d, x0 - d, x0 + d]])
+    by = np.concatenate([y, y, np.full(len(x), y0 - d), np.full(len(x), y0 + d), [y0 - d, y0 - d, y0 + d, y0 + d]])
+    values = np.broadcast_to(sandbox.evaluate(func, bx, by, stage="f(∂Q)"), bx.shape)
+    left, right, bottom, top, corners = np.split(values, np.cumsum([len(y), len(y), len(x), len(x)]))
+    Z = np.empty((len(y) + 2, len(x) + 2))
+    Z[1:-1, 0], Z[1:-1, -1], Z[0, 1:-1], Z[-1, 1:-1] = left, right, bottom, top
+    Z[0, 0], Z[0, -1], Z[-1, 0], Z[-1, -1] = corners
+    return Z, len(bx)
+
+
+def _simpson(Z, x0, y0, d, x, y):
+    return weights(y0 - d, y, y0 + d) @ Z @ weights(x0 - d, x, x0 + d)
+
+
+def over_square(func, x0, y0, d, sample, n_points, target_ms=None):
+    """∬_Q f over the square of center (x0, y0) and side 2d.
+
+    ``sample(n)`` returns the x, y and Z of the grid already drawn, so the
+    integral reuses it; only the sides of Q are evaluated here. The error is
+    estimated from the same rule on every other grid point (Richardson). When
+    it exceeds TOLERANCE the grid is refined at most REFINEMENTS times, and
+    only if the finer grid fits a share of the latency target; otherwise the
+    estimated error is what the caller reports next to the value.
+    """
+    if target_ms is None:
+        target_ms = planner.LATENCY_TARGET_MS
+    budget_points = BUDGET_SHARE * target_ms * 1e6 / planner.probe_cost(func, x0, y0, d)
+    evaluations = 0
+    for _ in range(REFINEMENTS + 1):
+        x, y, Z = sample(n_points)
+        if len(x) < 3 or len(y) < 3:
+            return Integral(math.nan, math.nan, evaluations)
+        border, used = _border(func, x0, y0, d, x, y)
+        evaluations += used
+        border[1:-1, 1:-1] = Z
+        with timing.stage("quadrature"):
+            fine = _simpson(border, x0, y0, d, x, y)
+            rows = np.r_[0, np.arange(1, len(y) + 1, 2), len(y) + 1]
+            cols = np.r_[0, np.arange(1, len(x) + 1, 2), len(x) + 1]
+            coarse = _simpson(border[np.ix_(rows, cols)], x0, y0, d, x[::2], y[::2])
+        error = abs(fine - coarse) / 15
+        if (not np.isfinite(fine) or error <= TOLERANCE * max(1.0, abs(fine))
+                or (2 * n_points - 1) ** 2 > budget_points):
+            break
+        n_points = 2 * n_points - 1
+    return Integral(float(fine), float(error), evaluations)
+
+
+def _trapezoid(points, values):
+    ds = np.hypot(*np.diff(points, axis=0).T)
+    return float(np.sum((values[1:] + values[:-1]) / 2 * ds))
+
+
+def along(func, lines):
+    """∫ f ds along the polylines (e.g. g = 0 from implicit.trace), by the trapezoidal rule.
+
+    The error is estimated from the same rule on every other vertex.
+    """
+    lines = [np.asarray(line, dtype=float) for line in lines if len(line) > 1]
+    if not lines:
+        return Integral(0.0, 0.0, 0)
+    points = np.concatenate(lines)
+    values = np.broadcast_to(sandbox.evaluate(func, points[:, 0], points[:, 1], stage="f(g = 0)"),
+                             (len(points),))
+    fine = coarse = 0.0
+    with timing.stage("quadrature"):
+        for line, v in zip(lines, np.split(values, np.cumsum([len(line) for line in lines])[:-1])):
+            keep = np.r_[np.arange(0, len(line) - 1, 2), len(line) - 1]
+            fine += _trapezoid(line, v)
+            coarse += _trapezoid(line[keep], v[keep])
+    return Integral(fine, abs(fine - coarse) / 3, len(points))
+
+
+def describe(symbol, integral):
+    """The integral as a LaTeX line for the info box."""
+    if not np.isfinite(integral.value):
+        return f"${symbol}$ non è finito"
+    return f"${symbol} \\approx {integral.value:.8g}$ (errore stimato {integral.error:.1e})"
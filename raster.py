@@ -0,0 +1,179 @@
+import struct
+import zlib
+from functools import lru_cache
+
+import matplotlib
+import numpy as np
+
+# Same scaling as create_base_plot
+LINTHRESH = 0.5
+LINSCALE = 1.0
+BASE = 10.0
+# Color of undefined (non-finite) values: the white figure background
+BAD_COLOR = (255, 255, 255)
+COMPRESSION = 1
+
+
+@lru_cache(maxsize=32)
+def lut(name):
+    """256-entry RGB lookup table of a matplotlib colormap (read-only)."""
+    cmap = matplotlib.colormaps[name].resampled(256)
+    table = np.rint(cmap(np.arange(256))[:, :3] * 255).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+def _symlog(v, dtype=float):
+    # matplotlib's SymLogNorm transform, before the rescaling to [0, 1], without
+    # branches: c·min(|v|, t) + t·log(max(|v|, t)/t), with the sign of v
+    c = LINSCALE / (1 - 1 / BASE)
+    with np.errstate(over='ignore'):  # beyond float32: ±inf, clipped by the caller
+        v = np.asarray(v, dtype=dtype)
+    a = np.abs(v)
+    out = np.minimum(a, LINTHRESH)
+    out *= c
+    np.maximum(a, LINTHRESH, out=a)
+    a *= 1 / LINTHRESH
+    np.log(a, out=a)
+    a *= LINTHRESH / np.log(BASE)
+    out += a
+    return np.copysign(out, v, out=out)
+
+
+def value_range(Z):
+    """Minimum and maximum of the finite values of Z."""
+    finite = np.isfinite(Z)
+    if finite.all():
+        return Z.min(), Z.max()
+    return (Z[finite].min(), Z[finite].max()) if finite.any() else (0.0, 1.0)
+
+
+def color_index(Z, vmin=None, vmax=None):
+    """Colormap bin (0-255) of every value of Z, and the mask of its non-finite values (None if all finite).
+
+    Same binning as matplotlib's Colormap.__call__ on SymLogNorm(linthresh=0.5,
+    linscale=1, vmin, vmax, base=10)(Z): floor(t·N), with t = 1 in the last
+    bin. The transform runs in float32, ample for 256 bins and half the work,
+    unless vmin or vmax is beyond its range.
+    """
+    if vmin is None or vmax is None:
+        lo, hi = value_range(Z)
+        vmin = lo if vmin is None else vmin
+        vmax = hi if vmax is None else vmax
+    bad = ~np.isfinite(Z)
+    bad = bad if bad.any() else None
+    t0, t1 = _symlog([vmin, vmax])
+    if not t1 > t0:
+        return np.zeros(np.shape(Z), dtype=np.uint8), bad
+    dtype = np.float32 if max(abs(vmin), abs(vmax)) < np.finfo(np.float32).max else float
+    t = _symlog(Z, dtype)
+    t -= t0
+    t *= 256 / (t1 - t0)
+    if bad is not None:
+        t[bad] = 0
+    np.clip(t, 0, 255, out=t)
+    return t.astype(np.uint8), bad
+
+
+def colorize(Z, colormap, vmin=None, vmax=None):
+    """RGB image of Z (rows in grid order) with the colors of create_base_plot."""
+    index, bad = color_index(Z, vmin, vmax)
+    rgb = np.take(lut(colormap), index, axis=0)
+    if bad is not None:
+        rgb[bad] = BAD_COLOR
+    return rgb
+
+
+def resample(Z, width, height):
+    """Nearest-neighbour resampling of Z to ``height`` x ``width`` samples."""
+    ny, nx = Z.shape
+    rows = (np.arange(height) * ny) // height
+    cols = (np.arange(width) * nx) // width
+    return Z[rows[:, None], cols]
+
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _rows(image):
+    # Filter type 0 (none) in front of every row
+    height = image.shape[0]
+    raw = np.empty((height, 1 + image[0].size), dtype=np.uint8)
+    raw[:, 0] = 0
+    raw[:, 1:] = image.reshape(height, -1)
+    return raw.tobytes()
+
+
+def encode_png(image, palette=None):
+    """PNG bytes of an (h, w, 3) uint8 image, written directly with zlib.
+
+    With a (256, 3) ``palette`` the image is instead (h, w) uint8 indices into
+    it: one byte per pixel to compress instead of three.
+    """
+    height, width = image.shape[:2]
+    header = struct.pack(">IIBBBBB", width, height, 8, 2 if palette is None else 3, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n"
+            + _chunk(b"IHDR", header)
+            + (_chunk(b"PLTE", palette.tobytes()) if palette is not None else b"")
+            + _chunk(b"IDAT", zlib.compress(_rows(image), COMPRESSION))
+            + _chunk(b"IEND", b""))
+
+
+def write_png(fh, width, height, bands):
+    """Stream a PNG to ``fh`` from (rows, width, 3) uint8 bands, top to bottom.
+
+    Every band is compressed and written as it arrives, in its own IDAT chunk:
+    memory is bounded by one band whatever the size of the image.
+    """
+    fh.write(b"\x89PNG\r\n\x1a\n" + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+    compressor = zlib.compressobj(COMPRESSION)
+    rows = 0
+    for rgb in bands:
+        rows += len(rgb)
+        data = compressor.compress(_rows(rgb))
+        if data:
+            fh.write(_chunk(b"IDAT", data))
+    if rows != height:
+        raise ValueError(f"Immagine incompleta: {rows} righe su {height}")
+    fh.write(_chunk(b"IDAT", compressor.flush()) + _chunk(b"IEND", b""))
+
+
+def heatmap_png(Z, colormap, size=None, vmin=None, vmax=None):
+    """Heatmap of Z as PNG bytes, without matplotlib figures.
+
+    ``size`` is the (width, height) in pixels, by default one pixel per sample.
+    The y axis points up as in create_base_plot; ``vmin``/``vmax`` let several
+    thumbnails share one color scale.
+    """
+    Z = np.asarray(Z, dtype=float)
+    if vmin is None or vmax is None:
+        lo, hi = value_range(Z)
+        vmin = lo if vmin is None else vmin
+        vmax = hi if vmax is None else vmax
+    if size is not None:
+        Z = resample(Z, *size)
+    index, bad = color_index(Z[::-1], vmin, vmax)
+    palette = lut(colormap)
+    if bad is not None:
+        # Undefined values take the palette entry of a bin the image does not
+        # use; when it uses all 256, the image goes out as RGB
+        counts = np.bincount(index.ravel(), minlength=256)
+        counts[0] -= np.count_nonzero(bad)
+        spare = np.flatnonzero(counts == 0)
+        if not len(spare):
+            rgb = np.take(palette, index, axis=0)
+            rgb[bad] = BAD_COLOR
+            return encode_png(rgb)
+        palette = palette.copy()
+        palette[spare[0]] = BAD_COLOR
+        index[bad] = spare[0]
+    return encode_png(index, palette=palette)
+
+
+def colorbar_png(colormap, vmin, vmax, size=(400, 14)):
+    """Horizontal colorbar strip, from vmin (left) to vmax (right) in symlog scale."""
+    width, height = size
+    # Uniform in the normalized (symlog) scale, like the colors of the thumbnails
+    index = ((np.arange(width) * 256) // width).astype(np.uint8)
+    return encode_png(np.broadcast_to(index, (height, width)), palette=lut(colormap))
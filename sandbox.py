@@ -0,0 +1,416 @@
+import cProfile
+import math
+import multiprocessing as mp
+import os
+import signal
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import sympy as sp
+
+import grammar
+import timing
+
+try:
+    import resource
+except ImportError:  # Not available on Windows: run without rlimits
+    resource = None
+
+# Limits applied to every sandboxed computation
+CPU_SECONDS = 5
+MEMORY_MB = 1024
+WALL_TIMEOUT = 20
+POLL_INTERVAL = 0.05
+TILE_ROWS = 64
+# Idle worker processes kept for the next computations
+WORKERS = os.cpu_count() or 1
+
+
+class SandboxError(ValueError):
+    """Raised when a sandboxed computation fails or is killed by its limits."""
+
+
+class SandboxCancelled(SandboxError):
+    """Raised when a sandboxed computation is superseded by a newer request."""
+
+
+class CompiledExpression:
+    """Callable wrapper around a SymPy expression that can be sent to the sandbox."""
+
+    def __init__(self, expr, names=('x', 'y'), func=None):
+        self.expr = expr
+        self.names = tuple(names)
+        self._func = func if func is not None else sp.lambdify(sp.symbols(self.names), expr, modules='numpy')
+
+    def __call__(self, *args):
+        return self._func(*args)
+
+    def __reduce__(self):
+        # Lambdified functions are not picklable: rebuild them on the other side
+        return (CompiledExpression, (self.expr, self.names))
+
+
+class CompiledBatch:
+    """Several SymPy expressions evaluated in one call into a stacked (k, ...) array.
+
+    The expressions are lambdified together with common subexpression
+    elimination, so shared terms are computed once over the grid.
+    """
+
+    def __init__(self, exprs, names=('x', 'y')):
+        self.exprs = tuple(exprs)
+        self.names = tuple(names)
+        self.expr = sp.Tuple(*self.exprs)
+        self.shape = (len(self.exprs),)
+        # cse rebuilds the expressions: keep it from evaluating them again
+        with sp.evaluate(False):
+            self._func = sp.lambdify(sp.symbols(self.names), list(self.exprs), modules='numpy', cse=True)
+
+    def __call__(self, *args):
+        out = np.empty(self.shape + np.broadcast_shapes(*(np.shape(a) for a in args)))
+        for row, value in zip(out, self._func(*args)):
+            row[...] = value
+        return out
+
+    def __reduce__(self):
+        return (CompiledBatch, (self.exprs, self.names))
+
+
+class _Worker:
+    """A sandbox process that runs the computations it is sent, one at a time."""
+
+    def __init__(self):
+        ctx = _context()
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, args=(child,), daemon=True)
+        # multiprocessing runs __main__ again in the new process, and Streamlit
+        # makes every page script __main__: start it as from an interactive
+        # session, which has no script to re-run
+        with _start_lock:
+            main = sys.modules["__main__"]
+            sys.modules["__main__"] = types.ModuleType("__main__")
+            try:
+                self.process.start()
+            finally:
+                sys.modules["__main__"] = main
+        child.close()
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class _Job:
+    def __init__(self, worker):
+        self.worker = worker
+        self.cancelled = False
+
+
+_active = {}
+_idle = []
+_peak_rss_kb = 0
+_lock = threading.Lock()
+_start_lock = threading.Lock()
+_ctx = None
+
+
+def _context():
+    """Return the multiprocessing context used to start sandbox workers."""
+    global _ctx
+    if _ctx is None:
+        # Forking the server itself is unsafe once its threads are running (a
+        # lock held by another thread stays locked in the child): workers are
+        # forked by a single-threaded fork server that has already imported
+        # numpy, sympy and this module
+        if "forkserver" in mp.get_all_start_methods():
+            _ctx = mp.get_context("forkserver")
+            _ctx.set_forkserver_preload(["sandbox"])
+        else:
+            _ctx = mp.get_context("spawn")
+    return _ctx
+
+
+def start(workers=WORKERS):
+    """Start the fork server and ``workers`` idle workers ahead of the first computation."""
+    with _lock:
+        missing = workers - len(_idle)
+    for _ in range(missing):
+        worker = _Worker()
+        with _lock:
+            _idle.append(worker)
+
+
+def _acquire():
+    with _lock:
+        while _idle:
+            worker = _idle.pop()
+            if worker.process.is_alive():
+                return worker
+            worker.stop()
+    return _Worker()
+
+
+def _release(worker):
+    with _lock:
+        if len(_idle) < WORKERS:
+            _idle.append(worker)
+            return
+    worker.stop()
+
+
+def _address_space():
+    """Current virtual memory size of this process in bytes (0 if unknown)."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _set_soft_limit(kind, soft):
+    resource.setrlimit(kind, (soft, resource.getrlimit(kind)[1]))
+
+
+def _apply_limits(cpu_seconds, memory_mb):
+    # Soft limits only, so that the worker can lift them for its next job; the
+    # CPU limit counts from the time the worker has already used
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _set_soft_limit(resource.RLIMIT_CPU, math.ceil(usage.ru_utime + usage.ru_stime) + cpu_seconds)
+    base = _address_space()
+    if base:
+        _set_soft_limit(resource.RLIMIT_AS, base + memory_mb * 2**20)
+
+
+def _lift_limits():
+    if resource is None:
+        return
+    _set_soft_limit(resource.RLIMIT_CPU, resource.RLIM_INFINITY)
+    _set_soft_limit(resource.RLIMIT_AS, resource.RLIM_INFINITY)
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else 0
+
+
+def _serve(conn):
+    # Worker loop, until the server closes the pipe. The job is received once
+    # its limits are in place: rebuilding it (lambdify) is part of the work
+    while True:
+        try:
+            limits, profile = conn.recv()
+        except EOFError:
+            return
+        _apply_limits(*limits)
+        try:
+            _child(conn, profile)
+        finally:
+            _lift_limits()
+
+
+def _child(conn, profile):
+    # A profiled render gets the child's cProfile stats back along with the result
+    profiler = cProfile.Profile() if profile else None
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            with sp.evaluate(False):
+                func, args = conn.recv()
+            result = func(*args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    except MemoryError:
+        conn.send(("error", "memoria esaurita", None, _max_rss_kb()))
+    except Exception as e:
+        conn.send(("error", f"{e.__class__.__name__} - {e}", None, _max_rss_kb()))
+    else:
+        if profiler is not None:
+            profiler.create_stats()
+        conn.send(("ok", result, profiler.stats if profiler is not None else None, _max_rss_kb()))
+
+
+def _exit_message(exitcode, cpu_seconds, memory_mb):
+    if exitcode == -getattr(signal, "SIGXCPU", 0) or exitcode == -getattr(signal, "SIGKILL", 0):
+        return f"Calcolo interrotto: superato il limite di {cpu_seconds} s di CPU"
+    return f"Calcolo interrotto (codice {exitcode}): limite di memoria ({memory_mb} MB) o errore fatale"
+
+
+def peak_rss_mb():
+    """Peak resident memory of the workers, as of the last computation each of them finished."""
+    return _peak_rss_kb / 1024
+
+
+def session_key():
+    """Return the id of the current Streamlit session, or None outside Streamlit."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return None
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else None
+
+
+def rerun_requested():
+    """Whether Streamlit has queued a rerun or stop for the calling session."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return False
+    ctx = get_script_run_ctx(suppress_warning=True)
+    state = getattr(getattr(ctx, "script_requests", None), "_state", None)
+    return state is not None and state.name != "CONTINUE"
+
+
+def cancel(key):
+    """Kill the computation currently running for ``key``, if any."""
+    with _lock:
+        job = _active.pop(key, None)
+        if job is not None:
+            job.cancelled = True
+    if job is not None:
+        job.worker.process.kill()
+
+
+def run(func, *args, key=None, cpu_seconds=CPU_SECONDS, memory_mb=MEMORY_MB, timeout=WALL_TIMEOUT):
+    """Run ``func(*args)`` in a resource-limited worker process and return its result.
+
+    ``func`` and ``args`` are pickled to the worker. A new call with the same
+    ``key`` (by default the Streamlit session) cancels the previous one, as
+    does a rerun requested by the user changing an input. When the current
+    render is profiled, so is ``func`` in the worker.
+    """
+    global _peak_rss_kb
+    if key is None:
+        key = session_key()
+    if key is not None:
+        cancel(key)
+
+    timer = timing.current()
+    profile = timer is not None and timer.profile
+    worker = _acquire()
+    conn, process = worker.conn, worker.process
+    job = _Job(worker)
+    if key is not None:
+        with _lock:
+            _active[key] = job
+
+    deadline = time.monotonic() + timeout
+    reusable = False
+    try:
+        try:
+            conn.send(((cpu_seconds, memory_mb), profile))
+            conn.send((func, args))
+        except OSError:  # the worker died: reported below
+            pass
+        while not conn.poll(POLL_INTERVAL):
+            if job.cancelled or rerun_requested():
+                raise SandboxCancelled("Calcolo annullato: l'input è cambiato")
+            if not process.is_alive() and not conn.poll():
+                process.join()
+                raise SandboxError(_exit_message(process.exitcode, cpu_seconds, memory_mb))
+            if time.monotonic() > deadline:
+                raise SandboxError(f"Calcolo interrotto: superato il tempo massimo di {timeout} s")
+        try:
+            # SymPy results are rebuilt as they are: evaluating them again
+            # would redo on the server the work the child was limited for
+            with sp.evaluate(False):
+                status, payload, stats, rss_kb = conn.recv()
+            reusable = True
+        except (EOFError, OSError):  # killed while sending its result
+            process.join()
+            if job.cancelled:
+                raise SandboxCancelled("Calcolo annullato: l'input è cambiato")
+            raise SandboxError(_exit_message(process.exitcode, cpu_seconds, memory_mb))
+    finally:
+        with _lock:
+            if _active.get(key) is job:
+                del _active[key]
+            reusable = reusable and not job.cancelled
+        # A worker is killed to interrupt it: one that did not finish its job is
+        # replaced by a new one
+        if reusable:
+            _release(worker)
+        else:
+            worker.stop()
+
+    _peak_rss_kb = max(_peak_rss_kb, rss_kb)
+    if stats is not None:
+        timing.add_child_stats(timer, stats)
+    if status == "error":
+        raise SandboxError(payload)
+    return payload
+
+
+def _evaluate(func, path, *grids):
+    shape = np.broadcast_shapes(*(np.shape(g) for g in grids))
+    # A CompiledBatch adds a leading axis with one entry per expression
+    batch = getattr(func, "shape", ())
+    if path == "direct" or len(shape) < 2:
+        Z = np.asarray(func(*grids), dtype=float)
+        return np.broadcast_to(Z, batch + shape).copy()
+
+    # Tiled and parallel paths evaluate bands of rows to bound the temporaries
+    grids = [np.broadcast_to(g, shape) for g in grids]
+    Z = np.empty(batch + shape)
+    lead = (slice(None),) * len(batch)
+
+    def fill(rows):
+        Z[lead + (rows,)] = func(*(g[rows] for g in grids))
+
+    bands = [slice(i, i + TILE_ROWS) for i in range(0, shape[0], TILE_ROWS)]
+    if path == "parallel":
+        # NumPy ufuncs release the GIL, so threads evaluate bands concurrently
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            list(pool.map(fill, bands))
+    else:
+        for rows in bands:
+            fill(rows)
+    return Z
+
+
+def _to_sympy(trees, names):
+    return [grammar.to_sympy(tree, names) for tree in trees]
+
+
+def compile_expression(symbolic_str, names=('x', 'y')):
+    """Parse ``symbolic_str`` with the whitelisted grammar into a CompiledExpression.
+
+    The grammar runs in the server process, and the NumPy function is built
+    from its tree without lambdify. The SymPy expression is built in the
+    sandbox: SymPy evaluates the tree while building it, which can take long.
+    """
+    names = tuple(names)
+    with timing.stage("parse"):
+        tree = grammar.parse(symbolic_str, names)
+    with timing.stage("sympy"):
+        [expr] = run(_to_sympy, (tree,), names)
+    return CompiledExpression(expr, names, func=grammar.to_numpy(tree))
+
+
+def compile_batch(symbolic_strs, names=('x', 'y')):
+    """Parse several expressions, returning a CompiledBatch."""
+    names = tuple(names)
+    with timing.stage("parse"):
+        trees = tuple(grammar.parse(s, names) for s in symbolic_strs)
+    with timing.stage("sympy"):
+        exprs = run(_to_sympy, trees, names)
+    with timing.stage("lambdify"):
+        return CompiledBatch(exprs, names)
+
+
+def evaluate(func, *grids, path="direct", stage="f(X, Y)", **limits):
+    """Evaluate a CompiledExpression on the given grids in the sandbox.
+
+    ``path`` is "direct", "tiled" (bands of rows) or "parallel" (bands on threads).
+    """
+    with timing.stage(stage):
+        return run(_evaluate, func, path, *grids, **limits)
@@ -0,0 +1,111 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+import sandbox
+import timing
+
+# Compiled expressions kept per server process, shared by all pages and sessions
+EXPRESSION_CACHE_SIZE = 256
+RENDER_WORKERS = max(2, os.cpu_count() or 1)
+# Same options as st.pyplot, so that a figure saved by a worker looks the same
+SAVEFIG_OPTIONS = {"format": "png", "dpi": 200, "bbox_inches": "tight"}
+
+_pool = None
+_pool_lock = threading.Lock()
+# matplotlib is not thread-safe: the render threads draw their figures in turn
+_draw_lock = threading.Lock()
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def _compile(symbolic_str, names):
+    return sandbox.compile_expression(symbolic_str, names)
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def _compile_batch(symbolic_strs, names):
+    return sandbox.compile_batch(symbolic_strs, names)
+
+
+def symbolic_to_callable(symbolic_str, names=('x', 'y')):
+    """Convert a symbolic function (string) into a Python callable function with validation.
+
+    The whitelisted grammar parses the input in-process, while the SymPy
+    expression is built in the sandbox (see sandbox.compile_expression); the
+    result is cached, so every page and session reuses it.
+    """
+    try:
+        return _compile(symbolic_str.strip(), tuple(names))
+    except sandbox.SandboxCancelled:
+        raise
+    except Exception as e:
+        raise ValueError(f"Funzione non valida: {str(e)}")
+
+
+def symbolic_batch_to_callable(symbolic_strs, names=('x', 'y')):
+    """Convert several symbolic functions into one callable returning a (k, ...) stack."""
+    try:
+        return _compile_batch(tuple(s.strip() for s in symbolic_strs), tuple(names))
+    except sandbox.SandboxCancelled:
+        raise
+    except Exception as e:
+        raise ValueError(f"Funzione non valida: {str(e)}")
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compiled_expression(expr, names=('x', 'y')):
+    """CompiledExpression of a trusted SymPy expression (e.g. a built-in), cached."""
+    return sandbox.CompiledExpression(expr, names)
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compiled_batch(exprs, names=('x', 'y')):
+    """CompiledBatch of a tuple of trusted SymPy expressions, cached."""
+    return sandbox.CompiledBatch(exprs, names)
+
+
+def render_pool():
+    """Thread pool for rendering work (PNG encoding, figures), one per server process."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+        return _pool
+
+
+def render_concurrently(jobs):
+    """Run the independent ``jobs`` (stage name -> callable) on the render pool and
+    yield (name, result) as each one finishes, so the page can show it at once."""
+    def timed(name, job):
+        with timing.stage(name):
+            return job()
+
+    pool = render_pool()
+    futures = {pool.submit(timing.bind(timed), name, job): name for name, job in jobs.items()}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _figure_png(build, args):
+    fig = build(*args)
+    buf = io.BytesIO()
+    with _draw_lock:
+        fig.savefig(buf, **SAVEFIG_OPTIONS)
+    return buf.getvalue()
+
+
+def figure_job(build, *args):
+    """A render_concurrently job that draws the matplotlib Figure ``build(*args)`` to PNG.
+
+    ``build`` uses the object-oriented Figure API, never pyplot, whose state
+    is shared by all the threads of the server; the draws take turns, as
+    they hold the GIL for most of their time anyway. What runs concurrently is the building, the PNG encoding and the
+    other jobs (the plotly surface, showing the figures already done).
+    """
+    return lambda: _figure_png(build, args)
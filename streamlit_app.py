@@ -0,0 +1,23 @@
+import streamlit as st
+
+import sandbox
+
+# All the apps run as pages of one server process: sympy, matplotlib, the
+# compiled expressions (shared), the tile cache (tiles) and the render pool
+# are loaded once and shared by every page and session. The sandbox workers
+# are started with the first session, ready for its first computation.
+sandbox.start()
+pages = {
+    "Funzioni di due variabili": [
+        st.Page("webapp2.py", title="Curve di livello", icon="🗺️", default=True),
+        st.Page("webapp.py", title="Curve di livello e vincolo", icon="🧭", url_path="vincolo"),
+        st.Page("webapp3D.py", title="Grafici in 3D", icon="⛰️", url_path="superfici"),
+        st.Page("app_sl.py", title="Contour plot", icon="〰️", url_path="contour"),
+    ],
+    "Funzioni di una variabile": [
+        st.Page("limit_app.py", title="Limiti e continuità", icon="📈", url_path="limiti"),
+        st.Page("tangent.py", title="Tangente e secanti", icon="📐", url_path="tangente"),
+    ],
+}
+
+st.navigation(pages).run()
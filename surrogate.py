@@ -0,0 +1,176 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import sympy as sp
+from numpy.polynomial import chebyshev
+
+import sandbox
+import timing
+
+# Degrees tried in turn; the fit is accepted when the estimated error is below
+# TOLERANCE times max(1, max |f|) on the window
+DEGREES = (16, 32, 64, 128)
+TOLERANCE = 1e-8
+# Random points of the window where the fit is checked against f
+CHECK_POINTS = 256
+# Fits kept per server process, shared by all sessions
+MAX_FITS = 64
+CHUNK = 65536
+
+
+class Surrogate:
+    """2-D Chebyshev interpolant of f on the square of center (x0, y0) and side 2d.
+
+    ``coefficients[j, k]`` multiplies T_j(v)·T_k(u), with u and v the
+    coordinates rescaled to [-1, 1]; ``error`` is the estimated maximum error.
+    """
+
+    def __init__(self, func, x0, y0, d, coefficients, error, evaluations):
+        self.func = func
+        self.expr = func.expr
+        self.names = func.names
+        self.x0, self.y0, self.d = x0, y0, d
+        self.coefficients = coefficients
+        self.error = error
+        self.evaluations = evaluations
+
+    @property
+    def degree(self):
+        return len(self.coefficients) - 1
+
+    def contains(self, x0, y0, d):
+        """Whether the square of center (x0, y0) and side 2d lies inside the fitted one."""
+        return (abs(x0 - self.x0) + d <= self.d * (1 + 1e-12)
+                and abs(y0 - self.y0) + d <= self.d * (1 + 1e-12))
+
+    def grid(self, x, y):
+        """Values on the tensor grid of the 1-D ``x`` and ``y``, as a (len(y), len(x)) array."""
+        Tx = chebyshev.chebvander((np.asarray(x, dtype=float) - self.x0) / self.d, self.degree)
+        Ty = chebyshev.chebvander((np.asarray(y, dtype=float) - self.y0) / self.d, self.degree)
+        return Ty @ self.coefficients @ Tx.T
+
+    def __call__(self, x, y):
+        # Points outside the window are evaluated exactly
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        u, v = (x - self.x0) / self.d, (y - self.y0) / self.d
+        inside = (np.abs(u) <= 1) & (np.abs(v) <= 1)
+        out = np.empty(x.shape)
+        u, v = u[inside], v[inside]
+        values = np.empty(u.shape)
+        for i in range(0, len(u), CHUNK):
+            values[i:i + CHUNK] = chebyshev.chebval2d(v[i:i + CHUNK], u[i:i + CHUNK], self.coefficients)
+        out[inside] = values
+        if not inside.all():
+            out[~inside] = np.broadcast_to(self.func(x[~inside], y[~inside]), out[~inside].shape)
+        return out
+
+    def __reduce__(self):
+        return (Surrogate, (self.func, self.x0, self.y0, self.d, self.coefficients, self.error, self.evaluations))
+
+
+def _coefficient_matrix(n):
+    # Values at the Chebyshev–Lobatto points cos(πk/n) → coefficients (discrete cosine transform)
+    j = np.arange(n + 1)
+    A = np.cos(np.pi * np.outer(j, j) / n) * (2 / n)
+    A[:, [0, n]] /= 2
+    A[[0, n]] /= 2
+    return A
+
+
+def _fit(func, x0, y0, d, degrees, tolerance, check_points):
+    # Runs in the sandbox: the only place where f itself is evaluated
+    rng = np.random.default_rng(0)
+    cu, cv = rng.uniform(-1, 1, (2, check_points))
+    exact = np.broadcast_to(np.asarray(func(x0 + d * cu, y0 + d * cv), dtype=float), cu.shape)
+    evaluations = check_points
+    if not np.isfinite(exact).all():
+        return None
+    for n in degrees:
+        nodes = np.cos(np.pi * np.arange(n + 1) / n)
+        F = np.broadcast_to(np.asarray(func(x0 + d * nodes[None, :], y0 + d * nodes[:, None]), dtype=float),
+                            (n + 1, n + 1))
+        evaluations += F.size
+        if not np.isfinite(F).all():
+            return None
+        A = _coefficient_matrix(n)
+        C = A @ F @ A.T
+        bound = tolerance * max(1.0, np.abs(F).max())
+        # Truncation error: the size of the highest coefficients; then check
+        # the interpolant against f away from the nodes
+        tail = max(np.abs(C[-3:]).max(), np.abs(C[:, -3:]).max())
+        if tail > bound:
+            continue
+        error = max(tail, np.abs(chebyshev.chebval2d(cv, cu, C) - exact).max())
+        if error > bound:
+            continue
+        # Drop the degrees whose coefficients are all negligible
+        magnitude = np.maximum(np.maximum.accumulate(np.abs(C).max(axis=1)[::-1])[::-1],
+                               np.maximum.accumulate(np.abs(C).max(axis=0)[::-1])[::-1])
+        m = max(1, int(np.argmax(magnitude <= bound / (n + 1) ** 2)) or n)
+        error += np.abs(C).sum() - np.abs(C[:m + 1, :m + 1]).sum()
+        return C[:m + 1, :m + 1].copy(), error, evaluations
+    return None
+
+
+_fits = OrderedDict()
+_lock = threading.Lock()
+
+
+def _key(func):
+    return (sp.srepr(func.expr), func.names)
+
+
+def _cached(func, x0, y0, d):
+    name = _key(func)
+    with _lock:
+        for key, surrogate in reversed(_fits.items()):
+            if key[0] == name and surrogate is not None and surrogate.contains(x0, y0, d):
+                _fits.move_to_end(key)
+                return surrogate
+        # False: never fitted; None: fitted without reaching the tolerance
+        return _fits.get((name, x0, y0, d), False)
+
+
+def fit(func, x0, y0, d, tolerance=TOLERANCE):
+    """Chebyshev surrogate of ``func`` covering the square of center (x0, y0) and side 2d.
+
+    A surrogate fitted before on a larger square is reused. Returns None when
+    no degree up to the largest in DEGREES meets the tolerance, or f is not
+    finite on the square: the caller then evaluates f exactly.
+    """
+    surrogate = _cached(func, x0, y0, d)
+    if surrogate is not False:
+        return surrogate
+    with timing.stage("chebyshev"):
+        result = sandbox.run(_fit, func, x0, y0, d, DEGREES, tolerance, CHECK_POINTS)
+    surrogate = Surrogate(func, x0, y0, d, *result) if result is not None else None
+    with _lock:
+        _fits[(_key(func), x0, y0, d)] = surrogate
+        while len(_fits) > MAX_FITS:
+            _fits.popitem(last=False)
+    return surrogate
+
+
+def evaluate(func, x, y, path="direct", stage="f(X, Y)"):
+    """f on the tensor grid of ``x`` and ``y``, from its surrogate when there is one.
+
+    Without an accurate surrogate (see fit) f is evaluated exactly in the
+    sandbox. Returns the grid and the surrogate used, or None.
+    """
+    x0, y0 = (x[0] + x[-1]) / 2, (y[0] + y[-1]) / 2
+    d = max(x[-1] - x[0], y[-1] - y[0]) / 2
+    surrogate = fit(func, x0, y0, d)
+    if surrogate is None:
+        X, Y = np.meshgrid(x, y)
+        return sandbox.evaluate(func, X, Y, path=path, stage=stage), None
+    with timing.stage("chebgrid"):
+        return surrogate.grid(x, y), surrogate
+
+
+def caption(surrogate):
+    """Short Italian description of the surrogate used (or of its absence)."""
+    if surrogate is None:
+        return "Approssimazione di Chebyshev non abbastanza accurata in $Q$: valori esatti"
+    return (f"Approssimazione di Chebyshev di grado {surrogate.degree}, errore stimato "
+            f"{surrogate.error:.1e} ({surrogate.evaluations} valutazioni di $f$)")
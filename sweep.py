@@ -0,0 +1,82 @@
+import math
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+import admission
+import contours
+import grammar
+import poster
+import sandbox
+import timing
+
+MAX_FRAMES = 61
+# Grid points of all the frames together, bounding the (n_a, ny, nx) array
+MAX_POINTS = 2**21
+# Frames are drawn in the browser: less for a surface than for its contours
+MAX_SURFACE_POINTS = 2**18
+
+_NAME = re.compile(r"[A-Za-z_][A-Za-z_0-9]*\Z")
+
+
+class Sweep(NamedTuple):
+    x: np.ndarray
+    y: np.ndarray
+    a: np.ndarray  # parameter value of each frame
+    Z: np.ndarray  # (len(a), len(y), len(x))
+    f0: np.ndarray  # f(x0, y0, a) for each frame
+
+
+def parameter_name(text):
+    """Validate the name of the swept parameter (anything but x, y, functions and constants)."""
+    name = text.strip()
+    if not _NAME.match(name) or name in ("x", "y") or name in grammar.FUNCTIONS or name in grammar.CONSTANTS:
+        raise ValueError(f"Nome del parametro non valido: {name!r}")
+    return name
+
+
+def side(n_frames, n_max=500, budget=MAX_POINTS):
+    """Grid side of each frame, so that all the frames fit in ``budget`` points.
+
+    The side is lowered when the server is loaded (admission.scaled).
+    """
+    return admission.scaled(max(20, min(n_max, int(math.sqrt(budget / n_frames)))))
+
+
+def evaluate(func, x0, y0, d, a_values, n_points, path="direct"):
+    """f(x, y, a) on every frame at once, as a broadcast (n_a, ny, nx) array."""
+    if not 2 <= len(a_values) <= MAX_FRAMES:
+        raise ValueError(f"Il numero di fotogrammi deve essere tra 2 e {MAX_FRAMES}")
+    x = np.linspace(x0 - d, x0 + d, n_points)
+    y = np.linspace(y0 - d, y0 + d, n_points)
+    a = np.asarray(a_values, dtype=float)
+    Z = sandbox.evaluate(func, x[None, None, :], y[None, :, None], a[:, None, None], path=path)
+    f0 = np.broadcast_to(np.asarray(func(x0, y0, a), dtype=float), a.shape)
+    return Sweep(x, y, a, Z, f0)
+
+
+def frame_levels(sweep, passo, tolerance):
+    """Level curves of every frame around its own f0, simplified to ``tolerance``.
+
+    The levels are those of the contour plot (poster.levels_around), contoured
+    with contours.extract.
+    """
+    frames = []
+    for Z, f0 in zip(sweep.Z, sweep.f0):
+        # Every frame has the same number of levels, as the browser animates them one by one
+        pairs = poster.levels_around(float(f0) if np.isfinite(f0) else 0.0, passo)
+        if np.isfinite(f0):
+            levels = contours.extract(sweep.x, sweep.y, Z, [value for value, _ in pairs])
+        else:  # no f0 to build the levels on: an empty frame
+            levels = [contours.Level("f", value, "#000000", []) for value, _ in pairs]
+        levels = [level._replace(color=color) for level, (_, color) in zip(levels, pairs)]
+        frames.append(contours.simplified(levels, tolerance))
+    return frames
+
+
+def payload(sweep, frames, tolerance):
+    """Frames as plain lists for the browser, with their levels from contours.to_traces."""
+    with timing.stage("encode"):
+        return [{"a": float(a), "f0": float(f0), "levels": contours.to_traces(levels, tolerance)}
+                for a, f0, levels in zip(sweep.a, sweep.f0, frames)]
@@ -1,17 +1,19 @@
 import streamlit as st
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import sympy as sp
+import sandbox
+import timing
+import shared
 
 # Funzione per interpretare l'input dell'utente e restituire una funzione compatibile con numpy
 def parse_function(input_str):
-    x = sp.symbols('x')
     try:
-        # Interpreta l'espressione inserita
-        symbolic_expr = sp.sympify(input_str)
-        # Converte in una funzione compatibile con numpy
-        func = sp.lambdify(x, symbolic_expr, 'numpy')
-        return func, symbolic_expr
+        # Interpreta l'espressione con la grammatica ammessa e la converte in una
+        # funzione compatibile con numpy; l'espressione sympy è costruita in un
+        # sottoprocesso con limiti di CPU e memoria
+        func = shared.symbolic_to_callable(input_str, names=('x',))
+        return func, func.expr
     except Exception as e:
         st.error(f"Errore nell'interpretazione della funzione: {e}")
         return None, None
@@ -20,17 +22,21 @@ def parse_function(input_str):
 def plot_tangent_secant(func, symbolic_expr, x_point, h_value, lato):
     # Definisci i valori di x per la curva
     x_values = np.linspace(x_point - lato, x_point + lato, 500)
-    y_values = func(x_values)
+    with timing.stage("f(x)"):
+        y_values = func(x_values)
 
     # Calcola i punti della secante e la pendenza della tangente
     x_secant = x_point + h_value
     y_secant = func(x_secant)
     y_point = func(x_point)
 
-    # Calcolo della derivata (pendenza della tangente) usando sympy
+    # Calcolo della derivata (pendenza della tangente) usando sympy, anch'esso
+    # nel sottoprocesso
     x = sp.symbols('x')
-    tangent_slope_expr = sp.diff(symbolic_expr, x)
-    tangent_slope_func = sp.lambdify(x, tangent_slope_expr, 'numpy')
+    with timing.stage("diff"):
+        tangent_slope_expr = sandbox.run(sp.diff, symbolic_expr, x)
+    with timing.stage("lambdify"), sp.evaluate(False):
+        tangent_slope_func = sp.lambdify(x, tangent_slope_expr, 'numpy')
     tangent_slope = tangent_slope_func(x_point)
 
     # Valori della secante
@@ -38,45 +44,52 @@ def plot_tangent_secant(func, symbolic_expr, x_point, h_value, lato):
     secant_line = y_point + secant_slope * (x_values - x_point)
     tangent_line = y_point + tangent_slope * (x_values - x_point)
 
-    # Tracciamento della curva, delle secanti e della tangente
-    plt.figure(figsize=(8, 6))
-    plt.plot(x_values, y_values, label=f"Curva (y = {symbolic_expr})", color="blue")
-    plt.scatter([x_point, x_secant], [y_point, y_secant], color="red", zorder=5)
-    plt.plot(x_values, secant_line, '--', label=f"Secante (h = {h_value:.4f})", color="orange")
-    plt.plot(x_values, tangent_line, ':', label="Tangente (limite delle secanti con h → 0)", color="green")
+    # Tracciamento della curva, delle secanti e della tangente, su una Figure
+    # propria: la pagina gira per più sessioni in parallelo nello stesso processo
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
+    ax.plot(x_values, y_values, label=f"Curva (y = {symbolic_expr})", color="blue")
+    ax.scatter([x_point, x_secant], [y_point, y_secant], color="red", zorder=5)
+    ax.plot(x_values, secant_line, '--', label=f"Secante (h = {h_value:.4f})", color="orange")
+    ax.plot(x_values, tangent_line, ':', label="Tangente (limite delle secanti con h → 0)", color="green")
 
     # Etichette e legenda
-    plt.title("Tangente come limite delle secanti")
-    plt.xlabel("x")
-    plt.ylabel("f(x)", rotation='horizontal')
-    plt.legend()
-    plt.grid(True)
-    st.pyplot(plt.gcf())
-    plt.close()
+    ax.set_title("Tangente come limite delle secanti")
+    ax.set_xlabel("x")
+    ax.set_ylabel("f(x)", rotation='horizontal')
+    ax.legend()
+    ax.grid(True)
+    with timing.stage("st.pyplot"):
+        st.pyplot(fig)
 
 # App Streamlit
 st.title("Visualizzazione della tangente come limite delle secanti")
-st.write("Inserisci una funzione qui sotto per vedere come la retta tangente si avvicina alla curva come limite delle secanti.")
+timer = timing.start_render("tangent")
+try:
+    st.write("Inserisci una funzione qui sotto per vedere come la retta tangente si avvicina alla curva come limite delle secanti.")
 
-# Input per la funzione
-input_function = st.text_input("Inserisci una funzione di x, ad esempio 'x**2' o 'sin(x)':", value="x**2")
+    # Input per la funzione
+    input_function = st.text_input("Inserisci una funzione di x, ad esempio 'x**2' o 'sin(x)':", value="x**2")
 
-lato_str = st.text_input("Inserisci la lunghezza del lato della visualizzazione", value = 1.0)
-lato = float(lato_str)
+    lato_str = st.text_input("Inserisci la lunghezza del lato della visualizzazione", value = 1.0)
+    lato = float(lato_str)
 
-# Interpreta la funzione e crea una funzione compatibile con numpy
-func, symbolic_expr = parse_function(input_function)
+    # Interpreta la funzione e crea una funzione compatibile con numpy
+    func, symbolic_expr = parse_function(input_function)
 
-if func is not None:
-    # Input per il punto x0 per la tangente
-    x_point = st.text_input("Inserisci il punto x0 dove vuoi calcolare la tangente:", "1.0")
-    try:
-        x_point = float(x_point)  # Converte l'input in float
-    except ValueError:
-        st.error("Per favore, inserisci un numero valido per x0.")
+    if func is not None:
+        # Input per il punto x0 per la tangente
+        x_point = st.text_input("Inserisci il punto x0 dove vuoi calcolare la tangente:", "1.0")
+        try:
+            x_point = float(x_point)  # Converte l'input in float
+        except ValueError:
+            st.error("Per favore, inserisci un numero valido per x0.")
 
-    # Input per il valore di h per la secante
-    h_value = st.slider("Scegli la distanza h per la retta secante", min_value=0.01, max_value=lato, value=lato/2, step=0.01)
+        # Input per il valore di h per la secante
+        h_value = st.slider("Scegli la distanza h per la retta secante", min_value=0.01, max_value=lato, value=lato/2, step=0.01)
 
-    # Traccia la curva, la secante e la tangente
-    plot_tangent_secant(func, symbolic_expr, x_point, h_value, lato)
+        # Traccia la curva, la secante e la tangente
+        plot_tangent_secant(func, symbolic_expr, x_point, h_value, lato)
+finally:
+    timing.finish_render(timer)
+    timing.debug_panel(timer)
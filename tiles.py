@@ -0,0 +1,122 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+import sympy as sp
+
+import sandbox
+
+# Samples per tile side; a tile at zoom level z covers TILE_WORLD / 2**z world units
+TILE = 64
+TILE_WORLD = 1.0
+MAX_BYTES = 256 * 2**20
+
+
+class Window(NamedTuple):
+    x: np.ndarray
+    y: np.ndarray
+    Z: np.ndarray
+    reused: int
+    total: int
+
+
+class TileCache:
+    """LRU cache of evaluated tiles in world coordinates, shared by all sessions."""
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self._bytes += tile.nbytes
+            while self._bytes > self.max_bytes and self._tiles:
+                _, old = self._tiles.popitem(last=False)
+                self._bytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._bytes = 0
+
+
+cache = TileCache()
+
+
+def zoom_level(d, n_points):
+    """Zoom level whose sample spacing is closest to 2d/n_points."""
+    spacing = 2 * d / max(n_points - 1, 1)
+    return round(math.log2(TILE_WORLD / (TILE * spacing)))
+
+
+def _lattice(x0, y0, d, n_points):
+    # Zoom level, sample spacing and indices of the lattice points inside Q
+    z = zoom_level(d, n_points)
+    spacing = TILE_WORLD / (2**z * TILE)
+    sx = (math.ceil((x0 - d) / spacing), math.floor((x0 + d) / spacing))
+    sy = (math.ceil((y0 - d) / spacing), math.floor((y0 + d) / spacing))
+    return z, spacing, sx, sy
+
+
+def window_shape(x0, y0, d, n_points):
+    """Columns and rows of the grid evaluate_window returns, without evaluating it."""
+    _, _, sx, sy = _lattice(x0, y0, d, n_points)
+    return sx[1] - sx[0] + 1, sy[1] - sy[0] + 1
+
+
+def _expression_key(func):
+    return (sp.srepr(func.expr), func.names)
+
+
+def evaluate_window(func, x0, y0, d, n_points, path="direct", stage="f(X, Y)"):
+    """Evaluate ``func`` on Q = [x0-d, x0+d] x [y0-d, y0+d] from cached tiles.
+
+    The samples lie on the lattice of the chosen zoom level, so panning or
+    zooming by a small amount reuses most tiles and only the missing ones are
+    computed (in a single sandboxed call).
+    """
+    z, spacing, sx, sy = _lattice(x0, y0, d, n_points)
+    # The tiles holding the samples
+    ti = range(sx[0] // TILE, sx[1] // TILE + 1)
+    tj = range(sy[0] // TILE, sy[1] // TILE + 1)
+
+    expr_key = _expression_key(func)
+    keys = [(expr_key, z, i, j) for j in tj for i in ti]
+    found = {key: cache.get(key) for key in keys}
+    missing = [key for key in keys if found[key] is None]
+
+    if missing:
+        k = np.arange(TILE)
+        X = np.stack([np.broadcast_to((i * TILE + k) * spacing, (TILE, TILE)) for _, _, i, _ in missing])
+        Y = np.stack([np.broadcast_to(((j * TILE + k) * spacing)[:, None], (TILE, TILE)) for _, _, _, j in missing])
+        values = sandbox.evaluate(func, X, Y, path=path, stage=stage)
+        for key, tile in zip(missing, values):
+            tile.flags.writeable = False
+            cache.put(key, tile)
+            found[key] = tile
+
+    mosaic = np.empty((len(tj) * TILE, len(ti) * TILE))
+    for (_, _, i, j), tile in ((key, found[key]) for key in keys):
+        r, c = (j - tj.start) * TILE, (i - ti.start) * TILE
+        mosaic[r:r + TILE, c:c + TILE] = tile
+
+    cx = sx[0] - ti.start * TILE
+    cy = sy[0] - tj.start * TILE
+    Z = mosaic[cy:cy + sy[1] - sy[0] + 1, cx:cx + sx[1] - sx[0] + 1]
+    x = np.arange(sx[0], sx[1] + 1) * spacing
+    y = np.arange(sy[0], sy[1] + 1) * spacing
+    return Window(x, y, Z, len(keys) - len(missing), len(keys))
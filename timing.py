@@ -0,0 +1,272 @@
+import cProfile
+import io
+import json
+import marshal
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# Number of samples kept per (app, stage) for the rolling percentiles
+WINDOW = 500
+QUANTILES = (0.5, 0.95, 0.99)
+# Functions listed in the profile summary shown on the page
+PROFILE_LINES = 30
+
+# Optional files for monitoring: Prometheus textfile and per-render JSON lines
+PROMETHEUS_PATH = os.environ.get("CONLINE_METRICS_PROM")
+JSONL_PATH = os.environ.get("CONLINE_METRICS_JSONL")
+
+_history = defaultdict(lambda: deque(maxlen=WINDOW))
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class RenderTimer:
+    """Per-stage breakdown of a single render."""
+
+    def __init__(self, app, profile=False):
+        self.app = app
+        self.stages = []
+        self.started = time.perf_counter()
+        self.total = None
+        # One cProfile.Profile per thread taking part in the render
+        self.profile = profile
+        self.profiles = []
+        # cProfile stats sent back by the sandbox processes of the render
+        self.child_stats = []
+
+    def add(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def breakdown(self):
+        """Total seconds per stage, in order of first appearance."""
+        totals = {}
+        for stage, seconds in self.stages:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+
+def current():
+    """Return the RenderTimer active in this thread, if any."""
+    return getattr(_local, "timer", None)
+
+
+def _start_profile(timer):
+    # cProfile only follows the thread that enables it: other sessions are not
+    # profiled, and each thread of this render needs its own profiler
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is active in this thread
+        return None
+    timer.profiles.append(profiler)
+    return profiler
+
+
+def bind(func):
+    """Wrap ``func`` so that, run on another thread, its stages count towards the current render."""
+    timer = current()
+
+    def run(*args, **kwargs):
+        _local.timer = timer
+        profiler = _start_profile(timer) if timer is not None and timer.profile else None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            _local.timer = None
+    return run
+
+
+def record(app, stage, seconds):
+    with _lock:
+        _history[(app, stage)].append(seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time a hot-path stage, adding it to the current render and to the rolling stats."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timer = current()
+        if timer is not None:
+            timer.add(name, elapsed)
+        record(timer.app if timer is not None else "-", name, elapsed)
+
+
+def profile_requested():
+    """Whether the page was opened with ?profile=1."""
+    try:
+        import streamlit as st
+        return st.query_params.get("profile") == "1"
+    except Exception:  # outside of a Streamlit script
+        return False
+
+
+def start_render(app, profile=None):
+    """Start timing a render of ``app`` in this thread and return its timer.
+
+    With ``profile`` (by default: when the page has ?profile=1) the render
+    also runs under cProfile, until finish_render.
+    """
+    timer = RenderTimer(app, profile_requested() if profile is None else profile)
+    _local.timer = timer
+    if timer.profile:
+        _start_profile(timer)
+    return timer
+
+
+def finish_render(timer):
+    """Close ``timer``, record the total and refresh the monitoring files."""
+    if current() is timer:
+        _local.timer = None
+    if timer.profiles:
+        timer.profiles[0].disable()
+    timer.total = time.perf_counter() - timer.started
+    record(timer.app, "total", timer.total)
+    if JSONL_PATH:
+        line = json.dumps({"time": time.time(), "app": timer.app, "total": timer.total,
+                           "stages": timer.breakdown()})
+        with _lock, open(JSONL_PATH, "a") as fh:
+            fh.write(line + "\n")
+    if PROMETHEUS_PATH:
+        # Write then rename, so the collector never reads a partial file
+        tmp = PROMETHEUS_PATH + ".tmp"
+        with open(tmp, "w") as fh:
+            fh.write(export_prometheus())
+        os.replace(tmp, PROMETHEUS_PATH)
+    return timer
+
+
+def percentiles():
+    """Rolling p50/p95/p99 (in seconds) and sample count for each (app, stage)."""
+    with _lock:
+        samples = {key: np.array(values) for key, values in _history.items()}
+    stats = {}
+    for key, values in sorted(samples.items()):
+        stats[key] = dict(zip(("p50", "p95", "p99"), np.quantile(values, QUANTILES)),
+                          count=len(values), sum=float(values.sum()))
+    return stats
+
+
+def export_jsonl():
+    """Rolling aggregates as JSON lines, one per (app, stage)."""
+    return "".join(json.dumps({"app": app, "stage": stage_name, **values}) + "\n"
+                   for (app, stage_name), values in percentiles().items())
+
+
+def export_prometheus():
+    """Rolling aggregates in the Prometheus text exposition format."""
+    lines = ["# HELP conline_stage_seconds Render stage duration over the last samples.",
+             "# TYPE conline_stage_seconds summary"]
+    for (app, stage_name), values in percentiles().items():
+        labels = f'app="{app}",stage="{stage_name}"'
+        for q, name in zip(QUANTILES, ("p50", "p95", "p99")):
+            lines.append(f'conline_stage_seconds{{{labels},quantile="{q}"}} {values[name]:.6f}')
+        lines.append(f"conline_stage_seconds_sum{{{labels}}} {values['sum']:.6f}")
+        lines.append(f"conline_stage_seconds_count{{{labels}}} {values['count']}")
+    # Renders admitted and queued right now; the waits are the "queue" stage above
+    import admission  # imports timing itself
+    status = admission.status()
+    for name, text in (("running", "Renders holding an admission slot."),
+                       ("waiting", "Renders queued for an admission slot."),
+                       ("slots", "Renders allowed to run at once.")):
+        lines += [f"# HELP conline_renders_{name} {text}", f"# TYPE conline_renders_{name} gauge",
+                  f"conline_renders_{name} {status[name]}"]
+    return "\n".join(lines) + "\n"
+
+
+class _ChildProfile:
+    """Stats gathered by cProfile in a sandbox process, in the form pstats.Stats loads."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def add_child_stats(timer, stats):
+    """Add to ``timer`` the cProfile stats of one of its sandboxed computations."""
+    with _lock:
+        timer.child_stats.append(stats)
+
+
+def profile_stats(timer):
+    """The profiles of a render, its sandbox processes included, merged into one pstats.Stats, or None."""
+    stats = None
+    for profiler in timer.profiles + [_ChildProfile(s) for s in timer.child_stats]:
+        profiler.create_stats()
+        if not profiler.stats:
+            continue
+        if stats is None:
+            stats = pstats.Stats(profiler)
+        else:
+            stats.add(profiler)
+    return stats
+
+
+def export_pstats(stats):
+    """Stats in the binary format of Stats.dump_stats (snakeviz, pstats.Stats(path)...)."""
+    return marshal.dumps(stats.stats)
+
+
+def profile_panel(timer):
+    """Show the cProfile summary of a profiled render, with its pstats file to download."""
+    import streamlit as st
+
+    stats = profile_stats(timer)
+    if stats is None:
+        return
+    # The file keeps the full paths, the summary only the file names
+    data = export_pstats(stats)
+    out = io.StringIO()
+    stats.stream = out
+    stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILE_LINES)
+    with st.expander("🔬 Profilo della generazione (cProfile)"):
+        st.caption("Il lavoro svolto nei processi sandbox è incluso: compare sia come attesa di "
+                   "sandbox.run sia nelle funzioni chiamate dai processi")
+        st.code(out.getvalue(), language=None)
+        st.download_button("📥 Profilo (pstats)", data, file_name=f"{timer.app.replace('/', '_')}.pstats",
+                           mime="application/octet-stream", key=f"profile_{timer.app}")
+
+
+def debug_panel(timer):
+    """Show the per-render breakdown and rolling stats when the page has ?debug=1.
+
+    A render profiled with ?profile=1 also gets its profile (see profile_panel).
+    """
+    import streamlit as st
+
+    if timer is not None and timer.profile:
+        profile_panel(timer)
+    if st.query_params.get("debug") != "1" or timer is None:
+        return
+    with st.expander("🛠 Debug: tempi per fase"):
+        rows = [{"fase": name, "ms": round(seconds * 1000, 1)} for name, seconds in timer.breakdown().items()]
+        if timer.total is not None:
+            rows.append({"fase": "totale", "ms": round(timer.total * 1000, 1)})
+        st.table(rows)
+        st.table([{"app": app, "fase": name, "p50 ms": round(v["p50"] * 1000, 1),
+                   "p95 ms": round(v["p95"] * 1000, 1), "p99 ms": round(v["p99"] * 1000, 1), "n": v["count"]}
+                  for (app, name), v in percentiles().items() if app == timer.app])
+        import admission
+        status = admission.status()
+        st.caption(f"Generazioni in corso sul server: {status['running']} su {status['slots']}, "
+                   f"in coda: {status['waiting']}")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("📥 Metriche (JSON lines)", export_jsonl(), file_name="metrics.jsonl",
+                               mime="application/json", key=f"metrics_jsonl_{timer.app}")
+        with col2:
+            st.download_button("📥 Metriche (Prometheus)", export_prometheus(), file_name="metrics.prom",
+                               mime="text/plain", key=f"metrics_prom_{timer.app}")
@@ -2,23 +2,23 @@ import streamlit as st
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib.colors as colors
-import sympy as sp
-import io
+import grammar
+import planner
+import admission
+import timing
+import tiles
+import lagrange
+import implicit
+import shared
+from matplotlib.figure import Figure
+from shared import symbolic_to_callable
 #import plotly.graph_objects as go
 
-def symbolic_to_callable(symbolic_str):
-    """Convert a symbolic function (string) into a Python callable function."""
-    x, y = sp.symbols('x y')  # Define the symbols
-    symbolic_expr = sp.sympify(symbolic_str)  # Convert the input string to a sympy expression
-    func = sp.lambdify((x, y), symbolic_expr, modules='numpy')  # Convert sympy expression to callable
-    return func
-
-def alg_vinc(f, g, x0=0,y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', Blevel=False, level=0, dplot=False):
-    x = np.arange(x0-d, x0+d, 2*d/500)
-    y = np.arange(y0-d, y0+d, 2*d/500)
-    X, Y = np.meshgrid(x, y)
-    Z=f(X,Y)
-    Z2=g(X,Y)
+def alg_vinc(f, g, x0=0,y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', Blevel=False, level=0, dplot=False, n=500, path='direct', system=None):
+    # Samples from the tile cache shared with the other pages
+    window = tiles.evaluate_window(f, x0, y0, d, n, path)
+    X, Y = np.meshgrid(window.x, window.y)
+    Z = window.Z
 
     fig1, ax1 = plt.subplots(figsize=(7,7))
     #im = ax.imshow(data2d)
@@ -26,21 +26,31 @@ def alg_vinc(f, g, x0=0,y0=0, d=1, e=0.01, cl=True, center=True, col='viridis',
     #im = ax.imshow(Z, extent=(x0-d, x0+d, y0-d, y0+d), norm=colors.SymLogNorm(linthresh=lnrwidth, linscale=1,
                                              # vmin=Z.min(), vmax=Z.max(), base=10))
    # im = ax.imshow(Z, extent=e(x0-d, x0+d, y0-d, y0+d), vmin=Z.min(), vmax=Z.max())
-    im2 = ax1.pcolormesh(X,Y,Z, vmin=Z.min(), vmax = Z.max(), cmap=col)
-    im = ax1.pcolormesh(X,Y,Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base = 10), cmap=col)
+    with timing.stage("pcolormesh"):
+        im2 = ax1.pcolormesh(X,Y,Z, vmin=Z.min(), vmax = Z.max(), cmap=col)
+        im = ax1.pcolormesh(X,Y,Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base = 10), cmap=col)
     fig1.colorbar(im2, extend='both', orientation='horizontal', shrink=0.8)
     ax1.set_xlabel(r"$x$", loc='center')
     ax1.set_ylabel(r"$y$", loc='center', rotation = 'horizontal')
     #ax.tick_params(axis='x', labelbottom=False)
 
     
-    CS1 = ax1.contour(X,Y, Z2, [0], linewidths=1.5, alpha=0.5)
+    # g = 0 traced in a narrow band around the curve, not contoured on the whole grid
+    lines, _ = implicit.trace(g, implicit.compile_gradient(g), x0, y0, d)
+    implicit.draw(ax1, lines, colors='#440154', linewidths=1.5, alpha=0.5)
+
+    # Constrained critical points, seeded along the g = 0 curve just drawn
+    extrema = []
+    if system is not None:
+        extrema = lagrange.constrained_extrema(system, lines, x0, y0, d)
+        lagrange.mark_extrema(ax1, extrema)
 
     if center:
         ax1.plot(x0, y0, marker='x', color='black')
 
     if Blevel==True:
-        ax1.contour(X,Y, Z, [level], linewidths=3)
+        with timing.stage("contour"):
+            ax1.contour(X,Y, Z, [level], linewidths=3)
 
     # if dplot:
 
@@ -67,76 +77,67 @@ def alg_vinc(f, g, x0=0,y0=0, d=1, e=0.01, cl=True, center=True, col='viridis',
     #     fig2 = fig1
         
 
-    return fig1
-
-def alg(f, x0=0, y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', level=0, Blevel=False, dplot =False):
-    x = np.arange(x0 - d, x0 + d, 2 * d / 500)
-    y = np.arange(y0 - d, y0 + d, 2 * d / 500)
-    X, Y = np.meshgrid(x, y)
-    Z = f(X, Y)
+    return fig1, extrema
 
-    #fig, (ax1, ax2) = plt.subplots(nrows=2, figsize=(7, 7))
-    fig1, ax1 = plt.subplots(figsize=(7, 7))
+def heatmap_figure(X, Y, Z, x0, y0, center, col):
+    fig1 = Figure(figsize=(7, 7))
+    ax1 = fig1.subplots()
     im2 = ax1.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=col)
     im = ax1.pcolormesh(X, Y, Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base=10), cmap=col)
     fig1.colorbar(im2, extend='both', ax=ax1, orientation='horizontal', shrink=0.8)
     ax1.set_xlabel(r"$x$", loc='center')
     ax1.set_ylabel(r"$y$", loc='center', rotation = 'horizontal')
+    if center:
+        ax1.plot(x0, y0, marker='x', color='black')
+    ax1.set_aspect('equal')
+    return fig1
 
-    fig2, ax2 = plt.subplots(figsize=(7,7))
-
-    f0 = f(x0,y0)
-    #levels = [f0 + e * k for k in np.arange(-15, 15)]
+def contour_figure(X, Y, Z, f0, e, x0, y0, center, Blevel, level):
+    fig2 = Figure(figsize=(7, 7))
+    ax2 = fig2.subplots()
     CS1 = ax2.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(1, 16)], linewidths=1.5, cmap='Reds')
     ax2.contour(X,Y,Z, [f0], linewidths=1.5, colors='black')
     CS2 = ax2.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
-
-    #ax2.clabel(CS1)
-    #ax2.clabel(CS2)
-
     fig2.colorbar(CS1, extend='both', ax=ax2, orientation='horizontal', location='top')
     fig2.colorbar(CS2, extend='both', ax=ax2, orientation='horizontal', location='bottom')
-
     ax2.set_xlabel(r"$x$", loc='center')
     ax2.set_ylabel(r"$y$", loc='center', rotation = 'horizontal')
-
     if center:
-        ax1.plot(x0, y0, marker='x', color='black')
         ax2.plot(x0, y0, marker='x', color='black')
-
     if Blevel==True:
         ax2.contour(X,Y, Z, [level], linewidths=3)
-
-    ax1.set_aspect('equal')
     ax2.set_aspect('equal')
+    return fig2
+
+def contour3d_figure(X, Y, Z, f0, e):
+    fig3 = Figure(figsize=(10, 7))
+    ax3 = fig3.add_subplot(111, projection='3d')
+    ax3.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(1, 16)], linewidths=1.5, cmap='Reds')
+    ax3.contour(X,Y,Z, [f0], linewidths=1.5, colors='black')
+    ax3.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
+    ax3.plot_surface(X, Y, Z, cmap="coolwarm", rstride=1, cstride=1, alpha=0.2)
+    return fig3
+
+def alg(f, x0=0, y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', level=0, Blevel=False, dplot =False, n=500, path='direct'):
+    """Evaluate f on the grid once and return the jobs drawing the heatmap, the
+    level curves and, with dplot, the 3D view.
+
+    The figures only share Z: shared.render_concurrently draws them on the
+    render threads, each shown as soon as it is ready.
+    """
+    # Samples from the tile cache shared with the other pages
+    window = tiles.evaluate_window(f, x0, y0, d, n, path)
+    X, Y = np.meshgrid(window.x, window.y)
+    Z = window.Z
+    f0 = f(x0,y0)
 
+    jobs = {
+        "pcolormesh": shared.figure_job(heatmap_figure, X, Y, Z, x0, y0, center, col),
+        "contour": shared.figure_job(contour_figure, X, Y, Z, f0, e, x0, y0, center, Blevel, level),
+    }
     if dplot:
-
-        #fig3, ax3 = plt.figure().add_subplot(projection='3d')
-        fig3 = plt.figure(figsize=(10, 7)) 
-        ax3 = fig3.add_subplot(111, projection='3d')
-
-        vmin = Z.min()
-        vmax = Z.max()
-        f0 = f(x0,y0)
-        #levels = [f0 + e * k for k in np.arange(-15, 15)]
-        ax3.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(1, 16)], linewidths=1.5, cmap='Reds')
-        ax3.contour(X,Y,Z, [f0], linewidths=1.5, colors='black')
-        ax3.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
-
-        #if vmax > 0:
-         #   ax3.contour(X, Y, Z, c_range, cmap='Reds', linewidths=1.5)
-
-        #if vmin < 0:
-         #   ax3.contour(X, Y, Z, c_range2, cmap='Blues_r', linewidths=1.5)
-
-        #ax2.contour(X,Y,Z, [0], linewidths=1.5)
-        ax3.plot_surface(X, Y, Z, cmap="coolwarm", rstride=1, cstride=1, alpha=0.2)
-    
-    if dplot == False:
-        fig3 = fig2
-
-    return fig1, fig2, fig3
+        jobs["plot_surface"] = shared.figure_job(contour3d_figure, X, Y, Z, f0, e)
+    return jobs
 
 # Streamlit interface
 st.title("Esplora le curve di livello")
@@ -163,11 +164,11 @@ col1, col2, col3 = st.columns([1, 1, 1])
 
 with col1:
     str_x0 = st.text_input(r"Scegli $x_0$ (default 0):", value=0.0)
-    x0 = float(sp.sympify(str_x0))
+    x0 = grammar.number(str_x0)
 
 with col2:
     str_y0 = st.text_input(r"Scegli $y_0$ (default 0):", value=0.0)
-    y0 = float(sp.sympify(str_y0))
+    y0 = grammar.number(str_y0)
 
 with col3:
     lato = st.number_input(
@@ -244,6 +245,7 @@ if vincolo:
         #r"Inserisci una funzione $g$ tale che è visualizzato il vincolo $g(x,y)^{-1}(\{0\})$  (e.g., scrivi x**2 + y ** 2-1 per la curva $x^2+y^2=1$)", 
         value="x**2+y**2-1"
     )
+    estremi = st.checkbox("Trova i punti critici di $f$ sul vincolo (moltiplicatori di Lagrange)", value=True)
 #else:
    # st.write("Seleziona la checkbox per inserire un vincolo")
 
@@ -251,7 +253,7 @@ if vincolo:
 curva_livello_f = st.checkbox(r"Scegli se visualizzare una curva di livello di $f$ 👇", value=False)
 if curva_livello_f:
     liv_f_str = st.text_input("Scegli il livello:", value=0.0)
-    livello_f = float(sp.sympify(liv_f_str))
+    livello_f = grammar.number(liv_f_str)
 else:
     livello_f=0
     #st.write("Seleziona la checkbox per inserire il livello che vuoi visualizzare")
@@ -263,17 +265,28 @@ else:
 
 # When the user clicks the button, generate the plot
 if st.button("Genera i grafici"):
+    timer = timing.start_render("webapp")
     try:
+        admission.admit(timer.app)
         # Convert the input function to a callable function
         f = symbolic_to_callable(func_str_f)
         if vincolo:
             g = symbolic_to_callable(func_str_g)
 
+        # Choose the resolution that fits the latency target
+        if vincolo == False:
+            plan = planner.plan_resolution(f, x0, y0, lato, kinds=("heatmap", "contour"))
+        if vincolo:
+            plan = planner.plan_resolution(f, x0, y0, lato, kinds=("heatmap",))
+
         # Generate and display the contour plot
         if vincolo == False:
-            fig1, fig2, fig3 = alg(f, x0, y0, lato, passo_attorno_f_0, center=center, col=colormap, level=livello_f, Blevel=curva_livello_f, dplot = False)
-            st.pyplot(fig1)
-            st.pyplot(fig2)
+            # Both figures render at once; each is shown as soon as it is ready
+            jobs = alg(f, x0, y0, lato, passo_attorno_f_0, center=center, col=colormap, level=livello_f, Blevel=curva_livello_f, dplot = False, n=plan.n_points, path=plan.path)
+            slots = {name: st.empty() for name in jobs}
+            for name, png in shared.render_concurrently(jobs):
+                with timing.stage("st.image"):
+                    slots[name].image(png, width="stretch")
             # if not dplot_f:
             #     st.pyplot(fig1)
             #     st.pyplot(fig2)
@@ -282,13 +295,24 @@ if st.button("Genera i grafici"):
             #     st.pyplot(fig2)
             #     st.pyplot(fig3)
         if vincolo:
-            fig1 = alg_vinc(f, g, x0, y0, lato, passo_attorno_f_0, center=center, col=colormap, level=livello_f, Blevel=curva_livello_f, dplot = False)
-            st.pyplot(fig1)
+            system = lagrange.compile_system(f, g) if estremi else None
+            fig1, extrema = alg_vinc(f, g, x0, y0, lato, passo_attorno_f_0, center=center, col=colormap, level=livello_f, Blevel=curva_livello_f, dplot = False, n=plan.n_points, path=plan.path, system=system)
+            with timing.stage("st.pyplot"):
+                st.pyplot(fig1)
+            if extrema:
+                st.table(lagrange.table(extrema))
+            elif estremi:
+                st.caption("Nessun punto critico vincolato trovato in $Q$")
             # if dplot_f:
             #     st.pyplot(fig1)
             #     st.pyplot(fig2)
             # if dplot_f == False:
             #     st.pyplot(fig1)
+        st.caption(planner.resolution_caption(plan, tiles.window_shape(x0, y0, lato, plan.n_points)))
         
     except Exception as ex:
         st.error(f"Error in function input: {ex.__class__.__name__} - {ex}")
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+        timing.debug_panel(timer)
@@ -4,31 +4,37 @@ import numpy as np
 import matplotlib.colors as colors
 import sympy as sp
 import io
-
-def symbolic_to_callable(symbolic_str):
-    """Convert a symbolic function (string) into a Python callable function with validation."""
-    x, y = sp.symbols('x y')
-    try:
-        symbolic_expr = sp.sympify(symbolic_str)
-        # Check that only x, y are used
-        if not symbolic_expr.free_symbols.issubset({x, y, sp.S.EmptySet}):
-            raise ValueError("La funzione deve contenere solo le variabili x e y")
-        func = sp.lambdify((x, y), symbolic_expr, modules='numpy')
-        return func
-    except Exception as e:
-        raise ValueError(f"Funzione non valida: {str(e)}")
+import grammar
+import sandbox
+import planner
+import admission
+import timing
+import clientside
+import tiles
+import lagrange
+import implicit
+import atlas
+import contours
+import raster
+import poster
+import quadrature
+import surrogate
+import sweep
+import shared
+from shared import symbolic_to_callable, symbolic_batch_to_callable
 
 def create_base_plot(X, Y, Z, colormap, figsize=(7, 7)):
     """Create the base heatmap plot with logarithmic scaling."""
     fig, ax = plt.subplots(figsize=figsize)
     
-    # Regular colormap for colorbar
-    im2 = ax.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=colormap)
-    # Logarithmic scaling for actual plot
-    im = ax.pcolormesh(X, Y, Z, 
-                       norm=colors.SymLogNorm(linthresh=0.5, linscale=1, 
-                                             vmin=Z.min(), vmax=Z.max(), base=10), 
-                       cmap=colormap)
+    with timing.stage("pcolormesh"):
+        # Regular colormap for colorbar
+        im2 = ax.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=colormap)
+        # Logarithmic scaling for actual plot
+        im = ax.pcolormesh(X, Y, Z, 
+                           norm=colors.SymLogNorm(linthresh=0.5, linscale=1, 
+                                                 vmin=Z.min(), vmax=Z.max(), base=10), 
+                           cmap=colormap)
     
     fig.colorbar(im2, extend='both', orientation='horizontal', shrink=0.8)
     ax.set_xlabel(r"$x$", loc='center')
@@ -41,14 +47,15 @@ def create_contour_plot(X, Y, Z, f0, passo, figsize=(7, 7)):
     """Create the contour plot with level curves around f0."""
     fig, ax = plt.subplots(figsize=figsize)
     
-    # Positive levels (red)
-    CS1 = ax.contour(X, Y, Z, [f0 + 2 * passo * k for k in np.arange(1, 16)], 
-                     linewidths=1.5, cmap='Reds')
-    # Level at f0 (black)
-    ax.contour(X, Y, Z, [f0], linewidths=1.5, colors='black')
-    # Negative levels (blue)
-    CS2 = ax.contour(X, Y, Z, [f0 + 2 * passo * k for k in np.arange(-15, 0)], 
-                     linewidths=1.5, cmap='Blues_r')
+    with timing.stage("contour"):
+        # Positive levels (red)
+        CS1 = ax.contour(X, Y, Z, [f0 + 2 * passo * k for k in np.arange(1, 16)], 
+                         linewidths=1.5, cmap='Reds')
+        # Level at f0 (black)
+        ax.contour(X, Y, Z, [f0], linewidths=1.5, colors='black')
+        # Negative levels (blue)
+        CS2 = ax.contour(X, Y, Z, [f0 + 2 * passo * k for k in np.arange(-15, 0)], 
+                         linewidths=1.5, cmap='Blues_r')
     
     fig.colorbar(CS1, extend='both', ax=ax, orientation='horizontal', location='top')
     fig.colorbar(CS2, extend='both', ax=ax, orientation='horizontal', location='bottom')
@@ -59,41 +66,83 @@ def create_contour_plot(X, Y, Z, f0, passo, figsize=(7, 7)):
     
     return fig, ax
 
-def generate_heatmap(f, g, x0, y0, d, colormap, center=True, level=0, show_level=False, with_constraint=False):
-    """Generate heatmap with optional constraint."""
-    # Adaptive resolution
-    n_points = min(500, max(100, int(500 * d)))
-    x = np.linspace(x0 - d, x0 + d, n_points)
-    y = np.linspace(y0 - d, y0 + d, n_points)
-    X, Y = np.meshgrid(x, y)
+def evaluate_window(f, x0, y0, d, n_points=None, path="direct", g=None, approx=False):
+    """Evaluate f (and optionally g) on about n_points x n_points samples covering Q.
     
-    Z = f(X, Y)
+    Samples come from the shared tile cache, so panning or zooming Q only
+    computes the regions that were not evaluated before. With ``approx`` f is
+    resampled from its Chebyshev surrogate instead, when accurate enough.
+    """
+    # Adaptive resolution, unless chosen by the planner
+    if n_points is None:
+        n_points = min(500, max(100, int(500 * d)))
+    if approx:
+        # Kept out of the tile cache, which holds exact values only
+        x = np.linspace(x0 - d, x0 + d, n_points)
+        y = np.linspace(y0 - d, y0 + d, n_points)
+        Z, _ = surrogate.evaluate(f, x, y, path)
+        window = tiles.Window(x, y, Z, 0, 0)
+    else:
+        window = tiles.evaluate_window(f, x0, y0, d, n_points, path)
+    X, Y = np.meshgrid(window.x, window.y)
+    
+    Z2 = None
+    if g is not None:
+        Z2 = tiles.evaluate_window(g, x0, y0, d, n_points, path, stage="g(X, Y)").Z
+    return window.x, window.y, X, Y, window.Z, Z2
+
+def grid_shape(x0, y0, d, n_points, approx=False):
+    """Columns and rows of the grid evaluate_window returns for these arguments."""
+    return (n_points, n_points) if approx else tiles.window_shape(x0, y0, d, n_points)
+
+def integrals_text(f, x0, y0, d, n_points, path, approx, lines=None):
+    """∬_Q f and, given the polylines of g = 0, ∫ f ds along them, for the box next to f(x0, y0).
+    
+    The double integral reuses the grid of the plot (see quadrature.over_square).
+    """
+    def sample(n):
+        x, y, _, _, Z, _ = evaluate_window(f, x0, y0, d, n, path, approx=approx)
+        return x, y, Z
+    
+    rows = [quadrature.describe(r"\iint_Q f", quadrature.over_square(f, x0, y0, d, sample, n_points))]
+    if lines is not None:
+        rows.append(quadrature.describe(r"\int_{g=0} f\,ds", quadrature.along(f, lines)))
+    return "  \n".join(rows)
+
+def generate_heatmap(f, g, x0, y0, d, colormap, center=True, level=0, show_level=False, with_constraint=False,
+                     n_points=None, path="direct", system=None, approx=False):
+    """Generate heatmap with optional constraint.
+    
+    With a Lagrange ``system`` (see lagrange.compile_system) the critical points
+    of f on g = 0 are marked too. Returns the figure, those points and the
+    polylines of g = 0 (empty without the constraint).
+    """
+    x, y, X, Y, Z, _ = evaluate_window(f, x0, y0, d, n_points, path, approx=approx)
     
     fig, ax = create_base_plot(X, Y, Z, colormap)
     
-    # Add constraint contour if requested
-    # Add constraint contour if requested
+    # Add constraint curve if requested, traced only around g = 0
+    extrema, lines = [], []
     if with_constraint and g is not None:
-        Z2 = g(X, Y)
-        ax.contour(X, Y, Z2, [0], linewidths=1, alpha=1, colors='white')
+        lines, _ = implicit.trace(g, implicit.compile_gradient(g), x0, y0, d)
+        implicit.draw(ax, lines, colors='white', linewidths=1, alpha=1)
+        if system is not None:
+            extrema = lagrange.constrained_extrema(system, lines, x0, y0, d)
+            lagrange.mark_extrema(ax, extrema)
     
     if center:
         ax.plot(x0, y0, marker='x', color='black', markersize=10, markeredgewidth=2)
     
     if show_level:
-        ax.contour(X, Y, Z, [level], linewidths=1, alpha=1, colors='cyan')
+        with timing.stage("contour"):
+            ax.contour(X, Y, Z, [level], linewidths=1, alpha=1, colors='cyan')
     
-    return fig
+    return fig, extrema, lines
 
-def generate_contour(f, x0, y0, d, passo, center=True, level=0, show_level=False):
+def generate_contour(f, x0, y0, d, passo, center=True, level=0, show_level=False, n_points=None, path="direct",
+                     approx=False):
     """Generate contour plot."""
-    # Adaptive resolution
-    n_points = min(500, max(100, int(500 * d)))
-    x = np.linspace(x0 - d, x0 + d, n_points)
-    y = np.linspace(y0 - d, y0 + d, n_points)
-    X, Y = np.meshgrid(x, y)
-    
-    Z = f(X, Y)
+    x, y, X, Y, Z, _ = evaluate_window(f, x0, y0, d, n_points, path, approx=approx)
     f0 = f(x0, y0)
     
     # Create contour plot
@@ -103,20 +152,168 @@ def generate_contour(f, x0, y0, d, passo, center=True, level=0, show_level=False
         ax.plot(x0, y0, marker='x', color='black', markersize=10, markeredgewidth=2)
     
     if show_level:
-        ax.contour(X, Y, Z, [level], linewidths=3, colors='lime')
+        with timing.stage("contour"):
+            ax.contour(X, Y, Z, [level], linewidths=3, colors='lime')
     
     return fig
 
+def create_small_multiples(X, Y, Zs, titles, colormap, cols=3):
+    """Grid of heatmaps sharing one logarithmic color scale and one colorbar."""
+    rows = -(-len(Zs) // cols)
+    fig, axes = plt.subplots(rows, cols, figsize=(3.2 * cols, 3.2 * rows + 0.8), squeeze=False,
+                             sharex=True, sharey=True)
+    
+    finite = Zs[np.isfinite(Zs)]
+    vmin, vmax = (finite.min(), finite.max()) if finite.size else (-1, 1)
+    norm = colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=vmin, vmax=vmax, base=10)
+    
+    with timing.stage("pcolormesh"):
+        for ax, Z, title in zip(axes.flat, Zs, titles):
+            ax.pcolormesh(X, Y, Z, norm=norm, cmap=colormap)
+            ax.set_title(f"${sp.latex(title)}$", fontsize=10)
+            ax.set_aspect('equal')
+    for ax in axes.flat[len(Zs):]:
+        ax.set_visible(False)
+    
+    fig.colorbar(plt.cm.ScalarMappable(norm=norm, cmap=colormap), ax=axes, extend='both',
+                 orientation='horizontal', shrink=0.8)
+    return fig
+
+def evaluate_batch(fs, x0, y0, d, n_points=None, path="direct"):
+    """Evaluate all the functions of a CompiledBatch on Q in one pass."""
+    if n_points is None:
+        n_points = min(500, max(100, int(500 * d)))
+    x = np.linspace(x0 - d, x0 + d, n_points)
+    y = np.linspace(y0 - d, y0 + d, n_points)
+    X, Y = np.meshgrid(x, y)
+    return X, Y, sandbox.evaluate(fs, X, Y, path=path)
+
+def generate_small_multiples(fs, x0, y0, d, colormap, n_points=None, path="direct"):
+    """Evaluate all the functions of a CompiledBatch in one pass and plot them side by side."""
+    X, Y, Zs = evaluate_batch(fs, x0, y0, d, n_points, path)
+    return create_small_multiples(X, Y, Zs, fs.exprs, colormap)
+
+def thumbnails(Zs, colormap, cols=3, size=240):
+    """PNG thumbnails of the heatmaps drawn without matplotlib, on one color scale, and their colorbar."""
+    finite = Zs[np.isfinite(Zs)]
+    vmin, vmax = (finite.min(), finite.max()) if finite.size else (-1, 1)
+    with timing.stage("raster"):
+        # zlib releases the GIL: the panels are encoded concurrently
+        images = list(shared.render_pool().map(
+            lambda Z: raster.heatmap_png(Z, colormap, size=(size, size), vmin=vmin, vmax=vmax), Zs))
+        bar = raster.colorbar_png(colormap, vmin, vmax, size=(cols * size, 14))
+    return images, bar, vmin, vmax
+
+def show_thumbnails(images, bar, titles, vmin, vmax, cols=3):
+    """Show the thumbnails from ``thumbnails`` in rows of ``cols``, with the colorbar below."""
+    with timing.stage("st.image"):
+        for start in range(0, len(images), cols):
+            for col, image, title in zip(st.columns(cols), images[start:start + cols], titles[start:start + cols]):
+                with col:
+                    st.image(image, caption=title)
+        st.image(bar)
+    st.caption(f"Scala logaritmica simmetrica da {vmin:.4g} a {vmax:.4g}")
+
 def fig_to_bytes(fig):
     """Convert matplotlib figure to bytes for download."""
     buf = io.BytesIO()
-    fig.savefig(buf, format='png', dpi=300, bbox_inches='tight')
+    with timing.stage("savefig"):
+        fig.savefig(buf, format='png', dpi=300, bbox_inches='tight')
     buf.seek(0)
     return buf
 
+def vector_downloads(levels, bounds, tolerance, key):
+    """Download buttons for contour lines (e.g. contours.from_figure) as GeoJSON, CSV and SVG."""
+    if not any(level.lines for level in levels):
+        return
+    for col, (fmt, (mime, ext)) in zip(st.columns(len(contours.FORMATS)), contours.FORMATS.items()):
+        with col:
+            st.download_button(
+                label=f"📐 {fmt.upper()}",
+                data=lambda fmt=fmt: contours.export(levels, fmt, tolerance, bounds),
+                file_name=f"{key}.{ext}",
+                mime=mime,
+                key=f"download_{key}_{fmt}",
+                on_click="ignore"
+            )
+
+def atlas_pages(plates, colormap, passo):
+    """Render the plates of an atlas one at a time, as (name, figure) pairs."""
+    compiled = {}
+    for plate in plates:
+        if plate.func_str not in compiled:
+            compiled[plate.func_str] = symbolic_to_callable(plate.func_str)
+        f = compiled[plate.func_str]
+        if plate.kind == "contour":
+            fig = generate_contour(f, plate.x0, plate.y0, plate.d, passo)
+        else:
+            fig, _, _ = generate_heatmap(f, None, plate.x0, plate.y0, plate.d, colormap)
+        yield plate.name, fig
+
+def export_atlas(plates, colormap, passo, fmt):
+    """Build the atlas file when the download starts (on Streamlit's download thread)."""
+    timer = timing.start_render("webapp2/atlas")
+    try:
+        admission.admit(timer.app)
+        return atlas.export(atlas_pages(plates, colormap, passo), fmt)
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+
+def export_poster(func_str, x0, y0, d, n, colormap, levels, fmt):
+    """Build the poster file when the download starts (on Streamlit's download thread)."""
+    timer = timing.start_render("webapp2/poster")
+    try:
+        admission.admit(timer.app)
+        return poster.export(symbolic_to_callable(func_str), x0, y0, d, n, colormap, levels, fmt)
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+
+class SectionOutput:
+    """What a section showed after its last click, kept in session_state under ``key``.
+
+    Every element goes through ``show``, which draws it and records the call;
+    the reruns that do not recompute the section draw it again with replay.
+    """
+    
+    def __init__(self, key):
+        self.items = []
+        st.session_state[key] = self.items
+    
+    def show(self, func, *args, **kwargs):
+        self.items.append((func, args, kwargs))
+        return func(*args, **kwargs)
+    
+    def amend(self, func, **kwargs):
+        """Change the arguments the last element drawn by ``func`` is replayed with."""
+        for i in reversed(range(len(self.items))):
+            if self.items[i][0] is func:
+                self.items[i] = (func, self.items[i][1], {**self.items[i][2], **kwargs})
+                return
+
+def replay(key):
+    """Draw again the last result of a section (see SectionOutput), if any."""
+    for func, args, kwargs in st.session_state.get(key, ()):
+        func(*args, **kwargs)
+
+def value_boxes(f0_text, integrals=None):
+    """f(x0, y0) and, next to it, the integrals (a slot to fill until they are known)."""
+    col_f0, col_integral = st.columns(2)
+    col_f0.info(f0_text)
+    slot = col_integral.empty()
+    if integrals is not None:
+        slot.info(integrals)
+    return slot
+
 # Streamlit interface
 st.title("Esplora le curve di livello")
 
+client_side = st.toggle("Disegna i grafici nel browser (zoom e valori interattivi)", value=False,
+                        key="client_side")
+approx = st.toggle("Approssima $f$ con un polinomio di Chebyshev (ricampionamento veloce in $Q$)", value=False,
+                   key="surrogate")
+
 # Domain selection
 st.subheader(r"$\bullet$ Scegli il quadrato $Q$ centrato in $(x_0, y_0)$ e di lato $2\ell$")
 
@@ -160,6 +357,7 @@ with col_help:
         - **Logaritmi**: `log(x)`, `log10(x)` per logaritmi naturali e base 10
         - **Radici quadrate**: `sqrt(x)` per $\sqrt{x}$
         - **Altre funzioni comuni**: `abs(x)` per $|x|$
+        - **Costanti**: `pi` per $\pi$, `E` per $e$
         
         **Esempi:**
         - `exp(x*y + x**2)` per $e^{xy + x^2}$
@@ -167,161 +365,599 @@ with col_help:
         - `log(x**2 + y**2 + 1)` per $\log(x^2 + y^2+1)$
         """)
 
+# Every section below is a fragment: its widgets rerun only the section, and
+# its last result, kept in session_state, is drawn again on the other reruns.
+# The inputs above (Q, f and the toggles) rerun the whole page; the inputs
+# another section owns are read from session_state.
+
 # Section 1: Generate contour plot
-st.subheader(r"$\bullet$ Genera curve di livello attorno a $f(x_0,y_0)$")
+@st.fragment
+def contour_section():
+    st.subheader(r"$\bullet$ Genera curve di livello attorno a $f(x_0,y_0)$")
 
-passo_str = st.text_input(
-    label=r"Scegli la differenza tra i valori dei livelli partendo da $f_0=f(x_0,y_0)$:",
-    value="0.01",
-    key="passo_contour"
-)
+    passo_str = st.text_input(
+        label=r"Scegli la differenza tra i valori dei livelli partendo da $f_0=f(x_0,y_0)$:",
+        value="0.01",
+        key="passo_contour"
+    )
+
+    curva_livello_contour = st.checkbox(r"Visualizza una curva di livello specifica", value=False, key="level_contour")
+    liv_contour_str = None
+    if curva_livello_contour:
+        liv_contour_str = st.text_input("Scegli il livello:", value="0", key="level_value_contour")
+
+    tol_contour_str = st.text_input(
+        label=r"Tolleranza di semplificazione per l'esportazione vettoriale (in unità di $x, y$):",
+        value="0.001",
+        key="tolerance_contour"
+    )
 
-curva_livello_contour = st.checkbox(r"Visualizza una curva di livello specifica", value=False, key="level_contour")
-liv_contour_str = None
-if curva_livello_contour:
-    liv_contour_str = st.text_input("Scegli il livello:", value="0", key="level_value_contour")
+    if not st.button("Genera curve di livello"):
+        replay("result_contour")
+        return
 
-if st.button("Genera curve di livello"):
+    out = SectionOutput("result_contour")
+    timer = timing.start_render("webapp2/contour")
     try:
+        admission.admit(timer.app)
         # Parse and validate inputs
-        x0 = float(sp.sympify(str_x0))
-        y0 = float(sp.sympify(str_y0))
-        lato = float(sp.sympify(lato_str))
-        passo = float(sp.sympify(passo_str))
-        
+        x0 = grammar.number(str_x0)
+        y0 = grammar.number(str_y0)
+        lato = grammar.number(lato_str)
+        passo = grammar.number(passo_str)
+
         if passo <= 0:
-            st.error("Il passo deve essere positivo")
+            out.show(st.error, "Il passo deve essere positivo")
             st.stop()
-        
+
         if lato <= 0:
-            st.error("Il lato deve essere positivo")
+            out.show(st.error, "Il lato deve essere positivo")
             st.stop()
-        
+
         # Convert function
         f = symbolic_to_callable(func_str_f)
-        
+
         # Test function at center
         f0_val = f(x0, y0)
         if not np.isfinite(f0_val):
-            st.warning(f"⚠️ La funzione non è definita o è infinita in ({x0}, {y0})")
+            out.show(st.warning, f"⚠️ La funzione non è definita o è infinita in ({x0}, {y0})")
             st.stop()
-        
+
         # Show function value at center with minimal decimal places
         if f0_val == int(f0_val):
             f0_display = f"{int(f0_val)}"
         else:
             f0_display = f"{f0_val:.6g}"
-        
-        st.info(f"$f(x_0, y_0) = {f0_display}$")
-        
+
+        # The integrals go next to it once the grid of the plot is there
+        integral_slot = out.show(value_boxes, f"$f(x_0, y_0) = {f0_display}$")
+
         # Parse level if specified
         livello_contour = 0
         if curva_livello_contour and liv_contour_str:
-            livello_contour = float(sp.sympify(liv_contour_str))
-        
-        # Generate contour plot
-        fig = generate_contour(f, x0, y0, lato, passo, 
-                              center=center, level=livello_contour,
-                              show_level=curva_livello_contour)
-        
-        st.subheader("Curve di livello di $f$ in $Q$")
-        st.pyplot(fig)
-        
-        buf = fig_to_bytes(fig)
-        st.download_button(
-            label="📥 Scarica curve di livello (PNG)",
-            data=buf,
-            file_name=f"contours_{x0}_{y0}.png",
-            mime="image/png",
-            key="download_contour"
-        )
-        
+            livello_contour = grammar.number(liv_contour_str)
+
+        # Choose the resolution that fits the latency target
+        plan = planner.plan_resolution(f, x0, y0, lato, kinds=("client",) if client_side else ("contour",),
+                                       n_max=min(500, max(100, int(500 * lato))))
+
+        out.show(st.subheader, "Curve di livello di $f$ in $Q$")
+        if client_side:
+            # Only the grid is computed here: the browser draws the levels
+            x, y, X, Y, Z, _ = evaluate_window(f, x0, y0, lato, plan.n_points, plan.path, approx=approx)
+            with timing.stage("encode"):
+                spec = clientside.contour_spec(x, y, Z, f0_val, passo,
+                                               level=livello_contour if curva_livello_contour else None,
+                                               center=(x0, y0) if center else None)
+            with timing.stage("iframe"):
+                out.show(clientside.show, spec, height=700, key="clientside_contour")
+            out.show(st.caption, planner.resolution_caption(plan, (len(x), len(y))))
+            if approx:
+                out.show(st.caption, surrogate.caption(surrogate.fit(f, x0, y0, lato)))
+        else:
+            # Generate contour plot
+            fig = generate_contour(f, x0, y0, lato, passo,
+                                  center=center, level=livello_contour,
+                                  show_level=curva_livello_contour,
+                                  n_points=plan.n_points, path=plan.path, approx=approx)
+
+            # The PNG of the download is also the one shown, and what is kept
+            png = fig_to_bytes(fig).getvalue()
+            levels = contours.from_figure(fig)
+            plt.close(fig)
+            with timing.stage("st.image"):
+                out.show(st.image, png, width="stretch")
+            out.show(st.caption, planner.resolution_caption(plan, grid_shape(x0, y0, lato, plan.n_points, approx)))
+            if approx:
+                out.show(st.caption, surrogate.caption(surrogate.fit(f, x0, y0, lato)))
+
+            out.show(
+                st.download_button,
+                label="📥 Scarica curve di livello (PNG)",
+                data=png,
+                file_name=f"contours_{x0}_{y0}.png",
+                mime="image/png",
+                key="download_contour"
+            )
+
+            # Level curves as geometry, from the contours already drawn
+            tolerance = grammar.number(tol_contour_str)
+            out.show(vector_downloads, levels, (x0 - lato, x0 + lato, y0 - lato, y0 + lato), tolerance,
+                     f"contours_{x0}_{y0}")
+
+        integrals = integrals_text(f, x0, y0, lato, plan.n_points, plan.path, approx)
+        integral_slot.info(integrals)
+        out.amend(value_boxes, integrals=integrals)
+
     except ValueError as ve:
-        st.error(f"❌ Errore di validazione: {ve}")
+        out.show(st.error, f"❌ Errore di validazione: {ve}")
     except Exception as ex:
-        st.error(f"❌ Errore: {ex.__class__.__name__} - {ex}")
+        out.show(st.error, f"❌ Errore: {ex.__class__.__name__} - {ex}")
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+        timing.debug_panel(timer)
+
+contour_section()
 
 
 # Section 2: Generate heatmap
-st.subheader(r"$\bullet$ Genera la mappa dei valori di $f$ in $Q$")
-
-colormap_heat = st.selectbox(
-    r"Scegli un colorset:", 
-    ['viridis', 'Greys', 'autumn', 'coolwarm'],
-    key="colormap_heat"
-)
-
-vincolo_heat = st.checkbox("Aggiungi il vincolo", value=False, key="vincolo_heat")
-func_str_g_heat = None
-if vincolo_heat:
-    func_str_g_heat = st.text_input(
-        r"Inserisci $g(x,y)$ per il vincolo $g(x,y)=0$:", 
-        value="x**2+y**2-1",
-        key="constraint_heat"
+@st.fragment
+def heatmap_section():
+    st.subheader(r"$\bullet$ Genera la mappa dei valori di $f$ in $Q$")
+
+    colormap_heat = st.selectbox(
+        r"Scegli un colorset:",
+        ['viridis', 'Greys', 'autumn', 'coolwarm'],
+        key="colormap_heat"
+    )
+
+    vincolo_heat = st.checkbox("Aggiungi il vincolo", value=False, key="vincolo_heat")
+    func_str_g_heat = None
+    if vincolo_heat:
+        func_str_g_heat = st.text_input(
+            r"Inserisci $g(x,y)$ per il vincolo $g(x,y)=0$:",
+            value="x**2+y**2-1",
+            key="constraint_heat"
+        )
+        estremi_heat = st.checkbox("Trova i punti critici di $f$ sul vincolo (moltiplicatori di Lagrange)",
+                                   value=True, key="extrema_heat")
+
+    curva_livello_heat = st.checkbox(r"Visualizza una curva di livello specifica", value=False, key="level_heat")
+    liv_heat_str = None
+    if curva_livello_heat:
+        liv_heat_str = st.text_input("Scegli il livello:", value="0", key="level_value_heat")
+
+    tol_heat_str = st.text_input(
+        label=r"Tolleranza di semplificazione per l'esportazione vettoriale (in unità di $x, y$):",
+        value="0.001",
+        key="tolerance_heat"
     )
 
-curva_livello_heat = st.checkbox(r"Visualizza una curva di livello specifica", value=False, key="level_heat")
-liv_heat_str = None
-if curva_livello_heat:
-    liv_heat_str = st.text_input("Scegli il livello:", value="0", key="level_value_heat")
+    if not st.button("Genera mappa di calore"):
+        replay("result_heat")
+        return
 
-if st.button("Genera mappa di calore"):
+    out = SectionOutput("result_heat")
+    timer = timing.start_render("webapp2/heatmap")
     try:
+        admission.admit(timer.app)
         # Parse and validate inputs
-        x0 = float(sp.sympify(str_x0))
-        y0 = float(sp.sympify(str_y0))
-        lato = float(sp.sympify(lato_str))
-        
+        x0 = grammar.number(str_x0)
+        y0 = grammar.number(str_y0)
+        lato = grammar.number(lato_str)
+
         if lato <= 0:
-            st.error("Il lato deve essere positivo")
+            out.show(st.error, "Il lato deve essere positivo")
             st.stop()
-        
+
         # Convert function
         f = symbolic_to_callable(func_str_f)
-        
+
         # Test function at center
         f0_val = f(x0, y0)
         if not np.isfinite(f0_val):
-            st.warning(f"⚠️ La funzione non è definita o è infinita in ({x0}, {y0})")
+            out.show(st.warning, f"⚠️ La funzione non è definita o è infinita in ({x0}, {y0})")
             st.stop()
-        
+
         # Show function value at center with minimal decimal places
         if f0_val == int(f0_val):
             f0_display = f"{int(f0_val)}"
         else:
             f0_display = f"{f0_val:.6g}"
-        
-        st.info(f"$f(x_0, y_0) = {f0_display}$")
-        
+
+        # The integrals go next to it once the grid of the plot is there
+        integral_slot = out.show(value_boxes, f"$f(x_0, y_0) = {f0_display}$")
+
         # Parse constraint if specified
         g = None
+        system = None
         if vincolo_heat and func_str_g_heat:
             g = symbolic_to_callable(func_str_g_heat)
-        
+            if estremi_heat:
+                system = lagrange.compile_system(f, g)
+
         # Parse level if specified
         livello_heat = 0
         if curva_livello_heat and liv_heat_str:
-            livello_heat = float(sp.sympify(liv_heat_str))
-        
-        # Generate heatmap
-        fig = generate_heatmap(f, g, x0, y0, lato, colormap_heat, 
-                              center=center, level=livello_heat, 
-                              show_level=curva_livello_heat, with_constraint=vincolo_heat)
-        
-        st.subheader("Mappa dei valori di $f$ in $Q$")
-        st.pyplot(fig)
-        
-        buf = fig_to_bytes(fig)
-        st.download_button(
-            label="📥 Scarica mappa (PNG)",
-            data=buf,
-            file_name=f"heatmap_{x0}_{y0}.png",
-            mime="image/png",
-            key="download_heat"
+            livello_heat = grammar.number(liv_heat_str)
+
+        # Choose the resolution that fits the latency target
+        plan = planner.plan_resolution(f, x0, y0, lato, kinds=("client",) if client_side else ("heatmap",),
+                                       n_max=min(500, max(100, int(500 * lato))),
+                                       extra=(g,) if g is not None and client_side else ())
+
+        out.show(st.subheader, "Mappa dei valori di $f$ in $Q$")
+        if client_side:
+            # Only the grids are computed here: the browser applies the colors
+            x, y, X, Y, Z, Z2 = evaluate_window(f, x0, y0, lato, plan.n_points, plan.path, g=g, approx=approx)
+            extrema = []
+            lines = lagrange.constraint_segments(x, y, Z2) if Z2 is not None else []
+            if system is not None:
+                extrema = lagrange.constrained_extrema(system, lines, x0, y0, lato)
+            with timing.stage("encode"):
+                spec = clientside.heatmap_spec(x, y, Z, colormap_heat, Z2=Z2,
+                                               level=livello_heat if curva_livello_heat else None,
+                                               center=(x0, y0) if center else None, points=extrema)
+            with timing.stage("iframe"):
+                out.show(clientside.show, spec, height=700, key="clientside_heatmap")
+            out.show(st.caption, planner.resolution_caption(plan, (len(x), len(y))))
+            if approx:
+                out.show(st.caption, surrogate.caption(surrogate.fit(f, x0, y0, lato)))
+        else:
+            # Generate heatmap
+            fig, extrema, lines = generate_heatmap(f, g, x0, y0, lato, colormap_heat,
+                                                   center=center, level=livello_heat,
+                                                   show_level=curva_livello_heat, with_constraint=vincolo_heat,
+                                                   n_points=plan.n_points, path=plan.path, system=system,
+                                                   approx=approx)
+
+            # The PNG of the download is also the one shown, and what is kept
+            png = fig_to_bytes(fig).getvalue()
+            levels = contours.from_figure(fig)
+            plt.close(fig)
+            with timing.stage("st.image"):
+                out.show(st.image, png, width="stretch")
+            out.show(st.caption, planner.resolution_caption(plan, grid_shape(x0, y0, lato, plan.n_points, approx)))
+            if approx:
+                out.show(st.caption, surrogate.caption(surrogate.fit(f, x0, y0, lato)))
+
+            out.show(
+                st.download_button,
+                label="📥 Scarica mappa (PNG)",
+                data=png,
+                file_name=f"heatmap_{x0}_{y0}.png",
+                mime="image/png",
+                key="download_heat"
+            )
+
+            # Constraint and level curves as geometry, from the contours already drawn
+            tolerance = grammar.number(tol_heat_str)
+            out.show(vector_downloads, levels, (x0 - lato, x0 + lato, y0 - lato, y0 + lato), tolerance,
+                     f"curves_{x0}_{y0}")
+
+        if extrema:
+            out.show(st.table, lagrange.table(extrema))
+        elif system is not None:
+            out.show(st.caption, "Nessun punto critico vincolato trovato in $Q$")
+
+        integrals = integrals_text(f, x0, y0, lato, plan.n_points, plan.path, approx,
+                                   lines=lines if g is not None else None)
+        integral_slot.info(integrals)
+        out.amend(value_boxes, integrals=integrals)
+
+    except ValueError as ve:
+        out.show(st.error, f"❌ Errore di validazione: {ve}")
+    except Exception as ex:
+        out.show(st.error, f"❌ Errore: {ex.__class__.__name__} - {ex}")
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+        timing.debug_panel(timer)
+
+heatmap_section()
+
+
+# Section 3: Compare several functions
+@st.fragment
+def multiples_section():
+    st.subheader(r"$\bullet$ Confronta più funzioni in $Q$")
+
+    funcs_str_multi = st.text_area(
+        "Inserisci una funzione $f(x,y)$ per riga:",
+        value="exp(x*y+x**2)\nsin(x + y)\nlog(x**2 + y**2 + 1)\nx**2 - y**2",
+        key="funcs_multi"
+    )
+
+    colormap_multi = st.selectbox(
+        r"Scegli un colorset:",
+        ['viridis', 'Greys', 'autumn', 'coolwarm'],
+        key="colormap_multi"
+    )
+
+    thumbnails_multi = st.checkbox("Anteprime rapide (immagini senza assi)", value=True, key="thumbnails_multi")
+
+    if not st.button("Genera confronto"):
+        replay("result_multi")
+        return
+
+    out = SectionOutput("result_multi")
+    timer = timing.start_render("webapp2/multiples")
+    try:
+        admission.admit(timer.app)
+        # Parse and validate inputs
+        x0 = grammar.number(str_x0)
+        y0 = grammar.number(str_y0)
+        lato = grammar.number(lato_str)
+
+        if lato <= 0:
+            out.show(st.error, "Il lato deve essere positivo")
+            st.stop()
+
+        lines = [line.strip() for line in funcs_str_multi.splitlines() if line.strip()]
+        if not lines:
+            out.show(st.error, "Inserisci almeno una funzione")
+            st.stop()
+
+        # All the functions are compiled into a single evaluator
+        fs = symbolic_batch_to_callable(lines)
+
+        # One small heatmap per function
+        kind = "thumbnail" if thumbnails_multi else "heatmap"
+        plan = planner.plan_resolution(fs, x0, y0, lato, kinds=(kind,) * len(lines),
+                                       n_max=min(500, max(100, int(500 * lato))))
+
+        if thumbnails_multi:
+            X, Y, Zs = evaluate_batch(fs, x0, y0, lato, n_points=plan.n_points, path=plan.path)
+            images, bar, vmin, vmax = thumbnails(Zs, colormap_multi)
+            out.show(show_thumbnails, images, bar, lines, vmin, vmax)
+            out.show(st.caption, planner.resolution_caption(plan))
+        else:
+            fig = generate_small_multiples(fs, x0, y0, lato, colormap_multi,
+                                           n_points=plan.n_points, path=plan.path)
+
+            # The PNG of the download is also the one shown, and what is kept
+            png = fig_to_bytes(fig).getvalue()
+            plt.close(fig)
+            with timing.stage("st.image"):
+                out.show(st.image, png, width="stretch")
+            out.show(st.caption, planner.resolution_caption(plan))
+
+            out.show(
+                st.download_button,
+                label="📥 Scarica confronto (PNG)",
+                data=png,
+                file_name=f"multiples_{x0}_{y0}.png",
+                mime="image/png",
+                key="download_multi"
+            )
+
+    except ValueError as ve:
+        out.show(st.error, f"❌ Errore di validazione: {ve}")
+    except Exception as ex:
+        out.show(st.error, f"❌ Errore: {ex.__class__.__name__} - {ex}")
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+        timing.debug_panel(timer)
+
+multiples_section()
+
+
+# Section 4: Export an atlas of plates
+@st.fragment
+def atlas_section():
+    st.subheader(r"$\bullet$ Esporta un atlante di tavole")
+
+    funcs_str_atlas = st.text_area(
+        "Inserisci una funzione $f(x,y)$ per riga:",
+        value="exp(x*y+x**2)\nsin(x + y)",
+        key="funcs_atlas"
+    )
+
+    windows_str_atlas = st.text_area(
+        r"Inserisci un quadrato per riga, come $x_0, y_0, \ell$:",
+        value="0, 0, 1\n0.5, 0.5, 0.5",
+        key="windows_atlas"
+    )
+
+    col1, col2 = st.columns([1, 1])
+
+    with col1:
+        kinds_atlas = st.multiselect(
+            "Tavole:",
+            ["curve di livello", "mappa di calore"],
+            default=["curve di livello", "mappa di calore"],
+            key="kinds_atlas"
         )
-        
+
+    with col2:
+        format_atlas = st.radio("Formato:", ["PDF multipagina", "ZIP di PNG"], key="format_atlas")
+
+    if not st.button("Prepara l'atlante"):
+        replay("result_atlas")
+        return
+
+    out = SectionOutput("result_atlas")
+    try:
+        lines = [line.strip() for line in funcs_str_atlas.splitlines() if line.strip()]
+        if not lines:
+            out.show(st.error, "Inserisci almeno una funzione")
+            st.stop()
+
+        passo = grammar.number(st.session_state["passo_contour"])
+        if passo <= 0:
+            out.show(st.error, "Il passo deve essere positivo")
+            st.stop()
+
+        kinds = [{"curve di livello": "contour", "mappa di calore": "heatmap"}[k] for k in kinds_atlas]
+        plates = atlas.plates(lines, atlas.parse_windows(windows_str_atlas), kinds)
+        if not plates:
+            out.show(st.error, "Scegli almeno un quadrato e un tipo di tavola")
+            st.stop()
+
+        # Check the functions now, so errors show up here and not in the download
+        for line in set(lines):
+            symbolic_to_callable(line)
+
+        # The plates are rendered only when the download starts, one at a time
+        fmt = "pdf" if format_atlas.startswith("PDF") else "zip"
+        colormap = st.session_state["colormap_heat"]
+        out.show(
+            st.download_button,
+            label=f"📥 Scarica atlante ({len(plates)} tavole)",
+            data=lambda: export_atlas(plates, colormap, passo, fmt),
+            file_name=f"atlante.{fmt}",
+            mime=atlas.FORMATS[fmt],
+            key="download_atlas",
+            on_click="ignore"
+        )
+
+    except ValueError as ve:
+        out.show(st.error, f"❌ Errore di validazione: {ve}")
+    except Exception as ex:
+        out.show(st.error, f"❌ Errore: {ex.__class__.__name__} - {ex}")
+
+atlas_section()
+
+
+# Section 5: Poster-resolution heatmap, evaluated and written band by band
+@st.fragment
+def poster_section():
+    st.subheader(r"$\bullet$ Esporta un poster ad alta risoluzione")
+
+    col1, col2, col3 = st.columns([1, 1, 1])
+
+    with col1:
+        side_poster = st.number_input("Lato del poster (pixel):", min_value=500, max_value=poster.DOWNLOAD_SIDE,
+                                      value=8000, step=500, key="side_poster")
+
+    with col2:
+        levels_poster = st.checkbox("Aggiungi le curve di livello", value=True, key="levels_poster")
+
+    with col3:
+        format_poster = st.radio("Formato delle curve:", list(contours.FORMATS), key="format_poster",
+                                 disabled=not levels_poster)
+
+    if not st.button("Prepara il poster"):
+        replay("result_poster")
+        return
+
+    out = SectionOutput("result_poster")
+    try:
+        x0 = grammar.number(str_x0)
+        y0 = grammar.number(str_y0)
+        lato = grammar.number(lato_str)
+        passo = grammar.number(st.session_state["passo_contour"])
+
+        if lato <= 0 or passo <= 0:
+            out.show(st.error, "Il lato e il passo devono essere positivi")
+            st.stop()
+
+        # Check the function now, so errors show up here and not in the download
+        f = symbolic_to_callable(func_str_f)
+        levels = poster.levels_around(float(f(x0, y0)), passo) if levels_poster else ()
+
+        # The grid lives on disk and the PNG is written row band by row band;
+        # the work starts with the download, whose finished file Streamlit
+        # keeps in memory, hence the limit on the side
+        n = int(side_poster)
+        ext, mime = ("zip", "application/zip") if levels else ("png", "image/png")
+        func_str, colormap = func_str_f, st.session_state["colormap_heat"]
+        out.show(
+            st.download_button,
+            label=f"📥 Scarica poster {n}×{n}" + (" con le curve" if levels else ""),
+            data=lambda: export_poster(func_str, x0, y0, lato, n, colormap, levels, format_poster),
+            file_name=f"poster_{n}.{ext}",
+            mime=mime,
+            key="download_poster",
+            on_click="ignore"
+        )
+        out.show(st.caption, f"Griglia su disco di {n * n * np.dtype(poster.DTYPE).itemsize / 2**20:.0f} MB, "
+                             "elaborata a bande di righe")
+
+    except ValueError as ve:
+        out.show(st.error, f"❌ Errore di validazione: {ve}")
+    except Exception as ex:
+        out.show(st.error, f"❌ Errore: {ex.__class__.__name__} - {ex}")
+
+poster_section()
+
+
+# Section 6: A family f(x, y, a), evaluated at once and animated in the browser
+@st.fragment
+def sweep_section():
+    st.subheader(r"$\bullet$ Esplora una famiglia di funzioni $f(x, y, a)$")
+
+    col1, col2 = st.columns([2, 1])
+
+    with col1:
+        func_str_sweep = st.text_input(
+            r"Inserisci $f(x, y, a)$, con un parametro oltre a $x$ e $y$:",
+            value="exp(a*x*y + x**2)",
+            key="func_sweep"
+        )
+
+    with col2:
+        param_sweep = st.text_input("Nome del parametro:", value="a", key="param_sweep")
+
+    col1, col2, col3 = st.columns([1, 1, 1])
+
+    with col1:
+        a_min_str = st.text_input("Valore iniziale del parametro:", value="-1", key="a_min_sweep")
+
+    with col2:
+        a_max_str = st.text_input("Valore finale del parametro:", value="1", key="a_max_sweep")
+
+    with col3:
+        frames_sweep = st.number_input("Fotogrammi:", min_value=2, max_value=sweep.MAX_FRAMES, value=21,
+                                       key="frames_sweep")
+
+    if not st.button("Genera animazione"):
+        replay("result_sweep")
+        return
+
+    out = SectionOutput("result_sweep")
+    timer = timing.start_render("webapp2/sweep")
+    try:
+        admission.admit(timer.app)
+        x0 = grammar.number(str_x0)
+        y0 = grammar.number(str_y0)
+        lato = grammar.number(lato_str)
+        passo = grammar.number(st.session_state["passo_contour"])
+
+        if lato <= 0 or passo <= 0:
+            out.show(st.error, "Il lato e il passo devono essere positivi")
+            st.stop()
+
+        parametro = sweep.parameter_name(param_sweep)
+        a_values = np.linspace(grammar.number(a_min_str), grammar.number(a_max_str), int(frames_sweep))
+        f = symbolic_to_callable(func_str_sweep, names=('x', 'y', parametro))
+
+        # One vectorized evaluation for all the frames, then the shared contour
+        # extraction frame by frame: the slider only switches between them
+        n = sweep.side(len(a_values), n_max=min(500, max(100, int(500 * lato))))
+        data = sweep.evaluate(f, x0, y0, lato, a_values, n)
+        tolerance = 0.5 * (data.x[1] - data.x[0])
+        frames = sweep.payload(data, sweep.frame_levels(data, passo, tolerance), tolerance)
+
+        with timing.stage("encode"):
+            spec = clientside.sweep_spec(data.x, data.y, frames, parametro,
+                                         center=(x0, y0) if center else None)
+        with timing.stage("iframe"):
+            out.show(clientside.show, spec, height=720, key="clientside_sweep")
+        out.show(st.caption, f"{len(a_values)} fotogrammi {n}×{n} con i livelli attorno a "
+                             f"$f(x_0, y_0, {parametro})$, calcolati in una sola valutazione")
+        if admission.caption():
+            out.show(st.caption, admission.caption())
+
     except ValueError as ve:
-        st.error(f"❌ Errore di validazione: {ve}")
+        out.show(st.error, f"❌ Errore di validazione: {ve}")
     except Exception as ex:
-        st.error(f"❌ Errore: {ex.__class__.__name__} - {ex}")
+        out.show(st.error, f"❌ Errore: {ex.__class__.__name__} - {ex}")
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+        timing.debug_panel(timer)
 
+sweep_section()
@@ -2,44 +2,50 @@ import streamlit as st
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib.colors as colors
-import sympy as sp
-import io
+import grammar
+import sandbox
+import planner
+import admission
+import timing
+import tiles
 import plotly.graph_objects as go
-
-def symbolic_to_callable(symbolic_str):
-    """Convert a symbolic function (string) into a Python callable function."""
-    x, y = sp.symbols('x y')  # Define the symbols
-    symbolic_expr = sp.sympify(symbolic_str)  # Convert the input string to a sympy expression
-    func = sp.lambdify((x, y), symbolic_expr, modules='numpy')  # Convert sympy expression to callable
-    return func
-
-def alg_vinc(f, g, x0=0,y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', Blevel=False, level=0, dplot=False, cplot=False):
-    x = np.arange(x0-d, x0+d, 2*d/500)
-    y = np.arange(y0-d, y0+d, 2*d/500)
+from matplotlib.figure import Figure
+import shared
+import surrogate
+import sweep
+from shared import symbolic_to_callable
+
+def alg_vinc(f, g, x0=0,y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', Blevel=False, level=0, dplot=False, cplot=False, n=500, path='direct'):
+    x = np.arange(x0-d, x0+d, 2*d/n)
+    y = np.arange(y0-d, y0+d, 2*d/n)
     X, Y = np.meshgrid(x, y)
-    Z = f(X, Y)
-    Z2 = g(X, Y)
+    Z = sandbox.evaluate(f, X, Y, path=path)
+    Z2 = sandbox.evaluate(g, X, Y, path=path, stage="g(X, Y)")
 
     fig1, ax1 = plt.subplots(figsize=(7,7))
-    im2 = ax1.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=col)
-    im = ax1.pcolormesh(X, Y, Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base=10), cmap=col)
+    with timing.stage("pcolormesh"):
+        im2 = ax1.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=col)
+        im = ax1.pcolormesh(X, Y, Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base=10), cmap=col)
     fig1.colorbar(im2, extend='both', orientation='horizontal', shrink=0.8)
     ax1.set_xlabel(r"$x$", loc='center')
     ax1.set_ylabel(r"$y$", loc='center', rotation='horizontal')
 
-    CS1 = ax1.contour(X, Y, Z2, [0], linewidths=1.5, alpha=0.5)
+    with timing.stage("contour"):
+        CS1 = ax1.contour(X, Y, Z2, [0], linewidths=1.5, alpha=0.5)
 
     if center:
         ax1.plot(x0, y0, marker='x', color='black')
 
     if Blevel:
-        ax1.contour(X, Y, Z, [level], linewidths=3)
+        with timing.stage("contour"):
+            ax1.contour(X, Y, Z, [level], linewidths=3)
 
     fig2 = fig1
     fig3 = None
 
     if dplot:
-        fig3 = go.Figure(data=[go.Surface(z=Z, x=X, y=Y, colorscale='Viridis', opacity=0.6)])
+        with timing.stage("go.Surface"):
+            fig3 = go.Figure(data=[go.Surface(z=Z, x=X, y=Y, colorscale='Viridis', opacity=0.6)])
         z2_contour = np.zeros_like(Z)
         z2_contour[Z2 == 0] = Z[Z2 == 0]
         fig3.add_trace(go.Surface(z=z2_contour, x=X, y=Y, showscale=False, colorscale='Reds', opacity=1))
@@ -54,81 +60,81 @@ def alg_vinc(f, g, x0=0,y0=0, d=1, e=0.01, cl=True, center=True, col='viridis',
 
     return fig1, fig2, fig3
 
-def alg(f, x0=0, y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', level=0, Blevel=False, dplot=False, cplot=False):
-    x = np.arange(x0 - d, x0 + d, 2 * d / 500)
-    y = np.arange(y0 - d, x0 + d, 2 * d / 500)
+def surface_figure(X, Y, Z):
+    fig3 = go.Figure(data=[go.Surface(z=Z, x=X, y=Y, colorscale='Viridis', opacity=0.6)])
+    fig3.update_layout(title='Interactive 3D Surface Plot',
+                       scene=dict(
+                           xaxis_title='X axis',
+                           yaxis_title='Y axis',
+                           zaxis_title='Z axis'
+                       ))
+    return fig3
+
+def contour3d_figure(X, Y, Z, f0, e, col):
+    fig4 = Figure(figsize=(10, 7))
+    ax4 = fig4.add_subplot(111, projection='3d')
+    ax4.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(1, 16)], linewidths=1.5, cmap='Reds')
+    ax4.contour(X, Y, Z, [f0], linewidths=1.5, colors='black')
+    ax4.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
+    ax4.plot_surface(X, Y, Z, cmap=col, rstride=1, cstride=1, alpha=0.2)
+    return fig4
+
+def alg(f, x0=0, y0=0, d=1, e=0.01, cl=True, center=True, col='viridis', level=0, Blevel=False, dplot=False, cplot=False, n=500, path='direct', approx=False):
+    """Evaluate f on the grid once and return the jobs drawing the requested 3D figures.
+
+    The jobs only share Z: run them with shared.render_concurrently. The
+    plotly surface and the mplot3d figure are built on the render threads.
+    With ``approx`` Z comes from the Chebyshev surrogate of f, returned with
+    the jobs (None when it is not accurate enough, see surrogate.evaluate).
+    """
+    approximation = None
+    if approx:
+        x = np.arange(x0 - d, x0 + d, 2 * d / n)
+        y = np.arange(y0 - d, y0 + d, 2 * d / n)
+        Z, approximation = surrogate.evaluate(f, x, y, path)
+    else:
+        # Samples from the tile cache shared with the other pages
+        window = tiles.evaluate_window(f, x0, y0, d, n, path)
+        x, y, Z = window.x, window.y, window.Z
     X, Y = np.meshgrid(x, y)
-    Z = f(X, Y)
-
-    fig1, ax1 = plt.subplots(figsize=(7, 7))
-    im2 = ax1.pcolormesh(X, Y, Z, vmin=Z.min(), vmax=Z.max(), cmap=col)
-    im = ax1.pcolormesh(X, Y, Z, norm=colors.SymLogNorm(linthresh=0.5, linscale=1, vmin=Z.min(), vmax=Z.max(), base=10), cmap=col)
-    fig1.colorbar(im2, extend='both', ax=ax1, orientation='horizontal', shrink=0.8)
-    ax1.set_xlabel(r"$x$", loc='center')
-    ax1.set_ylabel(r"$y$", loc='center', rotation='horizontal')
-
-    fig2, ax2 = plt.subplots(figsize=(7,7))
     f0 = f(x0, y0)
-    CS1 = ax2.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(1, 16)], linewidths=1.5, cmap='Reds')
-    ax2.contour(X, Y, Z, [f0], linewidths=1.5, colors='black')
-    CS2 = ax2.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
-    fig2.colorbar(CS1, extend='both', ax=ax2, orientation='horizontal', location='top')
-    fig2.colorbar(CS2, extend='both', ax=ax2, orientation='horizontal', location='bottom')
-
-    ax2.set_xlabel(r"$x$", loc='center')
-    ax2.set_ylabel(r"$y$", loc='center', rotation='horizontal')
-
-    if center:
-        ax1.plot(x0, y0, marker='x', color='black')
-        ax2.plot(x0, y0, marker='x', color='black')
-
-    if Blevel:
-        ax2.contour(X, Y, Z, [level], linewidths=3)
-
-    ax1.set_aspect('equal')
-    ax2.set_aspect('equal')
-
-    fig3 = None
 
+    jobs = {}
     if dplot:
-        fig3 = go.Figure(data=[go.Surface(z=Z, x=X, y=Y, colorscale='Viridis', opacity=0.6)])
-        f0_contour = np.zeros_like(Z)
-        f0_contour[Z == f0] = Z[Z == f0]
-        #fig3.add_trace(go.Surface(z=f0_contour, x=X, y=Y, showscale=False, colorscale='Reds', opacity=1))
-        fig3.update_layout(title='Interactive 3D Surface Plot',
-                           scene=dict(
-                               xaxis_title='X axis',
-                               yaxis_title='Y axis',
-                               zaxis_title='Z axis'
-                           ))
-        
+        jobs["go.Surface"] = lambda: surface_figure(X, Y, Z)
     if cplot:
-
-        #fig3, ax3 = plt.figure().add_subplot(projection='3d')
-        fig4 = plt.figure(figsize=(10, 7)) 
-        ax4 = fig4.add_subplot(111, projection='3d')
-
-        vmin = Z.min()
-        vmax = Z.max()
-        f0 = f(x0,y0)
-        #levels = [f0 + e * k for k in np.arange(-15, 15)]
-        ax4.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(1, 16)], linewidths=1.5, cmap='Reds')
-        ax4.contour(X,Y,Z, [f0], linewidths=1.5, colors='black')
-        ax4.contour(X, Y, Z, [f0 + 2 * e * k for k in np.arange(-15, 0)], linewidths=1.5, cmap='Blues_r')
-
-        #if vmax > 0:
-         #   ax3.contour(X, Y, Z, c_range, cmap='Reds', linewidths=1.5)
-
-        #if vmin < 0:
-         #   ax3.contour(X, Y, Z, c_range2, cmap='Blues_r', linewidths=1.5)
-
-        #ax2.contour(X,Y,Z, [0], linewidths=1.5)
-        ax4.plot_surface(X, Y, Z, cmap=col, rstride=1, cstride=1, alpha=0.2)
-    
-    if cplot == False:
-        fig4 = fig2
-
-    return fig1, fig2, fig3, fig4
+        jobs["plot_surface"] = shared.figure_job(contour3d_figure, X, Y, Z, f0, e, col)
+    return jobs, approximation
+
+def sweep_figure(data, frames, parameter):
+    """Surface and level curves of every frame of a parameter sweep, with a slider to go through them.
+
+    ``frames`` come from sweep.payload; all the frames are sent at once and
+    the animation runs in the browser.
+    """
+    finite = data.Z[np.isfinite(data.Z)]
+    zmin, zmax = (float(finite.min()), float(finite.max())) if finite.size else (0.0, 1.0)
+
+    def traces(Z, levels):
+        return [go.Surface(z=Z, x=data.x, y=data.y, colorscale='Viridis', opacity=0.6, cmin=zmin, cmax=zmax)] + [
+            go.Scatter3d(x=level["x"], y=level["y"], z=[None if v is None else level["value"] for v in level["x"]],
+                         mode='lines', line=dict(color=level["color"], width=3), hoverinfo='skip', showlegend=False)
+            for level in levels]
+
+    names = [f"{a:.4g}" for a in data.a]
+    step = dict(frame=dict(duration=200, redraw=True), transition=dict(duration=0), mode='immediate')
+    fig = go.Figure(data=traces(data.Z[0], frames[0]["levels"]),
+                    frames=[go.Frame(name=name, data=traces(Z, frame["levels"]))
+                            for name, Z, frame in zip(names, data.Z, frames)])
+    fig.update_layout(title=f'Grafico 3D al variare di {parameter}',
+                      scene=dict(xaxis_title='X axis', yaxis_title='Y axis', zaxis_title='Z axis',
+                                 zaxis=dict(range=[zmin, zmax])),
+                      updatemenus=[dict(type='buttons', showactive=False, x=0, y=0, xanchor='left', yanchor='top',
+                                        buttons=[dict(label='▶', method='animate', args=[None, dict(step, fromcurrent=True)]),
+                                                 dict(label='⏸', method='animate', args=[[None], step])])],
+                      sliders=[dict(x=0.12, len=0.88, y=0, currentvalue=dict(prefix=f"{parameter} = "),
+                                    steps=[dict(label=name, method='animate', args=[[name], step]) for name in names])])
+    return fig
 
 # Streamlit interface
 st.title("Generatore di superfici grafico in 3D")
@@ -138,10 +144,10 @@ func_str_f = st.text_input(r"Inserisci una funzione $f(x,y)$ secondo le operazio
 col1, col2 = st.columns(2)
 with col1:
     str_x0 = st.text_input(r"Scegli $x_0$ (default 0):", value=0.0)
-    x0 = float(sp.sympify(str_x0))
+    x0 = grammar.number(str_x0)
 with col2:
     str_y0 = st.text_input(r"Scegli $y_0$ (default 0):", value=0.0)
-    y0 = float(sp.sympify(str_y0))
+    y0 = grammar.number(str_y0)
     
 center = st.checkbox(r"Mostra $(x_0,y_0)$", value=False)
 
@@ -174,7 +180,7 @@ passo_attorno_f_0 = st.number_input(
 # curva_livello_f = st.checkbox(r"Scegli se visualizzare una curva di livello di $f$ 👇", value=False)
 # if curva_livello_f:
 #     liv_f_str = st.text_input("Scegli il livello:", value=0.0)
-#     livello_f = float(sp.sympify(liv_f_str))
+#     livello_f = grammar.number(liv_f_str)
 # else:
 #     livello_f=0
 #     #st.write("Seleziona la checkbox per inserire il livello che vuoi visualizzare")
@@ -183,34 +189,74 @@ dplot_f = st.checkbox(r"Scegli se visualizzare il grafico interattivo in 3D", va
 
 cplot_f = st.checkbox(r"Scegli se visualizzare il grafico statico in 3D con i livelli", value=False)
 
+approx_f = st.checkbox(r"Approssima $f$ con un polinomio di Chebyshev (ricampionamento veloce)", value=False)
+
+sweep_f = st.checkbox(r"Anima una famiglia $f(x, y, a)$ al variare di un parametro", value=False)
+if sweep_f:
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        param_sweep = st.text_input("Nome del parametro:", value="a")
+    with col2:
+        a_min_str = st.text_input("Valore iniziale:", value="-1")
+    with col3:
+        a_max_str = st.text_input("Valore finale:", value="1")
+    with col4:
+        frames_sweep = st.number_input("Fotogrammi:", min_value=2, max_value=sweep.MAX_FRAMES, value=11)
+
 
 
 # When the user clicks the button, generate the plot
-if st.button("Genera i grafici"):
+generate = st.button("Genera i grafici")
+if generate and not (sweep_f or dplot_f or cplot_f):
+    # Nothing to draw: no admission slot, no planning, no evaluation
+    st.text("Scegli una tra le due opzioni o entrambe")
+elif generate:
+    timer = timing.start_render("webapp3D")
     try:
-        # Convert the input function to a callable function
-        f = symbolic_to_callable(func_str_f)
-        # if vincolo:
-        #     g = symbolic_to_callable(func_str_g)
-
-        # Generate and display the contour plot
-        fig1, fig2, fig3, fig4 = alg(f, x0, y0, lato, passo_attorno_f_0, center=center, col=colormap, level=0, Blevel=0, dplot = dplot_f, cplot = cplot_f)
-        # if not dplot_f and not cplot_f:
-        #     st.pyplot(fig1)
-        #     st.pyplot(fig2)
-        if cplot_f and not dplot_f:
-            #st.pyplot(fig2)
-            st.pyplot(fig4)
-        if dplot_f and not cplot_f:
-            #st.pyplot(fig1)
-            st.plotly_chart(fig3)
-        if cplot_f and dplot_f:
-            #st.pyplot(fig1)
-            st.plotly_chart(fig3)
-            #st.pyplot(fig2)
-            st.pyplot(fig4)
-        if not cplot_f and not dplot_f:
-            st.text("Scegli una tra le due opzioni o entrambe")
+        admission.admit(timer.app)
+        if sweep_f:
+            # Every frame evaluated in one vectorized call, contoured with the
+            # shared extraction and sent at once: the slider needs no server work
+            parametro = sweep.parameter_name(param_sweep)
+            a_values = np.linspace(grammar.number(a_min_str), grammar.number(a_max_str), int(frames_sweep))
+            f = symbolic_to_callable(func_str_f, names=('x', 'y', parametro))
+            n = sweep.side(len(a_values), budget=sweep.MAX_SURFACE_POINTS)
+            data = sweep.evaluate(f, x0, y0, lato, a_values, n)
+            tolerance = 0.5 * (data.x[1] - data.x[0])
+            frames = sweep.payload(data, sweep.frame_levels(data, passo_attorno_f_0, tolerance), tolerance)
+            with timing.stage("go.Surface"):
+                fig = sweep_figure(data, frames, parametro)
+            with timing.stage("st.plotly_chart"):
+                st.plotly_chart(fig)
+            st.caption(f"{len(a_values)} fotogrammi {n}×{n}, calcolati in una sola valutazione")
+            if admission.caption():
+                st.caption(admission.caption())
+        else:
+            # Convert the input function to a callable function
+            f = symbolic_to_callable(func_str_f)
+            # if vincolo:
+            #     g = symbolic_to_callable(func_str_g)
+
+            # Choose the resolution that fits the latency target
+            # Only the figures drawn: the plotly surface and the mplot3d contours
+            kinds = ("surface",) * dplot_f + ("mplot3d",) * cplot_f
+            plan = planner.plan_resolution(f, x0, y0, lato, kinds=kinds)
+
+            # Evaluate once, then draw the figures concurrently: each one takes its
+            # place on the page (surface first) as soon as it is ready
+            jobs, approximation = alg(f, x0, y0, lato, passo_attorno_f_0, center=center, col=colormap, level=0, Blevel=0, dplot = dplot_f, cplot = cplot_f, n=plan.n_points, path=plan.path, approx=approx_f)
+            slots = {name: st.empty() for name in jobs}
+            for name, figure in shared.render_concurrently(jobs):
+                if isinstance(figure, bytes):
+                    with timing.stage("st.image"):
+                        slots[name].image(figure, width="stretch")
+                else:
+                    with timing.stage("st.plotly_chart"):
+                        slots[name].plotly_chart(figure)
+            shape = None if approx_f else tiles.window_shape(x0, y0, lato, plan.n_points)
+            st.caption(planner.resolution_caption(plan, shape))
+            if approx_f:
+                st.caption(surrogate.caption(approximation))
 
         # if vincolo:
         #     fig1, fig2, fig3 = alg_vinc(f, g, x0, y0, lato, passo_attorno_f_0, center=center, col=colormap, level=livello_f, Blevel=curva_livello_f)
@@ -222,3 +268,7 @@ if st.button("Genera i grafici"):
         
     except Exception as ex:
         st.error(f"Error in function input: {ex.__class__.__name__} - {ex}")
+    finally:
+        admission.release()
+        timing.finish_render(timer)
+        timing.debug_panel(timer)